@@ -0,0 +1,105 @@
+# coding: utf-8
+# asyncio interface to the libpwquality bindings
+# Copyright: 2019, Toshio Kuratomi <toshio@fedoraproject.org>
+# License: BSD or GPLv2+ at your option
+
+"""
+asyncio wrapper around PWQSettings which keeps libpwquality calls off of the event loop.
+
+The calls run on a :class:`parallel_pwq.ParallelChecker` so each worker thread has its own
+PWQSettings.  The number of calls in flight is bounded.  Once the limit is reached, callers wait
+for a free slot instead of queueing unbounded work behind the executor.
+"""
+# Make code behave more similarly on Python2 and Python3
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import asyncio
+
+from parallel_pwq import ParallelChecker
+
+
+class AsyncPWQSettings:
+    """
+    PWQSettings with awaitable check and generate methods
+
+    ::
+
+        async with AsyncPWQSettings('cffi_api_gen_pwq', max_in_flight=32) as pwq:
+            score = await pwq.check(password, username=username)
+    """
+    def __init__(self, binding='ctypes_pwq', max_workers=None, max_in_flight=None,
+                 settings_factory=None):
+        """
+        :kwarg binding: bindings module or name of the bindings module to use
+        :kwarg max_workers: number of worker threads.  Defaults to the number of cpus
+        :kwarg max_in_flight: number of calls which may be queued or running at once.  Defaults
+            to twice max_workers
+        :kwarg settings_factory: callable returning a configured PWQSettings.  Defaults to the
+            binding's PWQSettings class
+        """
+        self._checker = ParallelChecker(binding, max_workers=max_workers,
+                                        settings_factory=settings_factory)
+        self.module = self._checker.module
+        self.max_in_flight = max_in_flight or 2 * self._checker.max_workers
+        self.in_flight = 0
+        # Created on first use so that it belongs to the running event loop
+        self._semaphore = None
+
+    async def _run(self, method, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        await self._semaphore.acquire()
+        try:
+            future = self._checker.submit(method, *args)
+        except BaseException:
+            self._semaphore.release()
+            raise
+        self.in_flight += 1
+
+        # The slot is given back when the call is done rather than when the caller stops waiting
+        # for it.  Cancelling the caller does not stop a call which is already running
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(lambda _future: self._release_threadsafe(loop))
+        return await asyncio.wrap_future(future)
+
+    def _release_threadsafe(self, loop):
+        # Runs in the worker thread which finished the call
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            # The event loop was closed, so nothing is waiting for the slot
+            pass
+
+    def _release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    async def check(self, password, oldpassword=None, username=None):
+        """
+        Check whether the password conforms to the requirements and return password strength score
+
+        :arg password: password string to be checked
+        :kwarg oldpassword: old password string (or None) for additional checks
+        :kwarg username: user name (or None) for additional checks
+        """
+        return await self._run('check', password, oldpassword, username)
+
+    async def generate(self, entropy):
+        """
+        Generate password with requested entropy
+
+        :arg entropy: integer entropy bits used to generate the password
+        """
+        return await self._run('generate', entropy)
+
+    def close(self, wait=True):
+        """Stop the worker threads"""
+        self._checker.shutdown(wait=wait)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close(wait=False)
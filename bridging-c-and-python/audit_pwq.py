@@ -0,0 +1,362 @@
+# coding: utf-8
+# Multi-process password auditing with the libpwquality bindings
+# Copyright: 2019, Toshio Kuratomi <toshio@fedoraproject.org>
+# License: BSD or GPLv2+ at your option
+
+"""
+Check very large numbers of passwords by sharding them across a pool of processes.
+
+Each worker process loads the selected bindings and builds its PWQSettings once, when the pool
+starts it.  The passwords are read from the input iterable in chunks so the whole corpus never has
+to be in memory, and the results come back as batches in the same order as the input.
+
+Run as a module, this audits a file with one password per line and writes a JSON line for each
+of them::
+
+    python -m audit_pwq passwords.txt -o results.jsonl --workers 8
+
+The input is memory mapped and read a chunk at a time.  Each record has the byte offset of the
+line in the input and either its ``score`` or its error ``code`` and ``message``.  A checkpoint
+next to the output is updated every ``--checkpoint-interval`` seconds, and rerunning the same
+command with ``--resume`` after the audit was killed continues from the last checkpoint.  Progress
+and throughput are reported on stderr.
+"""
+# Make code behave more similarly on Python2 and Python3
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import argparse
+import functools
+import itertools
+import json
+import mmap
+import os
+import sys
+import tempfile
+import time
+from array import array
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from parallel_pwq import import_binding
+
+
+#: Results for one chunk of the input.  start is the index of the first password of the chunk in
+#: the input, scores is an array of scores or PWQ_ERROR_* codes, and counts maps each code
+#: (PWQ_ERROR_SUCCESS for passwords which passed) to the number of times it occurred in the chunk.
+AuditBatch = namedtuple('AuditBatch', ('start', 'scores', 'counts'))
+
+# Per-process state of the pool workers
+_WORKER_MODULE = None
+_WORKER_SETTINGS = None
+
+
+def _init_worker(binding, settings_factory):
+    global _WORKER_MODULE, _WORKER_SETTINGS
+    _WORKER_MODULE = import_binding(binding)
+    if settings_factory is None:
+        _WORKER_SETTINGS = _WORKER_MODULE.PWQSettings()
+    else:
+        _WORKER_SETTINGS = settings_factory(_WORKER_MODULE)
+
+
+def _settings_from_config(cfgfilename, module):
+    settings = module.PWQSettings()
+    settings.read_config(cfgfilename)
+    return settings
+
+
+def _check_chunk(start, passwords):
+    if hasattr(_WORKER_SETTINGS, 'check_many'):
+        scores = _WORKER_SETTINGS.check_many(passwords).scores
+    else:
+        scores = array('i')
+        for password in passwords:
+            try:
+                scores.append(_WORKER_SETTINGS.check(password))
+            except _WORKER_MODULE.PWQError as e:
+                scores.append(e.args[0])
+
+    counts = Counter(rc if rc < 0 else 0 for rc in scores)
+    return AuditBatch(start, scores, dict(counts))
+
+
+def _audit_chunk(offsets, passwords):
+    # Like _check_chunk but also returns the error messages, keyed by index in the chunk
+    messages = {}
+    if hasattr(_WORKER_SETTINGS, 'check_many'):
+        results = _WORKER_SETTINGS.check_many(passwords)
+        scores = results.scores
+        for idx, err in results.errors():
+            messages[idx] = err.args[1] if len(err.args) > 1 else str(err)
+    else:
+        scores = array('i')
+        for idx, password in enumerate(passwords):
+            try:
+                scores.append(_WORKER_SETTINGS.check(password))
+            except _WORKER_MODULE.PWQError as e:
+                scores.append(e.args[0])
+                messages[idx] = e.args[1]
+    return offsets, scores, messages
+
+
+class AuditEngine:
+    """
+    Shard password checks across a :class:`concurrent.futures.ProcessPoolExecutor`
+
+    ::
+
+        with AuditEngine('cffi_api_gen_pwq') as engine:
+            for batch in engine.run(passwords):
+                ...
+            print(engine.totals)
+    """
+    def __init__(self, binding='ctypes_pwq', max_workers=None, chunk_size=10000,
+                 max_pending=None, settings_factory=None):
+        """
+        :kwarg binding: name of the bindings module to use in the workers
+        :kwarg max_workers: number of worker processes.  Defaults to the number of cpus
+        :kwarg chunk_size: number of passwords sent to a worker at a time
+        :kwarg max_pending: number of chunks which may be queued or running at once.  This bounds
+            how far ahead of the consumer the input is read.  Defaults to twice max_workers
+        :kwarg settings_factory: picklable callable which is given the bindings module and returns
+            a configured PWQSettings.  Defaults to the module's PWQSettings class
+        """
+        if not isinstance(binding, str):
+            binding = binding.__name__
+        # Fail early in the parent rather than in every worker
+        import_binding(binding)
+
+        self.binding = binding
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending or 2 * self.max_workers
+        #: Counts of every PWQ_ERROR_* code seen by :meth:`run`
+        self.totals = Counter()
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                             initializer=_init_worker,
+                                             initargs=(binding, settings_factory))
+
+    def run(self, passwords):
+        """
+        Check passwords and yield an :class:`AuditBatch` for each chunk in input order
+
+        :arg passwords: iterable of passwords.  It is consumed lazily
+        """
+        def calls():
+            chunks = iter(lambda: list(itertools.islice(passwords, self.chunk_size)), [])
+            start = 0
+            for chunk in chunks:
+                yield _check_chunk, (start, chunk)
+                start += len(chunk)
+
+        passwords = iter(passwords)
+        for batch in self._map(calls()):
+            self.totals.update(batch.counts)
+            yield batch
+
+    def _map(self, calls):
+        """
+        Run (function, args) pairs on the pool and yield the results in order
+
+        At most max_pending calls are queued or running at once.
+        """
+        pending = deque()
+        while True:
+            for func, args in itertools.islice(calls, self.max_pending - len(pending)):
+                pending.append(self._executor.submit(func, *args))
+            if not pending:
+                break
+            yield pending.popleft().result()
+
+    def shutdown(self, wait=True):
+        """Stop the worker processes"""
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+
+#
+# Command line auditing of password files
+#
+
+def iter_lines(data, start=0):
+    """
+    Yield (offset, line) for each line of data from the byte offset start on
+
+    Line endings (``\\n`` or ``\\r\\n``) are stripped.  :arg data: bytes-like object supporting
+    ``find()``, for instance an :class:`mmap.mmap`
+    """
+    end = len(data)
+    while start < end:
+        newline = data.find(b'\n', start)
+        if newline < 0:
+            newline = end
+        line = data[start:newline]
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        yield start, line
+        start = newline + 1
+
+
+def _input_identity(path):
+    stat = os.stat(path)
+    return {'input': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def read_checkpoint(path):
+    """Return the checkpoint saved at path or None if there is none"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError):
+        return None
+
+
+def write_checkpoint(path, checkpoint):
+    """Replace the checkpoint at path atomically"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.audit-', suffix='.checkpoint')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(checkpoint, f, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def _format_records(offsets, scores, messages):
+    lines = []
+    for idx, offset in enumerate(offsets):
+        rc = scores[idx]
+        if rc >= 0:
+            lines.append('{"offset": %d, "score": %d}\n' % (offset, rc))
+        else:
+            lines.append('{"offset": %d, "code": %d, "message": %s}\n'
+                         % (offset, rc, json.dumps(messages.get(idx))))
+    return ''.join(lines).encode('utf-8')
+
+
+def audit_file(args):
+    """Audit the input file as described by the parsed command line arguments"""
+    identity = _input_identity(args.input)
+    checkpoint_path = args.checkpoint or args.output + '.checkpoint'
+    state = {'offset': 0, 'output_size': 0, 'lines': 0, 'counts': {}}
+    mode = 'wb'
+    if args.resume and os.path.exists(args.output):
+        checkpoint = read_checkpoint(checkpoint_path)
+        if checkpoint is not None:
+            if any(checkpoint.get(key) != value for key, value in identity.items()):
+                sys.stderr.write('%s is for a different input file\n' % checkpoint_path)
+                return 2
+            state.update((key, checkpoint[key]) for key in state)
+            mode = 'r+b'
+
+    totals = Counter(dict((int(code), count) for code, count in state['counts'].items()))
+    settings_factory = None
+    if args.config:
+        settings_factory = functools.partial(_settings_from_config, args.config)
+
+    with open(args.input, 'rb') as input_file, open(args.output, mode) as output, \
+            AuditEngine(args.binding, max_workers=args.workers, chunk_size=args.chunk_size,
+                        settings_factory=settings_factory) as engine:
+        # Drop the records written after the checkpoint.  They are produced again below
+        output.truncate(state['output_size'])
+        output.seek(state['output_size'])
+
+        data = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) if identity['size'] \
+            else b''
+        if hasattr(data, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            data.madvise(mmap.MADV_SEQUENTIAL)
+        lines = iter_lines(data, state['offset'])
+
+        def calls():
+            while True:
+                chunk = list(itertools.islice(lines, args.chunk_size))
+                if not chunk:
+                    break
+                offsets, passwords = zip(*chunk)
+                yield _audit_chunk, (array('q', offsets), list(passwords))
+
+        started = last_report = last_checkpoint = time.monotonic()
+        done = 0
+        for offsets, scores, messages in engine._map(calls()):
+            output.write(_format_records(offsets, scores, messages))
+            totals.update(rc if rc < 0 else 0 for rc in scores)
+            done += len(offsets)
+            state['lines'] += len(offsets)
+            state['offset'] = _line_end(data, offsets[-1])
+
+            now = time.monotonic()
+            finished = state['offset'] >= len(data)
+            if finished or now - last_checkpoint >= args.checkpoint_interval:
+                output.flush()
+                os.fsync(output.fileno())
+                state['output_size'] = output.tell()
+                state['counts'] = dict((str(code), count) for code, count in totals.items())
+                state.update(identity)
+                write_checkpoint(checkpoint_path, state)
+                last_checkpoint = now
+            if now - last_report >= args.progress_interval:
+                _report(done, state, now - started)
+                last_report = now
+
+        elapsed = time.monotonic() - started
+        _report(done, state, elapsed)
+        sys.stderr.write('results by code: %s\n'
+                         % ', '.join('%d: %d' % item for item in sorted(totals.items())))
+        if isinstance(data, mmap.mmap):
+            data.close()
+    return 0
+
+
+def _line_end(data, offset):
+    # Offset of the line after the one starting at offset
+    newline = data.find(b'\n', offset)
+    return len(data) if newline < 0 else newline + 1
+
+
+def _report(done, state, elapsed):
+    rate = done / elapsed if elapsed > 0 else 0.0
+    sys.stderr.write('%d lines (%d this run) at byte %d, %.0f lines/sec\n'
+                     % (state['lines'], done, state['offset'], rate))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m audit_pwq',
+                                     description='Check a file of passwords, one per line, and'
+                                                 ' write a JSON line with the result of each')
+    parser.add_argument('input', help='file with one password per line')
+    parser.add_argument('-o', '--output', required=True, help='JSON lines file to write')
+    parser.add_argument('--binding', default='ctypes_pwq',
+                        help='bindings module to check with (default: %(default)s)')
+    parser.add_argument('--config', help='libpwquality configuration file to read')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: number of cpus)')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='lines sent to a worker at a time (default: %(default)s)')
+    parser.add_argument('--checkpoint',
+                        help='checkpoint file (default: the output file + .checkpoint)')
+    parser.add_argument('--checkpoint-interval', type=float, default=30.0,
+                        help='seconds between checkpoints (default: %(default)s)')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the checkpoint if there is one')
+    parser.add_argument('--progress-interval', type=float, default=5.0,
+                        help='seconds between progress reports on stderr (default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    return audit_file(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
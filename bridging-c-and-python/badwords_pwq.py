@@ -0,0 +1,236 @@
+# coding: utf-8
+# Indexed badwords matching for the libpwquality bindings
+# Copyright: 2019, Toshio Kuratomi <toshio@fedoraproject.org>
+# License: BSD or GPLv2+ at your option
+
+"""
+Check the ``badwords`` setting with an Aho-Corasick automaton instead of a linear scan.
+
+libpwquality looks for each of the badwords, and each of them reversed, in the lowercased password
+one after the other, so the cost of a check grows with the length of the list.
+:class:`BadwordsIndex` compiles the words into an automaton which finds any of them in a single
+pass over the password, no matter how many there are.
+
+:class:`BadwordsFilter` wraps a settings object and takes over the rule from libpwquality::
+
+    pwq = ctypes_pwq.PWQSettings()
+    pwq.read_config()
+    badwords = BadwordsFilter(pwq)
+    badwords.check(password)
+
+The words are indexed once, when the filter is created.  Checks run on a copy of the settings
+without those words.  Of libpwquality's checks, only the cracklib dictionary check comes after
+the badwords check, so a password containing a badword raises PWQ_ERROR_BAD_WORDS when that copy
+accepts it or rejects it for the dictionary, just like libpwquality would have.
+
+Words shorter than four characters and lists with separators other than spaces are left to
+libpwquality.
+"""
+# Make code behave more similarly on Python2 and Python3
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+from array import array
+from collections import deque
+
+from parallel_pwq import import_binding
+from prefilter_pwq import PrefilterResults
+
+
+# Shorter words are left in the settings for libpwquality to check
+MIN_INDEXED_LENGTH = 4
+
+# Characters which may separate words in the list.  Lists containing any but spaces are not indexed
+_SEPARATORS = ' \t\n\r,;'
+
+
+def _to_bytes(password):
+    if isinstance(password, bytes):
+        data = password
+    elif isinstance(password, str):
+        data = password.encode('utf-8')
+    else:
+        data = memoryview(password).tobytes()
+    # libpwquality only sees the password up to the first NUL
+    return data.partition(b'\0')[0]
+
+
+class BadwordsIndex:
+    """
+    Aho-Corasick automaton matching any of a set of words or their reversals
+
+    The trie is stored in flat arrays in breadth first order so that the children of a node are
+    next to each other.  ``labels[node]`` is the byte on the edge leading to node, so the child of
+    a node for a byte is found with one ``bytes.find()`` over the node's children.
+    """
+    def __init__(self, words):
+        """:arg words: iterable of words as bytes.  They are matched case insensitively"""
+        trie = [{}]
+        terminal = [False]
+        for word in words:
+            word = word.lower()
+            if not word:
+                continue
+            for pattern in (word, word[::-1]):
+                node = 0
+                for byte in bytearray(pattern):
+                    child = trie[node].get(byte)
+                    if child is None:
+                        child = trie[node][byte] = len(trie)
+                        trie.append({})
+                        terminal.append(False)
+                    node = child
+                terminal[node] = True
+
+        # Renumber the nodes breadth first and compute the failure links
+        count = len(trie)
+        order = [0]
+        new_id = {0: 0}
+        first = array('i', [0]) * count
+        children = array('i', [0]) * count
+        labels = bytearray(count)
+        fail = array('i', [0]) * count
+        matches = bytearray(count)
+        queue = deque([0])
+        while queue:
+            node = queue.popleft()
+            node_id = new_id[node]
+            first[node_id] = len(order)
+            children[node_id] = len(trie[node])
+            for byte, child in sorted(trie[node].items()):
+                child_id = new_id[child] = len(order)
+                order.append(child)
+                labels[child_id] = byte
+                queue.append(child)
+
+                # The failure link is the longest proper suffix which is also in the trie
+                if node_id:
+                    state = fail[node_id]
+                    while True:
+                        start = first[state]
+                        pos = labels.find(byte, start, start + children[state])
+                        if pos >= 0 or not state:
+                            break
+                        state = fail[state]
+                    fail[child_id] = pos if pos >= 0 else 0
+                matches[child_id] = terminal[child] or matches[fail[child_id]]
+
+        self._first = first
+        self._children = children
+        self._labels = bytes(labels)
+        self._fail = fail
+        self._matches = bytes(matches)
+        self.nodes = count
+
+    def search(self, text):
+        """
+        Return whether text contains one of the words or their reversals
+
+        :arg text: bytes to search.  It is lowercased first
+        """
+        first = self._first
+        children = self._children
+        labels = self._labels
+        fail = self._fail
+        matches = self._matches
+        state = 0
+        for byte in bytearray(text.lower()):
+            while True:
+                start = first[state]
+                pos = labels.find(byte, start, start + children[state])
+                if pos >= 0:
+                    state = pos
+                    break
+                if not state:
+                    break
+                state = fail[state]
+            if matches[state]:
+                return True
+        return False
+
+
+class BadwordsFilter:
+    """
+    Check passwords with the badwords of a PWQSettings matched by a :class:`BadwordsIndex`
+
+    The badwords are read when the filter is created.  Call :meth:`refresh` after changing the
+    settings.  Reloads done by ``read_config(reload_interval=...)`` are picked up automatically.
+    """
+    def __init__(self, settings):
+        """:arg settings: PWQSettings of the ctypes or cffi bindings"""
+        self.module = import_binding(type(settings).__module__)
+        if not hasattr(self.module.PWQError, 'from_pwq_rc'):
+            raise ValueError('%s cannot be filtered' % self.module.__name__)
+        self.settings = settings
+        self.refresh()
+
+    def refresh(self):
+        """Index the badwords of the settings object again"""
+        values = self.settings.snapshot()
+        badwords = values.get('badwords') or ''
+        words = badwords.split(' ')
+        self.index = None
+        self._checker = self.settings
+        if any(sep in badwords for sep in _SEPARATORS[1:]):
+            return
+
+        indexed = [word for word in words if len(word) >= MIN_INDEXED_LENGTH]
+        if not indexed:
+            return
+        self.index = BadwordsIndex(word.encode('utf-8') for word in indexed)
+        values['badwords'] = ' '.join(word for word in words
+                                      if word and len(word) < MIN_INDEXED_LENGTH)
+        self._checker = self.module.PWQSettings()
+        self._checker.configure(**values)
+
+    def _poll(self):
+        watch = self.settings._config_watch
+        if watch is not None:
+            reloads = watch.reloads
+            watch.poll(self.settings)
+            if watch.reloads != reloads:
+                self.refresh()
+
+    def _overrides(self, rc):
+        # Whether a badword in the password decides the result libpwquality would return
+        return rc >= 0 or rc == self.module.PWQ_ERROR_CRACKLIB_CHECK
+
+    def check(self, password, oldpassword=None, username=None):
+        """
+        Check the password the way ``PWQSettings.check()`` does and return the score
+
+        The arguments are the same as for ``PWQSettings.check()``.
+        """
+        self._poll()
+        if self.index is None:
+            return self.settings.check(password, oldpassword, username)
+        try:
+            rc = self._checker.check(password, oldpassword, username)
+        except self.module.PWQError as e:
+            if not self._overrides(e.args[0]) or not self.index.search(_to_bytes(password)):
+                raise
+        else:
+            if not self.index.search(_to_bytes(password)):
+                return rc
+        raise self.module.PWQError.from_pwq_rc(self.module.PWQ_ERROR_BAD_WORDS)
+
+    def check_many(self, passwords, oldpasswords=None, usernames=None):
+        """
+        Check a batch of passwords and return a :class:`~prefilter_pwq.PrefilterResults`
+
+        The arguments are the same as for ``PWQSettings.check_many()``.
+        """
+        self._poll()
+        if self.index is None:
+            return self.settings.check_many(passwords, oldpasswords, usernames)
+        passwords = list(passwords)
+        results = self._checker.check_many(passwords, oldpasswords, usernames)
+        scores = array('i', results.scores)
+        checked_idx = {}
+        for idx, rc in enumerate(scores):
+            if self._overrides(rc) and self.index.search(_to_bytes(passwords[idx])):
+                scores[idx] = self.module.PWQ_ERROR_BAD_WORDS
+            else:
+                checked_idx[idx] = idx
+        return PrefilterResults(scores, [None] * len(scores), self.module.PWQError, results,
+                                checked_idx)
@@ -0,0 +1,483 @@
+# coding: utf-8
+# Benchmarks comparing the libpwquality bindings
+# Copyright: 2019, Toshio Kuratomi <toshio@fedoraproject.org>
+# License: BSD or GPLv2+ at your option
+
+"""
+Compare the cost of the different libpwquality bindings.
+
+For each binding this measures per-call latency of check() on passing and failing passwords,
+generate() latency at several entropy levels, first and repeated import time, memory growth per
+million calls, the per-call overhead of passing check()'s arguments positionally and by keyword,
+how much a batch of mostly rejected passwords costs compared to one of accepted passwords, how many
+bytes check() allocates for each type of password input, and how check()
+scales with the length of the badwords list, with and without badwords_pwq's index, and how
+check() throughput scales with the number of threads, each with its own PWQSettings.  Every
+binding is measured in its own process so that the import and memory numbers are not polluted by
+the other bindings.  The children hand their results back in a file, so anything the bindings
+print (like cffi building an out-of-line module on first use) does not get in the way.
+
+The first import is timed in the first of several fresh processes.  That is not a cold start:
+the OS page cache, the bytecode, and the cffi build cache may already be warm from earlier runs.
+
+The thread scaling numbers are most interesting on a free-threaded (``python3.13t``) build, where
+the extension module runs without the GIL.  The report records whether the GIL was enabled.
+
+Usage::
+
+    python bench_pwq.py                         # all bindings, print a table
+    python bench_pwq.py --json report.json      # also save a machine-readable report
+    python bench_pwq.py --baseline old.json --threshold 10
+                                                # exit 1 if anything got >10% slower
+
+Run it from this directory so the bindings can be imported.
+"""
+# Make code behave more similarly on Python2 and Python3
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from badwords_pwq import BadwordsFilter
+from parallel_pwq import BINDINGS
+
+
+PASSWORDS = {
+    'pass': 'Thosdjkesd%p~i l230-9',
+    'fail_length': 'Thos',
+    'fail_dictionary': 'supercalifragilic',
+}
+
+ENTROPY_LEVELS = (56, 128, 256)
+
+# Sizes of the badwords lists checked with and without badwords_pwq's index
+BADWORDS_COUNTS = (10, 1000, 100000)
+
+# Passwords rejected for reasons with and without details in the message.  A rejection heavy batch
+# has nine of these for every accepted password
+REJECTED = ('', 'Thosdjkesd%%dsekjdsohT', 'Thos', 'supercalifragilic')
+
+# Ways of passing check()'s arguments whose per-call overhead is measured
+CALL_STYLES = {
+    'positional': ((PASSWORDS['pass'],), {}),
+    'positional_all': ((PASSWORDS['pass'], None, None), {}),
+    'keywords': ((PASSWORDS['pass'],), {'oldpassword': None, 'username': None}),
+}
+
+# Numbers of threads check() throughput is measured with
+THREAD_COUNTS = (1, 2, 4, 8)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+#
+# Measurements.  These run inside of the per-binding child process
+#
+
+def time_calls(func, args, number, repeat):
+    """
+    Return the best and median per-call time of func(*args) in nanoseconds
+
+    Exceptions raised by func are ignored so that failing checks can be timed too.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            try:
+                func(*args)
+            except Exception:
+                pass
+        timings.append((time.perf_counter() - start) / number * 1e9)
+    timings.sort()
+    return {'best_ns': timings[0], 'median_ns': timings[len(timings) // 2]}
+
+
+def rss_bytes():
+    """Return the current resident set size of this process"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure_memory(func, args, calls):
+    """Return the RSS and tracemalloc growth per million calls of func(*args)"""
+    # Warm up so that one-time allocations are not counted
+    for _ in range(min(calls, 1000)):
+        try:
+            func(*args)
+        except Exception:
+            pass
+
+    rss_start = rss_bytes()
+    tracemalloc.start()
+    traced_start = tracemalloc.get_traced_memory()[0]
+    for _ in range(calls):
+        try:
+            func(*args)
+        except Exception:
+            pass
+    traced_end = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    rss_end = rss_bytes()
+
+    scale = 1000000 / calls
+    return {'rss_bytes_per_million': (rss_end - rss_start) * scale,
+            'traced_bytes_per_million': (traced_end - traced_start) * scale}
+
+
+def measure_allocations(settings, errors, calls):
+    """
+    Return the bytes check() allocates per call for text, bytes, and buffer inputs
+
+    A long password is used so that copies of it stand out from the fixed overhead of a call.
+    Input types which the binding does not accept are reported as None.
+    """
+    text = PASSWORDS['pass'] * 200
+    data = text.encode('utf-8')
+    buf = bytearray(data + b'\0')
+    inputs = {'str': text, 'bytes': data, 'bytearray': buf,
+              'memoryview': memoryview(buf)[:len(buf)]}
+
+    results = {}
+    for name, value in inputs.items():
+        try:
+            settings.check(value)
+        except errors:
+            pass
+        except Exception:
+            results[name] = None
+            continue
+
+        tracemalloc.start()
+        allocated = 0
+        for _ in range(calls):
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            try:
+                settings.check(value)
+            except errors:
+                pass
+            allocated += tracemalloc.get_traced_memory()[1] - current
+        tracemalloc.stop()
+        results[name] = allocated / calls
+    return results
+
+
+def measure_calls(settings, number, repeat):
+    """
+    Return the best and median per-call time of check() with each of the CALL_STYLES
+
+    Styles which the binding does not accept are reported as None.
+    """
+    results = {}
+    for name, (args, kwargs) in CALL_STYLES.items():
+        try:
+            settings.check(*args, **kwargs)
+        except TypeError:
+            results[name] = None
+            continue
+        check = settings.check
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                check(*args, **kwargs)
+            timings.append((time.perf_counter() - start) / number * 1e9)
+        timings.sort()
+        results[name] = {'best_ns': timings[0], 'median_ns': timings[len(timings) // 2]}
+    return results
+
+
+def measure_rejections(settings, errors, number, repeat):
+    """
+    Return the per-call time of checking a rejection heavy batch and an all accepted batch
+
+    Every call goes through the same try/except so that the difference is what raising PWQError
+    costs the binding.
+    """
+    rejected = [REJECTED[idx % len(REJECTED)] for idx in range(9)] + [PASSWORDS['pass']]
+    rejected *= max(number // len(rejected), 1)
+    batches = {'rejected': rejected, 'accepted': [PASSWORDS['pass']] * len(rejected)}
+    results = {}
+    for name, batch in batches.items():
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for password in batch:
+                try:
+                    settings.check(password)
+                except errors:
+                    pass
+            timings.append((time.perf_counter() - start) / len(batch) * 1e9)
+        timings.sort()
+        results[name] = {'best_ns': timings[0], 'median_ns': timings[len(timings) // 2]}
+    return results
+
+
+def measure_badwords(module, number, repeat):
+    """
+    Time check() of a passing password against badwords lists of each of the BADWORDS_COUNTS
+
+    libpwquality scans the list for every check so the number of calls is scaled down for the
+    long lists.  Bindings which BadwordsFilter works with are also timed with it.
+    """
+    results = {}
+    for count in BADWORDS_COUNTS:
+        settings = module.PWQSettings()
+        settings.badwords = ' '.join('qzx%d' % idx for idx in range(count))
+        calls = max(number // (1 + count // 100), 10)
+        results[str(count)] = {
+            'library': time_calls(settings.check, (PASSWORDS['pass'],), calls, repeat)}
+        if hasattr(module.PWQError, 'from_pwq_rc'):
+            badwords = BadwordsFilter(settings)
+            results[str(count)]['indexed'] = time_calls(badwords.check, (PASSWORDS['pass'],),
+                                                        number, repeat)
+    return results
+
+
+def measure_threads(module, number, repeat):
+    """
+    Time check() of a dictionary word from each of the THREAD_COUNTS threads at once
+
+    Every thread owns a PWQSettings and makes number calls.  The result is the wall time divided
+    by the calls of all of the threads, so it goes down as the binding scales.
+    """
+    results = {}
+    for count in THREAD_COUNTS:
+        settings = [module.PWQSettings() for _ in range(count)]
+        timings = []
+        for _ in range(repeat):
+            barrier = threading.Barrier(count + 1)
+
+            def worker(ctx):
+                barrier.wait()
+                for _ in range(number):
+                    try:
+                        ctx.check(PASSWORDS['fail_dictionary'])
+                    except module.PWQError:
+                        pass
+
+            threads = [threading.Thread(target=worker, args=(ctx,)) for ctx in settings]
+            for thread in threads:
+                thread.start()
+            barrier.wait()
+            start = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            timings.append((time.perf_counter() - start) / (number * count) * 1e9)
+        timings.sort()
+        results[str(count)] = {'best_ns': timings[0], 'median_ns': timings[len(timings) // 2]}
+    return results
+
+
+def measure_import(binding, repeat):
+    """
+    Return the import time of binding in milliseconds in the first and the fastest of the
+    following fresh processes
+    """
+    code = ('import sys, time; start = time.perf_counter(); import %s;'
+            ' elapsed = time.perf_counter() - start;'
+            ' open(sys.argv[1], "w").write(repr(elapsed))' % binding)
+    timings = []
+    with tempfile.NamedTemporaryFile('r', prefix='bench-pwq-', suffix='.txt') as output:
+        for _ in range(repeat + 1):
+            subprocess.check_call([sys.executable, '-c', code, output.name], cwd=HERE,
+                                  stdout=subprocess.DEVNULL)
+            output.seek(0)
+            timings.append(float(output.read()) * 1000)
+    return {'first_ms': timings[0], 'warm_ms': min(timings[1:])}
+
+
+def bench_binding(binding, number, repeat, memory_calls):
+    """Measure one binding and return the results as a dict"""
+    results = {'import': measure_import(binding, repeat)}
+
+    module = importlib.import_module(binding)
+    settings = module.PWQSettings()
+
+    results['check'] = dict((name, time_calls(settings.check, (password,), number, repeat))
+                            for name, password in PASSWORDS.items())
+    results['calls'] = measure_calls(settings, number, repeat)
+    results['rejections'] = measure_rejections(settings, module.PWQError, number, repeat)
+    results['generate'] = dict((str(entropy),
+                                time_calls(settings.generate, (entropy,), max(number // 10, 1),
+                                           repeat))
+                               for entropy in ENTROPY_LEVELS)
+    results['memory'] = dict(
+        (name, measure_memory(settings.check, (password,), memory_calls))
+        for name, password in PASSWORDS.items())
+    results['memory']['generate'] = measure_memory(settings.generate, (ENTROPY_LEVELS[0],),
+                                                   max(memory_calls // 10, 1))
+    results['allocations'] = measure_allocations(settings, module.PWQError,
+                                                 max(memory_calls // 100, 1))
+    results['badwords'] = measure_badwords(module, number, repeat)
+    results['threads'] = measure_threads(module, max(number // 10, 1), repeat)
+    # A free-threaded interpreter turns the GIL back on when it imports an extension module which
+    # does not support running without it.  sys._is_gil_enabled() is new in Python 3.13
+    results['gil_enabled'] = getattr(sys, '_is_gil_enabled', lambda: True)()
+    return results
+
+
+#
+# Reporting.  These run in the parent process
+#
+
+def run_child(binding, args):
+    with tempfile.NamedTemporaryFile('r', prefix='bench-pwq-', suffix='.json') as output:
+        cmd = [sys.executable, os.path.abspath(__file__), '--child', binding,
+               '--child-output', output.name, '--number', str(args.number),
+               '--repeat', str(args.repeat), '--memory-calls', str(args.memory_calls)]
+        try:
+            # The child's stdout is left alone for whatever the bindings print
+            subprocess.check_call(cmd, cwd=HERE, stdout=sys.stderr)
+        except subprocess.CalledProcessError as e:
+            return {'error': 'benchmark exited with %s' % e.returncode}
+        return json.load(output)
+
+
+def flatten(report):
+    """Turn a report into {(binding, metric): value} for the latency and import numbers"""
+    flat = {}
+    for binding, results in report['bindings'].items():
+        if 'error' in results:
+            continue
+        for name, timing in results['check'].items():
+            flat[(binding, 'check/%s' % name)] = timing['best_ns']
+        for entropy, timing in results['generate'].items():
+            flat[(binding, 'generate/%s' % entropy)] = timing['best_ns']
+        flat[(binding, 'import/warm')] = results['import']['warm_ms']
+        for count, timings in results.get('badwords', {}).items():
+            for kind, timing in timings.items():
+                flat[(binding, 'badwords/%s/%s' % (count, kind))] = timing['best_ns']
+        for style, timing in results.get('calls', {}).items():
+            if timing is not None:
+                flat[(binding, 'calls/%s' % style)] = timing['best_ns']
+        for name, timing in results.get('rejections', {}).items():
+            flat[(binding, 'rejections/%s' % name)] = timing['best_ns']
+        for count, timing in results.get('threads', {}).items():
+            flat[(binding, 'threads/%s' % count)] = timing['best_ns']
+    return flat
+
+
+def format_table(report):
+    """Return a comparison table of the bindings as a string"""
+    bindings = [b for b, r in report['bindings'].items() if 'error' not in r]
+    flat = flatten(report)
+    metrics = sorted(set(metric for _binding, metric in flat))
+
+    width = max([len(m) for m in metrics] + [len('metric')])
+    lines = ['%-*s %s' % (width, 'metric', ' '.join('%18s' % b for b in bindings))]
+    for metric in metrics:
+        unit = 'ms' if metric.startswith('import') else 'ns'
+        values = ' '.join('%15.1f %s' % (flat[(b, metric)], unit) if (b, metric) in flat
+                          else '%18s' % '-' for b in bindings)
+        lines.append('%-*s %s' % (width, metric, values))
+
+    for binding, results in report['bindings'].items():
+        if 'error' in results:
+            lines.append('%s: %s' % (binding, results['error']))
+            continue
+        leak = max(m['rss_bytes_per_million'] for m in results['memory'].values())
+        lines.append('%s: up to %.0f bytes RSS growth per million calls' % (binding, leak))
+        allocations = ', '.join('%s %s' % (name, 'unsupported' if size is None else '%.0f B' % size)
+                                for name, size in sorted(results['allocations'].items()))
+        lines.append('%s: check() allocates per call: %s' % (binding, allocations))
+        rejections = results.get('rejections')
+        if rejections:
+            lines.append('%s: rejection heavy batch costs %.2fx an accepted one'
+                         % (binding, rejections['rejected']['best_ns']
+                            / rejections['accepted']['best_ns']))
+        threads = results.get('threads')
+        if threads:
+            single = threads[str(THREAD_COUNTS[0])]['best_ns']
+            speedups = ', '.join('%s threads %.2fx'
+                                 % (count, single / threads[str(count)]['best_ns'])
+                                 for count in THREAD_COUNTS[1:])
+            lines.append('%s: check() throughput vs 1 thread (GIL %s): %s'
+                         % (binding, 'enabled' if results.get('gil_enabled', True) else 'disabled',
+                            speedups))
+    return '\n'.join(lines)
+
+
+def compare(report, baseline, threshold):
+    """
+    Return a list of regressions between baseline and report
+
+    :arg threshold: percentage a metric may grow before it counts as a regression
+    """
+    current = flatten(report)
+    previous = flatten(baseline)
+    regressions = []
+    for key in sorted(current):
+        if key not in previous or previous[key] <= 0:
+            continue
+        change = (current[key] - previous[key]) / previous[key] * 100
+        if change > threshold:
+            regressions.append('%s %s: %.1f -> %.1f (+%.1f%%)'
+                               % (key[0], key[1], previous[key], current[key], change))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the libpwquality bindings')
+    parser.add_argument('bindings', nargs='*', default=list(BINDINGS),
+                        help='bindings to benchmark (default: all of them)')
+    parser.add_argument('--number', type=int, default=10000,
+                        help='calls per timing run (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timing runs per measurement (default: %(default)s)')
+    parser.add_argument('--memory-calls', type=int, default=100000,
+                        help='calls used to measure memory growth (default: %(default)s)')
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--baseline', help='report to compare against')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percent slowdown which counts as a regression'
+                             ' (default: %(default)s)')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--child-output', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    if args.child:
+        results = bench_binding(args.child, args.number, args.repeat, args.memory_calls)
+        with open(args.child_output, 'w') as f:
+            json.dump(results, f)
+        return 0
+
+    report = {'python': sys.version, 'number': args.number, 'repeat': args.repeat,
+              'bindings': dict((binding, run_child(binding, args)) for binding in args.bindings)}
+
+    print(format_table(report))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print('\nRegressions over %s%%:' % args.threshold)
+            print('\n'.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
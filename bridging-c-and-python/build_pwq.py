@@ -0,0 +1,213 @@
+# coding: utf-8
+# Build step shared by the ctypes and cffi libpwquality bindings
+# Copyright: 2019, Toshio Kuratomi <toshio@fedoraproject.org>
+# License: BSD or GPLv2+ at your option
+
+"""
+Extract the information the bindings need from pwquality.h at build time.
+
+Running this writes ``pwq_constants.py`` which holds the ``PWQ_*`` constants and ``CDEF``, the
+header already cleaned up so that cffi can parse it.  When that module exists the bindings import
+it instead of reading the header every time they are loaded::
+
+    python build_pwq.py [path/to/pwquality.h] [path/to/pwq_constants.py]
+
+Without it, the bindings fall back to parsing the copy of pwquality.h which sits next to them.
+
+The cffi out-of-line bindings use :func:`load_cffi_module` to build their ``built_cffi_*`` modules
+into a per-user cache directory (``$PWQ_BUILD_CACHE`` or ``~/.cache/pwquality-bindings``) instead
+of the current directory.  Each build lives in a directory named after a hash of pwquality.h, the
+cdef and C source, and the interpreter ABI, so a changed header or a different Python gets its own
+build.  A file lock makes sure only one process compiles a given build while any others starting
+at the same time wait for it, and the finished build is renamed into place so nobody imports a
+half written module.
+"""
+# Make code behave more similarly on Python2 and Python3
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import fcntl
+import hashlib
+import importlib.util
+import os.path
+import platform
+import shutil
+import sys
+import sysconfig
+import tempfile
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+#: Header used when no other path is given
+DEFAULT_HEADER = os.path.join(HERE, 'pwquality.h')
+
+#: Where the generated module is written by default
+DEFAULT_OUTPUT = os.path.join(HERE, 'pwq_constants.py')
+
+
+def retrieve_constants(header_file=DEFAULT_HEADER):
+    """Return a dict of the ``PWQ_*`` constants defined in header_file"""
+    constants = {}
+    with open(header_file, 'r') as hf:
+        for line in hf:
+            if line.startswith('#define PWQ_'):
+                s = line.split()
+                constants[s[1]] = int(s[2])
+    return constants
+
+
+def retrieve_cdef(header_file=DEFAULT_HEADER):
+    """Return the contents of header_file stripped down to what cffi's cdef() understands"""
+    with open(header_file, 'r') as f:
+        defines = []
+        in_comment = False
+        extern_flag = False
+        for line in f:
+            test_line = line.strip()
+            if test_line.startswith('#if') or test_line.startswith('#endif'):
+                continue
+            elif test_line.startswith('/*'):
+                if test_line.endswith('*/'):
+                    continue
+                in_comment = True
+                continue
+            elif in_comment and test_line.endswith('*/'):
+                in_comment = False
+                continue
+            elif test_line.startswith('extern "C" {'):
+                extern_flag = True
+                continue
+            elif test_line.startswith('#define'):
+                if len(test_line.split()) <= 2:
+                    continue
+
+            if in_comment:
+                continue
+            defines.append(line)
+
+        if extern_flag:
+            for idx, line in reversed(list(enumerate(defines))):
+                if line.startswith('}'):
+                    break
+            del defines[idx]
+        defines = '\n'.join(defines)
+
+    return defines
+
+
+def load_cdef():
+    """Return the generated cdef if this build step has been run, otherwise parse the header"""
+    try:
+        from pwq_constants import CDEF
+    except ImportError:
+        return retrieve_cdef()
+    return CDEF
+
+
+def build_cache_dir():
+    """Return the directory the cffi modules are built in"""
+    path = os.environ.get('PWQ_BUILD_CACHE')
+    if not path:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        path = os.path.join(base, 'pwquality-bindings')
+    return path
+
+
+def build_key(module_name, cdefs, source=None, libraries=(), header_file=DEFAULT_HEADER):
+    """Return the hash which identifies a build of a cffi module"""
+    import cffi
+
+    key = hashlib.sha256()
+    for part in ([module_name, source or '', cffi.__version__, sys.implementation.cache_tag,
+                  sysconfig.get_config_var('EXT_SUFFIX') or '', platform.machine()]
+                 + list(cdefs) + list(libraries)):
+        key.update(part.encode('utf-8'))
+        key.update(b'\0')
+    try:
+        with open(header_file, 'rb') as f:
+            key.update(f.read())
+    except (IOError, OSError):
+        pass
+    return key.hexdigest()[:32]
+
+
+def _compile(module_name, cdefs, source, libraries, tmpdir):
+    import cffi
+
+    ffibuilder = cffi.FFI()
+    ffibuilder.set_source(module_name, source, libraries=list(libraries))
+    for cdef in cdefs:
+        ffibuilder.cdef(cdef)
+    return os.path.basename(ffibuilder.compile(tmpdir=tmpdir, verbose=True))
+
+
+def load_cffi_module(module_name, cdefs, source=None, libraries=()):
+    """
+    Import a cffi out-of-line module from the build cache, building it there if needed
+
+    The module is always loaded from the cache.  A module of the same name elsewhere on
+    ``sys.path``, like the stale builds older versions wrote to the current directory, would not
+    match the header, cdef, and ABI the build is keyed by and is ignored.
+
+    :arg module_name: name of the generated module
+    :arg cdefs: list of strings to pass to ``cdef()``
+    :kwarg source: C source for API mode.  None builds an ABI mode module
+    :kwarg libraries: libraries an API mode module links against
+    """
+    cache = build_cache_dir()
+    build_dir = os.path.join(cache, '%s-%s' % (module_name, build_key(module_name, cdefs, source,
+                                                                     libraries)))
+    filename_path = os.path.join(build_dir, 'module')
+    if not os.path.exists(filename_path):
+        # Other processes may be creating it at the same time
+        os.makedirs(cache, mode=0o700, exist_ok=True)
+        with open(build_dir + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Somebody else may have built it while we waited for the lock
+            if not os.path.exists(filename_path):
+                tmpdir = tempfile.mkdtemp(dir=cache, prefix='.%s-' % module_name)
+                try:
+                    filename = _compile(module_name, cdefs, source, libraries, tmpdir)
+                    with open(os.path.join(tmpdir, 'module'), 'w') as f:
+                        f.write(filename)
+                    os.rename(tmpdir, build_dir)
+                except Exception:
+                    shutil.rmtree(tmpdir, ignore_errors=True)
+                    raise
+
+    with open(filename_path) as f:
+        path = os.path.join(build_dir, f.read())
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules[module_name] = module
+    return module
+
+
+def build_constants(header_file=DEFAULT_HEADER, output_file=DEFAULT_OUTPUT):
+    """
+    Write a python module with the constants and the cdef from the libpwquality header
+
+    The constants are found with the same algorithm as pwquality uses during its build
+    """
+    constants = retrieve_constants(header_file)
+    with open(output_file, 'w') as of:
+        of.write('# This file is generated at build time from pwquality.h\n')
+        of.write('# Regenerate it with: python build_pwq.py\n')
+        for name, value in sorted(constants.items()):
+            of.write('%s = %s\n' % (name, value))
+        of.write('\n__all__ = %r\n' % sorted(constants))
+        of.write('\nCDEF = %r\n' % retrieve_cdef(header_file))
+
+
+def main(argv=None):
+    args = sys.argv[1:] if argv is None else argv
+    header_file = args[0] if len(args) > 0 else DEFAULT_HEADER
+    output_file = args[1] if len(args) > 1 else DEFAULT_OUTPUT
+    build_constants(header_file, output_file)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
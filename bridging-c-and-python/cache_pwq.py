@@ -0,0 +1,196 @@
+# coding: utf-8
+# Check result cache shared by the ctypes and cffi libpwquality bindings
+# Copyright: 2019, Toshio Kuratomi <toshio@fedoraproject.org>
+# License: BSD or GPLv2+ at your option
+
+"""
+Remember the results of ``PWQSettings.check()``.
+
+Callers like a login-time policy hook check the same password, old password, and user name over
+and over, and every one of those checks goes through cracklib.  The ctypes and cffi bindings can
+keep the results in a :class:`CheckCache`::
+
+    pwq = ctypes_pwq.PWQSettings()
+    pwq.read_config()
+    cache = pwq.enable_check_cache(maxsize=4096, ttl=300)
+    pwq.check(password, username=user)
+    cache.stats()
+
+The entries are keyed by an HMAC-SHA256 of the arguments under a key which is made at random in
+every process, so neither the passwords nor plain hashes of them are stored.  A fingerprint of the
+settings is part of what the HMAC covers.  The bindings wrap every change to the settings in
+:meth:`CheckCache.changing_settings`, which moves the cache to a new generation once the change
+is done.  The fingerprint is computed again for each generation and a result is only stored when
+no change was made while it was computed, so a result is only returned for the settings it was
+computed with.  Entries expire ttl seconds after they were stored and the least recently used are
+dropped when there are more than maxsize of them.
+
+Rejections are cached as the arguments of the exception and raised as a new exception built by
+the binding's ``PWQError.from_pwq_rc`` every time.  check_many() is not cached.
+"""
+# Make code behave more similarly on Python2 and Python3
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def _new_key():
+    global _HMAC_KEY
+    _HMAC_KEY = os.urandom(32)
+
+
+# The key which the arguments are HMACed with.  Forked children make their own
+_new_key()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_new_key)
+
+
+def _key_part(value):
+    # What libpwquality sees for a check() argument.  None, empty values, and buffers which start
+    # with a NUL are tagged apart: depending on the binding and the argument they are passed as
+    # NULL or as "", and libpwquality treats those differently (a NULL username means the user
+    # running the process).  Buffers end at their first NUL
+    if value is None:
+        return b'N'
+    if not value:
+        return b'E'
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    elif not isinstance(value, bytes):
+        value = memoryview(value).tobytes()
+    value = value.partition(b'\0')[0]
+    return b'S%d:%s' % (len(value), value)
+
+
+def settings_fingerprint(settings):
+    """Return a digest of the values of all of the settings of a PWQSettings"""
+    values = sorted(settings.snapshot().items())
+    return hashlib.sha256(repr(values).encode('utf-8')).digest()
+
+
+class CheckCache:
+    """LRU cache of check() results with a time to live, keyed by an HMAC of the arguments"""
+    def __init__(self, error_cls, maxsize=1024, ttl=300):
+        """
+        :arg error_cls: exception the binding's check() raises for rejected passwords
+        :kwarg maxsize: maximum number of results to keep
+        :kwarg ttl: seconds a result is kept for.  None keeps them until they are evicted
+        """
+        self.error_cls = error_cls
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # HMAC digest: (expiry time, score, exception args or None)
+        self._entries = OrderedDict()
+        # Bumped when a change to the settings starts and again when it is done.  A result is only
+        # stored when no change is in progress and the generation is the same as before the check
+        self._generation = 0
+        self._changes = 0
+        # (generation, digest of the settings)
+        self._fingerprint = (None, None)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def changing_settings(self):
+        """Context manager which the bindings wrap around anything that can change a setting"""
+        with self._lock:
+            self._changes += 1
+            self._generation += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._changes -= 1
+                self._generation += 1
+
+    def _current_generation(self):
+        # None while a change is in progress
+        with self._lock:
+            return None if self._changes else self._generation
+
+    def check(self, settings, check, password, oldpassword=None, username=None):
+        """
+        Return the cached result of ``check(password, oldpassword, username)`` or call it
+
+        :arg settings: the PWQSettings which check belongs to
+        :arg check: the uncached check method
+        """
+        generation = self._current_generation()
+        if generation is None:
+            # The settings are being changed so nothing can be looked up or stored
+            return check(password, oldpassword, username)
+
+        fingerprint_generation, fingerprint = self._fingerprint
+        if fingerprint_generation != generation:
+            fingerprint = settings_fingerprint(settings)
+            if self._current_generation() != generation:
+                return check(password, oldpassword, username)
+            self._fingerprint = (generation, fingerprint)
+
+        message = [fingerprint]
+        message.extend(_key_part(value) for value in (password, oldpassword, username))
+        key = hmac.digest(_HMAC_KEY, b''.join(message), 'sha256')
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] is None or entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    error_args = entry[2]
+                else:
+                    del self._entries[key]
+                    self.expirations += 1
+                    entry = None
+            if entry is None:
+                self.misses += 1
+        if entry is not None:
+            if error_args is None:
+                return entry[1]
+            # Built by from_pwq_rc so that instrumentation sees the error code of a cached rejection
+            err = self.error_cls.from_pwq_rc(error_args[0])
+            err.args = error_args
+            raise err
+
+        # A result computed while the settings were being changed may be for either version of
+        # them, so it is only kept when no change was started or finished while it was computed
+        try:
+            score = check(password, oldpassword, username)
+        except self.error_cls as e:
+            self._store(key, generation, None, e.args)
+            raise
+        self._store(key, generation, score, None)
+        return score
+
+    def _store(self, key, generation, score, error_args):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            if self._changes or self._generation != generation:
+                return
+            self._entries[key] = (expires, score, error_args)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """Return the hit, miss, eviction, and expiration counts and the number of entries"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'expirations': self.expirations, 'size': len(self._entries)}
+
+    def clear(self):
+        """Forget all of the results"""
+        with self._lock:
+            self._entries.clear()
@@ -17,10 +17,15 @@ it is easy for you to switch.
 from __future__ import absolute_import, division, print_function
 __metaclass__ = type
 
-import ctypes.util
 import sys
+import threading
+from array import array
+from contextlib import nullcontext
 
-import cffi
+from build_pwq import load_cdef, retrieve_cdef
+from cache_pwq import CheckCache
+from config_pwq import (ConfigWatch, add_setting_properties, resolve_settings,
+                        settings_by_name, snapshot_settings)
 
 
 #
@@ -51,49 +56,47 @@ else:
     to_native = to_bytes
 
 
+def to_c_string(obj):
+    """
+    Return obj in a form which can be passed as a ``char *``, avoiding copies where possible
+
+    Text is encoded to UTF-8 and bytes are passed as they are.  Other buffers (bytearray,
+    memoryview slices, ...) are passed without a copy when they end in a NUL byte.  Anything else
+    is copied into bytes.
+    """
+    if obj is None or isinstance(obj, bytes):
+        return obj
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    view = memoryview(obj).cast('B')
+    if view.nbytes and view[-1] == 0:
+        return load_library().ffi.from_buffer(view)
+    return view.tobytes()
+
+
 #
 # This code builds the extension.  It is done at runtime here but it could be used
 # When building and installing the package instead.  It generates a .c file and compiles it.
 #
 
-def init_library(header_file):
+# pwquality_generate() hands back memory from malloc() which has to be wiped and freed.  libc is a
+# dependency of libpwquality so these are found through the libpwquality handle.
+LIBC_CDEF = """
+void free(void *ptr);
+size_t strlen(const char *s);
+"""
+
+
+def init_library(header_file=None):
+    import cffi
+
     ffi = cffi.FFI()
 
-    with open(header_file, 'r') as f:
-        defines = []
-        in_comment = False
-        extern_flag = False
-        for line in f:
-            test_line = line.strip()
-            if test_line.startswith('#if') or test_line.startswith('#endif'):
-                continue
-            elif test_line.startswith('/*'):
-                if test_line.endswith('*/'):
-                    continue
-                in_comment = True
-                continue
-            elif in_comment and test_line.endswith('*/'):
-                in_comment = False
-                continue
-            elif test_line.startswith('extern "C" {'):
-                extern_flag = True
-                continue
-            elif test_line.startswith('#define'):
-                if len(test_line.split()) <= 2:
-                    continue
-
-            if in_comment:
-                continue
-            defines.append(line)
-
-        if extern_flag:
-            for idx, line in reversed(list(enumerate(defines))):
-                if line.startswith('}'):
-                    break
-            del defines[idx]
-        defines = '\n'.join(defines)
-
-    ffi.cdef(defines)
+    if header_file is None:
+        ffi.cdef(load_cdef())
+    else:
+        ffi.cdef(retrieve_cdef(header_file))
+    ffi.cdef(LIBC_CDEF)
 
     return ffi
 
@@ -106,45 +109,123 @@ def init_library(header_file):
 # to .lib and .ffi instead.
 class CffiLibrary:
     def __init__(self, library_name):
-        self.ffi = init_library('%s.h' % library_name)
-        self.lib = self.ffi.dlopen(ctypes.util.find_library(library_name))
-
+        import ctypes.util
 
-_LIBPWQ = CffiLibrary('pwquality')
+        self.ffi = init_library()
+        self.lib = self.ffi.dlopen(ctypes.util.find_library(library_name))
 
 
 # Import the constants into the namespace here.  The upstream extension module makes the constants
 # available to calling python code so that's why we do this here.
-def import_constants():
+def import_constants(lib=None):
+    if lib is None:
+        lib = _LIBPWQ.lib
     global_vars = globals()
-    attributes = dir(_LIBPWQ.lib)
+    attributes = dir(lib)
     for attrib in attributes:
         if attrib.startswith('PWQ_'):
-            global_vars[attrib] = getattr(_LIBPWQ.lib, attrib)
+            global_vars[attrib] = getattr(lib, attrib)
+
+
+#
+# Loading the library.  This is put off until the first PWQSettings is created or the first
+# constant is looked up so that importing this module is cheap.
+#
+
+_LIBPWQ = None
+_LOAD_LOCK = threading.Lock()
 
 
-import_constants()
+def load_library():
+    """Load libpwquality and the constants if that has not been done yet and return the library"""
+    global _LIBPWQ
+    if _LIBPWQ is None:
+        with _LOAD_LOCK:
+            if _LIBPWQ is None:
+                libpwq = CffiLibrary('pwquality')
+                import_constants(libpwq.lib)
+                _LIBPWQ = libpwq
+                _init_tables()
+    return _LIBPWQ
+
+
+def __getattr__(name):
+    # PEP 562.  The constants only exist once load_library() has run
+    if name.startswith('PWQ_'):
+        load_library()
+        global_vars = globals()
+        if name in global_vars:
+            return global_vars[name]
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
 
 #
 # The main portion of the bindings
 #
 
+def _free_password(password, length):
+    _LIBPWQ.ffi.memmove(password, b'\0' * length, length)
+    _LIBPWQ.lib.free(password)
+
+
+def _strerror(rc, auxerror=None):
+    if auxerror is None:
+        auxerror = _LIBPWQ.ffi.NULL
+    elif isinstance(auxerror, int):
+        # The integer auxerror of a rule evaluated in Python (see prefilter_pwq)
+        auxerror = _LIBPWQ.ffi.cast('void *', auxerror)
+    buf = _LIBPWQ.ffi.new('char []', PWQ_MAX_ERROR_MESSAGE_LEN)
+    msg = _LIBPWQ.lib.pwquality_strerror(buf, len(buf), rc, auxerror)
+    return to_native(_LIBPWQ.ffi.string(msg))
+
+
 class PWQError(Exception):
     """
     Standard exception thrown from PWQSettings method calls
 
     The exception value is always an integer error code and string description.
     """
+    # Set when the message depends on auxerror and has not been formatted yet
+    _auxerror = None
+
     @staticmethod
     def from_pwq_rc(rc, auxerror=None):
         if rc == PWQ_ERROR_MEM_ALLOC:
             return MemoryError()
 
-        buf = _LIBPWQ.ffi.new('char []', b'\0' * (PWQ_MAX_ERROR_MESSAGE_LEN - 1))
-        msg = _LIBPWQ.lib.pwquality_strerror(buf, len(buf), rc, auxerror)
-        print(auxerror)
-        return PWQError(rc, to_native(_LIBPWQ.ffi.string(msg)))
+        if not auxerror:
+            msg = _ERROR_MESSAGES.get(rc)
+            if msg is None:
+                msg = _strerror(rc)
+        elif rc in _BORROWED_AUXERROR_CODES:
+            # Defer formatting until somebody looks at the message
+            err = PWQError(rc)
+            err._auxerror = auxerror
+            return err
+        else:
+            msg = _strerror(rc, auxerror)
+
+        if rc in _ATTRIBUTE_ERROR_CODES:
+            # The upstream bindings report bad setting names as AttributeError
+            return AttributeError(rc, msg)
+        return PWQError(rc, msg)
+
+    @property
+    def args(self):
+        if self._auxerror is not None:
+            auxerror = self._auxerror
+            self._auxerror = None
+            rc = BaseException.args.__get__(self)[0]
+            BaseException.args.__set__(self, (rc, _strerror(rc, auxerror)))
+        return BaseException.args.__get__(self)
+
+    @args.setter
+    def args(self, value):
+        self._auxerror = None
+        BaseException.args.__set__(self, value)
+
+    def __reduce__(self):
+        return (self.__class__, self.args)
 
     def __repr__(self):
         return 'PWQError(%r, %r)' % (self.args[0], self.args[1])
@@ -153,22 +234,133 @@ class PWQError(Exception):
         return '(%r, %r)' % (self.args[0], self.args[1])
 
 
+# Filled in by _init_tables() once the library has been loaded
+_BORROWED_AUXERROR_CODES = frozenset()
+_ATTRIBUTE_ERROR_CODES = frozenset()
+_ERROR_MESSAGES = {}
+_SETTINGS_BY_NAME = {}
+_SETTINGS = ()
+
+
+def _init_tables():
+    global _BORROWED_AUXERROR_CODES, _ATTRIBUTE_ERROR_CODES, _ERROR_MESSAGES
+    global _SETTINGS_BY_NAME, _SETTINGS
+
+    # The messages for these codes are formatted from an integer or from a static cracklib string
+    # in auxerror.  Neither needs to be freed so the formatting can wait until the message is read.
+    _BORROWED_AUXERROR_CODES = frozenset((
+        PWQ_ERROR_MIN_DIGITS, PWQ_ERROR_MIN_UPPERS, PWQ_ERROR_MIN_LOWERS, PWQ_ERROR_MIN_OTHERS,
+        PWQ_ERROR_MIN_LENGTH, PWQ_ERROR_MIN_CLASSES, PWQ_ERROR_MAX_CONSECUTIVE,
+        PWQ_ERROR_MAX_CLASS_REPEAT, PWQ_ERROR_MAX_SEQUENCE, PWQ_ERROR_CRACKLIB_CHECK,
+    ))
+
+    # Messages for when there is no auxerror only depend on the error code
+    _ERROR_MESSAGES = dict((value, _strerror(value)) for name, value in list(globals().items())
+                           if name.startswith('PWQ_ERROR_'))
+
+    _ATTRIBUTE_ERROR_CODES = frozenset((
+        PWQ_ERROR_UNKNOWN_SETTING, PWQ_ERROR_NON_INT_SETTING, PWQ_ERROR_NON_STR_SETTING,
+    ))
+
+    # Setting property name to (setting id, type) and the (setting id, type) pairs on their own
+    _SETTINGS_BY_NAME = settings_by_name(globals())
+    _SETTINGS = tuple(_SETTINGS_BY_NAME.values())
+
+
+class CheckResults:
+    """
+    Results of a :meth:`PWQSettings.check_many` call
+
+    The scores are kept in a compact :class:`array.array` in the same order as the passwords which
+    were checked.  Negative values are PWQ_ERROR_* codes.  The PWQError for a failed check is only
+    created when it is asked for.
+    """
+    def __init__(self, scores, auxerrors):
+        self.scores = scores
+        self._auxerrors = auxerrors
+        self._errors = {}
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __iter__(self):
+        return iter(self.scores)
+
+    def __getitem__(self, idx):
+        return self.scores[idx]
+
+    def error(self, idx):
+        """
+        Return the exception for a failed check or None if the password passed
+
+        :arg idx: index of the password in the batch
+        """
+        if idx < 0:
+            idx += len(self.scores)
+        rc = self.scores[idx]
+        if rc >= 0:
+            return None
+        try:
+            return self._errors[idx]
+        except KeyError:
+            err = self._errors[idx] = PWQError.from_pwq_rc(rc, self._auxerrors[idx])
+        return err
+
+    def errors(self):
+        """Iterate over (index, exception) pairs for the passwords which failed the check"""
+        for idx, rc in enumerate(self.scores):
+            if rc < 0:
+                yield idx, self.error(idx)
+
+
 class PWQSettings:
     def __init__(self):
-        self._pwqsettings = _LIBPWQ.lib.pwquality_default_settings()
+        self._pwqsettings = load_library().lib.pwquality_default_settings()
         if self._pwqsettings is None:
             raise MemoryError
 
     def __del__(self):
         _LIBPWQ.lib.pwquality_free_settings(self._pwqsettings)
 
-    def read_config(self, cfgfilename=None):
+    # Set by read_config() when the configuration file should be reapplied after it changes
+    _config_watch = None
+
+    # Set by enable_check_cache() to remember the results of check()
+    _check_cache = None
+
+    def read_config(self, cfgfilename=None, reload_interval=None):
         """
         Read the settings from configuration file
 
         :kwarg cfgfilename: path to the configuration file (optional)
+        :kwarg reload_interval: when given, :meth:`check` and :meth:`generate` look at the file
+            again once this many seconds have passed and reapply it if it has changed
+        """
+        cfgfilename = to_native(cfgfilename)
+        if reload_interval is None:
+            self._read_config_file(cfgfilename)
+            self._config_watch = None
+        else:
+            watch = ConfigWatch(cfgfilename, _SETTINGS, reload_interval)
+            watch.read(self)
+            self._config_watch = watch
+
+    def enable_check_cache(self, maxsize=1024, ttl=300):
         """
-        pass
+        Remember the results of :meth:`check` and return the :class:`~cache_pwq.CheckCache`
+
+        Results are keyed by an HMAC of the arguments and the settings, so they are not returned
+        after a setting changes.  Calling this again starts over with an empty cache.
+
+        :kwarg maxsize: maximum number of results to keep
+        :kwarg ttl: seconds a result is kept for.  None keeps them until they are evicted
+        """
+        self._check_cache = CheckCache(PWQError, maxsize, ttl)
+        return self._check_cache
+
+    def disable_check_cache(self):
+        """Stop remembering the results of :meth:`check`"""
+        self._check_cache = None
 
     def set_option(self, option):
         """
@@ -176,7 +368,79 @@ class PWQSettings:
 
         :arg option: string with the name=value pair
         """
-        pass
+        with self._changing_settings():
+            rc = _LIBPWQ.lib.pwquality_set_option(self._pwqsettings, to_bytes(option))
+        if rc < 0:
+            raise PWQError.from_pwq_rc(rc)
+
+    def configure(self, **settings):
+        """
+        Change several settings at once
+
+        Settings before one that libpwquality rejects have already been applied when the
+        exception is raised.
+
+        :kwarg settings: new values keyed by setting property name, for instance
+            ``configure(minlen=12, dictcheck=0)``
+        """
+        self._set_settings(resolve_settings(settings, _SETTINGS_BY_NAME))
+
+    def snapshot(self):
+        """Return the current value of every setting in a dict keyed by setting property name"""
+        return snapshot_settings(self, _SETTINGS_BY_NAME)
+
+    def _changing_settings(self):
+        # Wrapped around anything which can change a setting
+        if self._check_cache is not None:
+            return self._check_cache.changing_settings()
+        return nullcontext()
+
+    def _get_setting(self, setting, kind):
+        ffi = _LIBPWQ.ffi
+        if kind is int:
+            value = ffi.new('int *')
+            rc = _LIBPWQ.lib.pwquality_get_int_value(self._pwqsettings, setting, value)
+        else:
+            value = ffi.new('const char **')
+            rc = _LIBPWQ.lib.pwquality_get_str_value(self._pwqsettings, setting, value)
+        if rc < 0:
+            raise PWQError.from_pwq_rc(rc)
+        if kind is int:
+            return value[0]
+        return to_native(ffi.string(value[0])) if value[0] else None
+
+    def _set_setting(self, setting, kind, value):
+        with self._changing_settings():
+            if kind is int:
+                rc = _LIBPWQ.lib.pwquality_set_int_value(self._pwqsettings, setting, value)
+            else:
+                value = _LIBPWQ.ffi.NULL if value is None else to_bytes(value)
+                rc = _LIBPWQ.lib.pwquality_set_str_value(self._pwqsettings, setting, value)
+        if rc < 0:
+            raise PWQError.from_pwq_rc(rc)
+
+    def _read_config_file(self, cfgfilename):
+        auxerror_ptr = _LIBPWQ.ffi.new('void **', None)
+        cfgfilename = _LIBPWQ.ffi.NULL if cfgfilename is None else to_bytes(cfgfilename)
+        with self._changing_settings():
+            rc = _LIBPWQ.lib.pwquality_read_config(self._pwqsettings, cfgfilename, auxerror_ptr)
+        if rc < 0:
+            raise PWQError.from_pwq_rc(rc, auxerror_ptr[0])
+
+    def _get_settings(self, settings_ids):
+        # ctypes/ABI mode cannot loop in C so these make one foreign call per setting
+        values = {}
+        for setting, kind in settings_ids:
+            try:
+                values[(setting, kind)] = self._get_setting(setting, kind)
+            except AttributeError:
+                # This version of libpwquality does not have the setting
+                pass
+        return values
+
+    def _set_settings(self, values):
+        for setting, kind, value in values:
+            self._set_setting(setting, kind, value)
 
     def generate(self, entropy):
         """
@@ -184,26 +448,90 @@ class PWQSettings:
 
         :arg entropy: integer entropy bits used to generate the password
         """
+        if self._config_watch is not None:
+            self._config_watch.poll(self)
+
         password_ptr = _LIBPWQ.ffi.new('char **', None)
 
         rc = _LIBPWQ.lib.pwquality_generate(self._pwqsettings, entropy, password_ptr)
         if rc < 0:
             raise PWQError.from_pwq_rc(rc)
-        return to_native(_LIBPWQ.ffi.string(password_ptr[0]))
+
+        length = _LIBPWQ.lib.strlen(password_ptr[0])
+        try:
+            return to_native(_LIBPWQ.ffi.string(password_ptr[0], length))
+        finally:
+            _free_password(password_ptr[0], length)
+
+    def generate_many(self, count, entropy):
+        """
+        Generate a list of passwords with requested entropy
+
+        :arg count: number of passwords to generate
+        :arg entropy: integer entropy bits used to generate the passwords
+        """
+        if self._config_watch is not None:
+            self._config_watch.poll(self)
+
+        # ABI mode cannot loop in C so this is a convenience over calling generate() count times
+        return [self.generate(entropy) for _ in range(count)]
+
+    def generate_into(self, buffer, entropy):
+        """
+        Generate password with requested entropy into a caller supplied buffer
+
+        The password is written as UTF-8 followed by a NUL byte when there is room for one, so
+        the buffer can be handed straight to :meth:`check`.  The copy that libpwquality allocated
+        is wiped before it is freed.  Returns the length of the password.
+
+        :arg buffer: writable buffer (for instance a bytearray) to write the password into
+        :arg entropy: integer entropy bits used to generate the password
+        """
+        if self._config_watch is not None:
+            self._config_watch.poll(self)
+
+        view = memoryview(buffer).cast('B')
+        if view.readonly:
+            raise TypeError('buffer must be writable')
+
+        password_ptr = _LIBPWQ.ffi.new('char **', None)
+        rc = _LIBPWQ.lib.pwquality_generate(self._pwqsettings, entropy, password_ptr)
+        if rc < 0:
+            raise PWQError.from_pwq_rc(rc)
+
+        length = _LIBPWQ.lib.strlen(password_ptr[0])
+        try:
+            if length > view.nbytes:
+                raise ValueError('buffer is too small for a %s byte password' % length)
+            _LIBPWQ.ffi.memmove(view, password_ptr[0], length)
+            if length < view.nbytes:
+                view[length] = 0
+        finally:
+            _free_password(password_ptr[0], length)
+
+        return length
 
     def check(self, password, oldpassword=None, username=None):
         """
         Check whether the password conforms to the requirements and return password strength score
 
-        :arg password: password string to be checked
+        :arg password: password string to be checked.  bytes, bytearray and NUL terminated
+            memoryview slices holding UTF-8 are passed to libpwquality without copying them
         :kwarg oldpassword: old password string (or None) for additional checks
         :kwarg username: user name (or None) for additional checks
         """
+        if self._config_watch is not None:
+            self._config_watch.poll(self)
+        if self._check_cache is not None:
+            return self._check_cache.check(self, self._check, password, oldpassword, username)
+        return self._check(password, oldpassword, username)
+
+    def _check(self, password, oldpassword, username):
         auxerror_ptr = _LIBPWQ.ffi.new('void **', None)
 
-        password = to_bytes(password)
-        oldpassword = to_bytes(oldpassword) or _LIBPWQ.ffi.NULL
-        username = to_bytes(username) or _LIBPWQ.ffi.NULL
+        password = to_c_string(password)
+        oldpassword = to_c_string(oldpassword) if oldpassword else _LIBPWQ.ffi.NULL
+        username = to_c_string(username) if username else _LIBPWQ.ffi.NULL
 
         rc = _LIBPWQ.lib.pwquality_check(self._pwqsettings, password, oldpassword,
                                          username, auxerror_ptr)
@@ -211,3 +539,45 @@ class PWQSettings:
             raise PWQError.from_pwq_rc(rc, auxerror_ptr[0])
 
         return rc
+
+    def check_many(self, passwords, oldpasswords=None, usernames=None):
+        """
+        Check a batch of passwords and return a :class:`CheckResults`
+
+        ABI mode cannot loop in C so this still makes one foreign call per password but the
+        auxerror storage for the whole batch is allocated once.
+
+        :arg passwords: iterable of password strings to be checked
+        :kwarg oldpasswords: sequence of old password strings (or None) matching passwords
+        :kwarg usernames: sequence of user names (or None) matching passwords
+        """
+        if self._config_watch is not None:
+            self._config_watch.poll(self)
+
+        ffi = _LIBPWQ.ffi
+        passwords = [to_c_string(p) for p in passwords]
+        count = len(passwords)
+        if oldpasswords is None:
+            oldpasswords = [None] * count
+        if usernames is None:
+            usernames = [None] * count
+        if len(oldpasswords) != count or len(usernames) != count:
+            raise ValueError('oldpasswords and usernames must be the same length as passwords')
+
+        scores = array('i', [0]) * count
+        auxerrors = ffi.new('void *[]', count)
+        check = _LIBPWQ.lib.pwquality_check
+        pwqsettings = self._pwqsettings
+
+        for idx, password in enumerate(passwords):
+            oldpassword = oldpasswords[idx]
+            username = usernames[idx]
+            scores[idx] = check(pwqsettings, password,
+                                to_c_string(oldpassword) if oldpassword else ffi.NULL,
+                                to_c_string(username) if username else ffi.NULL, auxerrors + idx)
+
+        return CheckResults(scores, auxerrors)
+
+
+# difok, minlen, dictpath, and the other setting properties of the upstream bindings
+add_setting_properties(PWQSettings, globals())
@@ -17,9 +17,16 @@ it is easy for you to switch.
 from __future__ import absolute_import, division, print_function
 __metaclass__ = type
 
+import operator
 import sys
+import threading
+from array import array
+from contextlib import nullcontext
 
-import cffi
+from build_pwq import load_cdef, load_cffi_module
+from cache_pwq import CheckCache
+from config_pwq import (ConfigWatch, add_setting_properties, coerce_setting,
+                        settings_by_name, snapshot_settings)
 
 
 #
@@ -50,100 +57,263 @@ else:
     to_native = to_bytes
 
 
+def to_c_string(obj):
+    """
+    Return obj in a form which can be passed as a ``char *``, avoiding copies where possible
+
+    Text is encoded to UTF-8 and bytes are passed as they are.  Other buffers (bytearray,
+    memoryview slices, ...) are passed without a copy when they end in a NUL byte.  Anything else
+    is copied into bytes.
+    """
+    if obj is None or isinstance(obj, bytes):
+        return obj
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    view = memoryview(obj).cast('B')
+    if view.nbytes and view[-1] == 0:
+        return load_library().ffi.from_buffer(view)
+    return view.tobytes()
+
+
 #
 # This code builds the extension.  It is done at runtime here but it could be used
 # When building and installing the package instead.  It generates a .c file and compiles it.
 #
 
-def build_extension():
-    ffibuilder = cffi.FFI()
-
-    #'/srv/git/libpwquality/libpwquality/src/pwqprivate.h'
-
-    ffibuilder.set_source("built_cffi_api_pwq", '#include "pwquality.h"', libraries=['pwquality'])
-
-    with open('pwquality.h', 'r') as f:
-        defines = []
-        in_comment = False
-        extern_flag = False
-        for line in f:
-            test_line = line.strip()
-            if test_line.startswith('#if') or test_line.startswith('#endif'):
-                continue
-            elif test_line.startswith('/*'):
-                if test_line.endswith('*/'):
-                    continue
-                in_comment = True
-                continue
-            elif in_comment and test_line.endswith('*/'):
-                in_comment = False
-                continue
-            elif test_line.startswith('extern "C" {'):
-                extern_flag = True
-                continue
-            elif test_line.startswith('#define'):
-                if len(test_line.split()) <= 2:
-                    continue
-
-            if in_comment:
-                continue
-            defines.append(line)
+# Helpers compiled into the extension alongside the library bindings.  Looping in C lets a whole
+# batch of checks or generated passwords cross from Python into C only once.
+EXTENSION_SOURCE = """
+#include <stdlib.h>
+#include <string.h>
+#include "pwquality.h"
+
+static void
+pwq_wipe(char *s, size_t len)
+{
+        /* volatile so that the compiler cannot drop the stores before free() */
+        volatile char *p = s;
+
+        while (len--)
+                *p++ = '\\0';
+}
+
+static void
+pwq_free_passwords(char **passwords, size_t count)
+{
+        size_t i;
+
+        for (i = 0; i < count; i++) {
+                if (passwords[i] != NULL) {
+                        pwq_wipe(passwords[i], strlen(passwords[i]));
+                        free(passwords[i]);
+                        passwords[i] = NULL;
+                }
+        }
+}
+
+static int
+pwq_generate_many(pwquality_settings_t *pwq, int entropy_bits, size_t count, char **passwords)
+{
+        size_t i;
+        int rc;
+
+        for (i = 0; i < count; i++) {
+                if ((rc = pwquality_generate(pwq, entropy_bits, &passwords[i])) < 0) {
+                        pwq_free_passwords(passwords, i);
+                        return rc;
+                }
+        }
+        return 0;
+}
+
+static void
+pwq_check_many(pwquality_settings_t *pwq, size_t count, char **passwords,
+               char **oldpasswords, char **usernames, int *scores, void **auxerrors)
+{
+        size_t i;
+
+        for (i = 0; i < count; i++) {
+                scores[i] = pwquality_check(pwq, passwords[i],
+                                            oldpasswords ? oldpasswords[i] : NULL,
+                                            usernames ? usernames[i] : NULL,
+                                            &auxerrors[i]);
+        }
+}
+
+static int
+pwq_set_values(pwquality_settings_t *pwq, size_t count, const int *settings, const int *is_str,
+               const int *int_values, char **str_values)
+{
+        size_t i;
+        int rc;
+
+        for (i = 0; i < count; i++) {
+                if (is_str[i])
+                        rc = pwquality_set_str_value(pwq, settings[i], str_values[i]);
+                else
+                        rc = pwquality_set_int_value(pwq, settings[i], int_values[i]);
+                if (rc < 0)
+                        return rc;
+        }
+        return 0;
+}
+
+static void
+pwq_get_values(pwquality_settings_t *pwq, size_t count, const int *settings, const int *is_str,
+               int *int_values, const char **str_values, int *rcs)
+{
+        size_t i;
+
+        for (i = 0; i < count; i++) {
+                if (is_str[i])
+                        rcs[i] = pwquality_get_str_value(pwq, settings[i], &str_values[i]);
+                else
+                        rcs[i] = pwquality_get_int_value(pwq, settings[i], &int_values[i]);
+        }
+}
+"""
 
-        if extern_flag:
-            for idx, line in reversed(list(enumerate(defines))):
-                if line.startswith('}'):
-                    break
-            del defines[idx]
-        defines = '\n'.join(defines)
+EXTENSION_CDEF = """
+void free(void *ptr);
+size_t strlen(const char *s);
+void pwq_wipe(char *s, size_t len);
+void pwq_free_passwords(char **passwords, size_t count);
+int pwq_generate_many(pwquality_settings_t *pwq, int entropy_bits, size_t count,
+                      char **passwords);
+void pwq_check_many(pwquality_settings_t *pwq, size_t count, char **passwords,
+                    char **oldpasswords, char **usernames, int *scores, void **auxerrors);
+int pwq_set_values(pwquality_settings_t *pwq, size_t count, const int *settings,
+                   const int *is_str, const int *int_values, char **str_values);
+void pwq_get_values(pwquality_settings_t *pwq, size_t count, const int *settings,
+                    const int *is_str, int *int_values, const char **str_values, int *rcs);
+"""
 
-    ffibuilder.cdef(defines)
 
-    ffibuilder.compile(verbose=True)
+def build_extension():
+    # Compiled once per header, cdef, and Python ABI in the per-user build cache
+    return load_cffi_module("built_cffi_api_pwq", [load_cdef(), EXTENSION_CDEF],
+                            source=EXTENSION_SOURCE, libraries=['pwquality'])
 
 #
 # Pythonic-API layer
 #
 
-# Load the bindings or generate and compile the bindings and then load them
-try:
-    import built_cffi_api_pwq as _LIBPWQ
-except Exception:
-    build_extension()
-    import built_cffi_api_pwq as _LIBPWQ
+def init_libpwquality():
+    # Load the bindings or generate and compile the bindings and then load them
+    return build_extension()
 
 
 # Import the constants into the namespace here.  The upstream extension module makes the constants
 # available to calling python code so that's why we do this here.
-def import_constants():
+def import_constants(lib=None):
+    if lib is None:
+        lib = _LIBPWQ.lib
     global_vars = globals()
-    attributes = dir(_LIBPWQ.lib)
+    attributes = dir(lib)
     for attrib in attributes:
         if attrib.startswith('PWQ_'):
-            global_vars[attrib] = getattr(_LIBPWQ.lib, attrib)
+            global_vars[attrib] = getattr(lib, attrib)
+
+
+#
+# Loading the library.  This is put off until the first PWQSettings is created or the first
+# constant is looked up so that importing this module is cheap.
+#
 
+_LIBPWQ = None
+_LOAD_LOCK = threading.Lock()
 
-import_constants()
+
+def load_library():
+    """Load libpwquality and the constants if that has not been done yet and return the library"""
+    global _LIBPWQ
+    if _LIBPWQ is None:
+        with _LOAD_LOCK:
+            if _LIBPWQ is None:
+                libpwq = init_libpwquality()
+                import_constants(libpwq.lib)
+                _LIBPWQ = libpwq
+                _init_tables()
+    return _LIBPWQ
+
+
+def __getattr__(name):
+    # PEP 562.  The constants only exist once load_library() has run
+    if name.startswith('PWQ_'):
+        load_library()
+        global_vars = globals()
+        if name in global_vars:
+            return global_vars[name]
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
 
 #
 # The main portion of the bindings
 #
 
+def _free_password(password, length):
+    _LIBPWQ.lib.pwq_wipe(password, length)
+    _LIBPWQ.lib.free(password)
+
+
+def _strerror(rc, auxerror=None):
+    if auxerror is None:
+        auxerror = _LIBPWQ.ffi.NULL
+    elif isinstance(auxerror, int):
+        # The integer auxerror of a rule evaluated in Python (see prefilter_pwq)
+        auxerror = _LIBPWQ.ffi.cast('void *', auxerror)
+    buf = _LIBPWQ.ffi.new('char []', PWQ_MAX_ERROR_MESSAGE_LEN)
+    msg = _LIBPWQ.lib.pwquality_strerror(buf, len(buf), rc, auxerror)
+    return to_native(_LIBPWQ.ffi.string(msg))
+
+
 class PWQError(Exception):
     """
     Standard exception thrown from PWQSettings method calls
 
     The exception value is always an integer error code and string description.
     """
+    # Set when the message depends on auxerror and has not been formatted yet
+    _auxerror = None
+
     @staticmethod
     def from_pwq_rc(rc, auxerror=None):
         if rc == PWQ_ERROR_MEM_ALLOC:
             return MemoryError()
 
-        buf = _LIBPWQ.ffi.new('char []', b'\0' * (PWQ_MAX_ERROR_MESSAGE_LEN - 1))
-        msg = _LIBPWQ.lib.pwquality_strerror(buf, len(buf), rc, auxerror)
-        print(auxerror)
-        return PWQError(rc, to_native(_LIBPWQ.ffi.string(msg)))
+        if not auxerror:
+            msg = _ERROR_MESSAGES.get(rc)
+            if msg is None:
+                msg = _strerror(rc)
+        elif rc in _BORROWED_AUXERROR_CODES:
+            # Defer formatting until somebody looks at the message
+            err = PWQError(rc)
+            err._auxerror = auxerror
+            return err
+        else:
+            msg = _strerror(rc, auxerror)
+
+        if rc in _ATTRIBUTE_ERROR_CODES:
+            # The upstream bindings report bad setting names as AttributeError
+            return AttributeError(rc, msg)
+        return PWQError(rc, msg)
+
+    @property
+    def args(self):
+        if self._auxerror is not None:
+            auxerror = self._auxerror
+            self._auxerror = None
+            rc = BaseException.args.__get__(self)[0]
+            BaseException.args.__set__(self, (rc, _strerror(rc, auxerror)))
+        return BaseException.args.__get__(self)
+
+    @args.setter
+    def args(self, value):
+        self._auxerror = None
+        BaseException.args.__set__(self, value)
+
+    def __reduce__(self):
+        return (self.__class__, self.args)
 
     def __repr__(self):
         return 'PWQError(%r, %r)' % (self.args[0], self.args[1])
@@ -152,22 +322,161 @@ class PWQError(Exception):
         return '(%r, %r)' % (self.args[0], self.args[1])
 
 
+# Filled in by _init_tables() once the library has been loaded
+_BORROWED_AUXERROR_CODES = frozenset()
+_ATTRIBUTE_ERROR_CODES = frozenset()
+_ERROR_MESSAGES = {}
+_SETTINGS_BY_NAME = {}
+_SETTINGS = ()
+
+
+def _init_tables():
+    global _BORROWED_AUXERROR_CODES, _ATTRIBUTE_ERROR_CODES, _ERROR_MESSAGES
+    global _SETTINGS_BY_NAME, _SETTINGS
+
+    # The messages for these codes are formatted from an integer or from a static cracklib string
+    # in auxerror.  Neither needs to be freed so the formatting can wait until the message is read.
+    _BORROWED_AUXERROR_CODES = frozenset((
+        PWQ_ERROR_MIN_DIGITS, PWQ_ERROR_MIN_UPPERS, PWQ_ERROR_MIN_LOWERS, PWQ_ERROR_MIN_OTHERS,
+        PWQ_ERROR_MIN_LENGTH, PWQ_ERROR_MIN_CLASSES, PWQ_ERROR_MAX_CONSECUTIVE,
+        PWQ_ERROR_MAX_CLASS_REPEAT, PWQ_ERROR_MAX_SEQUENCE, PWQ_ERROR_CRACKLIB_CHECK,
+    ))
+
+    # Messages for when there is no auxerror only depend on the error code
+    _ERROR_MESSAGES = dict((value, _strerror(value)) for name, value in list(globals().items())
+                           if name.startswith('PWQ_ERROR_'))
+
+    _ATTRIBUTE_ERROR_CODES = frozenset((
+        PWQ_ERROR_UNKNOWN_SETTING, PWQ_ERROR_NON_INT_SETTING, PWQ_ERROR_NON_STR_SETTING,
+    ))
+
+    # Setting property name to (setting id, type) and the (setting id, type) pairs on their own
+    _SETTINGS_BY_NAME = settings_by_name(globals())
+    _SETTINGS = tuple(_SETTINGS_BY_NAME.values())
+
+
+# configure() keyword names seen before mapped to the setting ids and types to pass to C for them
+_CONFIGURE_PLANS = {}
+_MAX_CONFIGURE_PLANS = 256
+
+
+def _configure_plan(names):
+    ids = []
+    for name in names:
+        try:
+            ids.append(_SETTINGS_BY_NAME[name])
+        except KeyError:
+            raise TypeError('configure() got an unexpected keyword argument %r' % name)
+
+    ffi = _LIBPWQ.ffi
+    is_str = [kind is str for _setting, kind in ids]
+    plan = (ffi.new('int[]', [setting for setting, _kind in ids]), ffi.new('int[]', is_str),
+            is_str)
+    if len(_CONFIGURE_PLANS) >= _MAX_CONFIGURE_PLANS:
+        _CONFIGURE_PLANS.clear()
+    _CONFIGURE_PLANS[names] = plan
+    return plan
+
+
+def _c_setting_string(value):
+    value = coerce_setting(str, value)
+    return _LIBPWQ.ffi.NULL if value is None else _LIBPWQ.ffi.new('char[]', to_bytes(value))
+
+
+class CheckResults:
+    """
+    Results of a :meth:`PWQSettings.check_many` call
+
+    The scores are kept in a compact :class:`array.array` in the same order as the passwords which
+    were checked.  Negative values are PWQ_ERROR_* codes.  The PWQError for a failed check is only
+    created when it is asked for.
+    """
+    def __init__(self, scores, auxerrors):
+        self.scores = scores
+        self._auxerrors = auxerrors
+        self._errors = {}
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __iter__(self):
+        return iter(self.scores)
+
+    def __getitem__(self, idx):
+        return self.scores[idx]
+
+    def error(self, idx):
+        """
+        Return the exception for a failed check or None if the password passed
+
+        :arg idx: index of the password in the batch
+        """
+        if idx < 0:
+            idx += len(self.scores)
+        rc = self.scores[idx]
+        if rc >= 0:
+            return None
+        try:
+            return self._errors[idx]
+        except KeyError:
+            err = self._errors[idx] = PWQError.from_pwq_rc(rc, self._auxerrors[idx])
+        return err
+
+    def errors(self):
+        """Iterate over (index, exception) pairs for the passwords which failed the check"""
+        for idx, rc in enumerate(self.scores):
+            if rc < 0:
+                yield idx, self.error(idx)
+
+
 class PWQSettings:
     def __init__(self):
-        self._pwqsettings = _LIBPWQ.lib.pwquality_default_settings()
+        self._pwqsettings = load_library().lib.pwquality_default_settings()
         if self._pwqsettings is None:
             raise MemoryError
 
     def __del__(self):
         _LIBPWQ.lib.pwquality_free_settings(self._pwqsettings)
 
-    def read_config(self, cfgfilename=None):
+    # Set by read_config() when the configuration file should be reapplied after it changes
+    _config_watch = None
+
+    # Set by enable_check_cache() to remember the results of check()
+    _check_cache = None
+
+    def read_config(self, cfgfilename=None, reload_interval=None):
         """
         Read the settings from configuration file
 
         :kwarg cfgfilename: path to the configuration file (optional)
+        :kwarg reload_interval: when given, :meth:`check` and :meth:`generate` look at the file
+            again once this many seconds have passed and reapply it if it has changed
+        """
+        cfgfilename = to_native(cfgfilename)
+        if reload_interval is None:
+            self._read_config_file(cfgfilename)
+            self._config_watch = None
+        else:
+            watch = ConfigWatch(cfgfilename, _SETTINGS, reload_interval)
+            watch.read(self)
+            self._config_watch = watch
+
+    def enable_check_cache(self, maxsize=1024, ttl=300):
         """
-        pass
+        Remember the results of :meth:`check` and return the :class:`~cache_pwq.CheckCache`
+
+        Results are keyed by an HMAC of the arguments and the settings, so they are not returned
+        after a setting changes.  Calling this again starts over with an empty cache.
+
+        :kwarg maxsize: maximum number of results to keep
+        :kwarg ttl: seconds a result is kept for.  None keeps them until they are evicted
+        """
+        self._check_cache = CheckCache(PWQError, maxsize, ttl)
+        return self._check_cache
+
+    def disable_check_cache(self):
+        """Stop remembering the results of :meth:`check`"""
+        self._check_cache = None
 
     def set_option(self, option):
         """
@@ -175,7 +484,144 @@ class PWQSettings:
 
         :arg option: string with the name=value pair
         """
-        pass
+        with self._changing_settings():
+            rc = _LIBPWQ.lib.pwquality_set_option(self._pwqsettings, to_bytes(option))
+        if rc < 0:
+            raise PWQError.from_pwq_rc(rc)
+
+    def configure(self, **settings):
+        """
+        Change several settings at once.  They are all applied in a single call into C and the
+        setting ids for each combination of keywords are only looked up the first time.
+
+        Settings before one that libpwquality rejects have already been applied when the
+        exception is raised.
+
+        :kwarg settings: new values keyed by setting property name, for instance
+            ``configure(minlen=12, dictcheck=0)``
+        """
+        names = tuple(settings)
+        plan = _CONFIGURE_PLANS.get(names)
+        if plan is None:
+            plan = _configure_plan(names)
+        c_settings, c_is_str, is_str = plan
+
+        ffi = _LIBPWQ.ffi
+        values = list(settings.values())
+        int_values = array('i', [0 if string else operator.index(value)
+                                 for string, value in zip(is_str, values)])
+        str_values = [_c_setting_string(value) if string else ffi.NULL
+                      for string, value in zip(is_str, values)]
+
+        with self._changing_settings():
+            rc = _LIBPWQ.lib.pwq_set_values(self._pwqsettings, len(values), c_settings, c_is_str,
+                                            ffi.from_buffer('int[]', int_values),
+                                            ffi.new('char *[]', str_values))
+        if rc < 0:
+            raise PWQError.from_pwq_rc(rc)
+
+    def snapshot(self):
+        """
+        Return the current value of every setting in a dict keyed by setting property name
+
+        All of the settings are read in a single call into C.
+        """
+        return snapshot_settings(self, _SETTINGS_BY_NAME)
+
+    def _changing_settings(self):
+        # Wrapped around anything which can change a setting
+        if self._check_cache is not None:
+            return self._check_cache.changing_settings()
+        return nullcontext()
+
+    def _get_setting(self, setting, kind):
+        ffi = _LIBPWQ.ffi
+        if kind is int:
+            value = ffi.new('int *')
+            rc = _LIBPWQ.lib.pwquality_get_int_value(self._pwqsettings, setting, value)
+        else:
+            value = ffi.new('const char **')
+            rc = _LIBPWQ.lib.pwquality_get_str_value(self._pwqsettings, setting, value)
+        if rc < 0:
+            raise PWQError.from_pwq_rc(rc)
+        if kind is int:
+            return value[0]
+        return to_native(ffi.string(value[0])) if value[0] else None
+
+    def _set_setting(self, setting, kind, value):
+        with self._changing_settings():
+            if kind is int:
+                rc = _LIBPWQ.lib.pwquality_set_int_value(self._pwqsettings, setting, value)
+            else:
+                value = _LIBPWQ.ffi.NULL if value is None else to_bytes(value)
+                rc = _LIBPWQ.lib.pwquality_set_str_value(self._pwqsettings, setting, value)
+        if rc < 0:
+            raise PWQError.from_pwq_rc(rc)
+
+    def _read_config_file(self, cfgfilename):
+        auxerror_ptr = _LIBPWQ.ffi.new('void **', None)
+        cfgfilename = _LIBPWQ.ffi.NULL if cfgfilename is None else to_bytes(cfgfilename)
+        with self._changing_settings():
+            rc = _LIBPWQ.lib.pwquality_read_config(self._pwqsettings, cfgfilename, auxerror_ptr)
+        if rc < 0:
+            raise PWQError.from_pwq_rc(rc, auxerror_ptr[0])
+
+    def _get_settings(self, settings_ids):
+        ffi = _LIBPWQ.ffi
+        count = len(settings_ids)
+        settings = array('i', [setting for setting, _kind in settings_ids])
+        is_str = array('i', [kind is str for _setting, kind in settings_ids])
+        int_values = array('i', settings)
+        str_values = ffi.new('const char *[]', count)
+        rcs = array('i', settings)
+        _LIBPWQ.lib.pwq_get_values(self._pwqsettings, count, ffi.from_buffer('int[]', settings),
+                                   ffi.from_buffer('int[]', is_str),
+                                   ffi.from_buffer('int[]', int_values), str_values,
+                                   ffi.from_buffer('int[]', rcs))
+
+        values = {}
+        for idx, key in enumerate(settings_ids):
+            rc = rcs[idx]
+            if rc < 0:
+                if rc in _ATTRIBUTE_ERROR_CODES:
+                    # This version of libpwquality does not have the setting
+                    continue
+                raise PWQError.from_pwq_rc(rc)
+            if not is_str[idx]:
+                values[key] = int_values[idx]
+            elif str_values[idx]:
+                values[key] = to_native(ffi.string(str_values[idx]))
+            else:
+                values[key] = None
+        return values
+
+    def _set_settings(self, values):
+        ffi = _LIBPWQ.ffi
+        settings = array('i')
+        is_str = array('i')
+        int_values = array('i')
+        str_values = []
+        for setting, kind, value in values:
+            settings.append(setting)
+            if kind is str:
+                is_str.append(1)
+                int_values.append(0)
+                str_values.append(ffi.NULL if value is None else ffi.new('char[]', to_bytes(value)))
+            else:
+                is_str.append(0)
+                int_values.append(value)
+                str_values.append(ffi.NULL)
+        if not settings:
+            return
+
+        with self._changing_settings():
+            rc = _LIBPWQ.lib.pwq_set_values(self._pwqsettings, len(settings),
+                                            ffi.from_buffer('int[]', settings),
+                                            ffi.from_buffer('int[]', is_str),
+                                            ffi.from_buffer('int[]', int_values),
+                                            ffi.new('char *[]', str_values))
+        if rc < 0:
+            raise PWQError.from_pwq_rc(rc)
 
     def generate(self, entropy):
         """
@@ -183,26 +629,100 @@ class PWQSettings:
 
         :arg entropy: integer entropy bits used to generate the password
         """
+        if self._config_watch is not None:
+            self._config_watch.poll(self)
+
         password_ptr = _LIBPWQ.ffi.new('char **', None)
 
         rc = _LIBPWQ.lib.pwquality_generate(self._pwqsettings, entropy, password_ptr)
         if rc < 0:
             raise PWQError.from_pwq_rc(rc)
-        return to_native(_LIBPWQ.ffi.string(password_ptr[0]))
+
+        length = _LIBPWQ.lib.strlen(password_ptr[0])
+        try:
+            return to_native(_LIBPWQ.ffi.string(password_ptr[0], length))
+        finally:
+            _free_password(password_ptr[0], length)
+
+    def generate_many(self, count, entropy):
+        """
+        Generate a list of passwords with requested entropy
+
+        :arg count: number of passwords to generate
+        :arg entropy: integer entropy bits used to generate the passwords
+        """
+        if self._config_watch is not None:
+            self._config_watch.poll(self)
+
+        ffi = _LIBPWQ.ffi
+        passwords = ffi.new('char *[]', count)
+
+        # The loop runs in C.  On failure it has already freed what it generated
+        rc = _LIBPWQ.lib.pwq_generate_many(self._pwqsettings, entropy, count, passwords)
+        if rc < 0:
+            raise PWQError.from_pwq_rc(rc)
+
+        try:
+            return [to_native(ffi.string(password)) for password in passwords]
+        finally:
+            _LIBPWQ.lib.pwq_free_passwords(passwords, count)
+
+    def generate_into(self, buffer, entropy):
+        """
+        Generate password with requested entropy into a caller supplied buffer
+
+        The password is written as UTF-8 followed by a NUL byte when there is room for one, so
+        the buffer can be handed straight to :meth:`check`.  The copy that libpwquality allocated
+        is wiped before it is freed.  Returns the length of the password.
+
+        :arg buffer: writable buffer (for instance a bytearray) to write the password into
+        :arg entropy: integer entropy bits used to generate the password
+        """
+        if self._config_watch is not None:
+            self._config_watch.poll(self)
+
+        view = memoryview(buffer).cast('B')
+        if view.readonly:
+            raise TypeError('buffer must be writable')
+
+        password_ptr = _LIBPWQ.ffi.new('char **', None)
+        rc = _LIBPWQ.lib.pwquality_generate(self._pwqsettings, entropy, password_ptr)
+        if rc < 0:
+            raise PWQError.from_pwq_rc(rc)
+
+        length = _LIBPWQ.lib.strlen(password_ptr[0])
+        try:
+            if length > view.nbytes:
+                raise ValueError('buffer is too small for a %s byte password' % length)
+            _LIBPWQ.ffi.memmove(view, password_ptr[0], length)
+            if length < view.nbytes:
+                view[length] = 0
+        finally:
+            _free_password(password_ptr[0], length)
+
+        return length
 
     def check(self, password, oldpassword=None, username=None):
         """
         Check whether the password conforms to the requirements and return password strength score
 
-        :arg password: password string to be checked
+        :arg password: password string to be checked.  bytes, bytearray and NUL terminated
+            memoryview slices holding UTF-8 are passed to libpwquality without copying them
         :kwarg oldpassword: old password string (or None) for additional checks
         :kwarg username: user name (or None) for additional checks
         """
+        if self._config_watch is not None:
+            self._config_watch.poll(self)
+        if self._check_cache is not None:
+            return self._check_cache.check(self, self._check, password, oldpassword, username)
+        return self._check(password, oldpassword, username)
+
+    def _check(self, password, oldpassword, username):
         auxerror_ptr = _LIBPWQ.ffi.new('void **', None)
 
-        password = to_bytes(password)
-        oldpassword = to_bytes(oldpassword) or _LIBPWQ.ffi.NULL
-        username = to_bytes(username) or _LIBPWQ.ffi.NULL
+        password = to_c_string(password)
+        oldpassword = to_c_string(oldpassword) if oldpassword else _LIBPWQ.ffi.NULL
+        username = to_c_string(username) if username else _LIBPWQ.ffi.NULL
 
         rc = _LIBPWQ.lib.pwquality_check(self._pwqsettings, password, oldpassword,
                                          username, auxerror_ptr)
@@ -210,3 +730,56 @@ class PWQSettings:
             raise PWQError.from_pwq_rc(rc, auxerror_ptr[0])
 
         return rc
+
+    def check_many(self, passwords, oldpasswords=None, usernames=None):
+        """
+        Check a batch of passwords and return a :class:`CheckResults`
+
+        The loop over the passwords runs in C so the whole batch is a single call into the
+        extension.
+
+        :arg passwords: iterable of password strings to be checked
+        :kwarg oldpasswords: sequence of old password strings (or None) matching passwords
+        :kwarg usernames: sequence of user names (or None) matching passwords
+        """
+        if self._config_watch is not None:
+            self._config_watch.poll(self)
+
+        ffi = _LIBPWQ.ffi
+
+        def c_string(obj):
+            # The char * arrays need cdata so bytes have to be copied into a char[]
+            obj = to_c_string(obj)
+            if isinstance(obj, bytes):
+                return ffi.new('char[]', obj)
+            return obj
+
+        keepalive = [c_string(p) for p in passwords]
+        count = len(keepalive)
+        c_passwords = ffi.new('char *[]', keepalive)
+
+        c_extra = []
+        for extra in (oldpasswords, usernames):
+            if extra is None:
+                c_extra.append(ffi.NULL)
+                continue
+            if len(extra) != count:
+                raise ValueError('oldpasswords and usernames must be the same length as'
+                                 ' passwords')
+            extra = [c_string(e) if e else ffi.NULL for e in extra]
+            keepalive.extend(extra)
+            c_extra.append(ffi.new('char *[]', extra))
+
+        c_scores = ffi.new('int[]', count)
+        auxerrors = ffi.new('void *[]', count)
+
+        _LIBPWQ.lib.pwq_check_many(self._pwqsettings, count, c_passwords, c_extra[0],
+                                   c_extra[1], c_scores, auxerrors)
+
+        scores = array('i')
+        scores.frombytes(ffi.buffer(c_scores))
+        return CheckResults(scores, auxerrors)
+
+
+# difok, minlen, dictpath, and the other setting properties of the upstream bindings
+add_setting_properties(PWQSettings, globals())
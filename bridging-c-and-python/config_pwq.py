@@ -0,0 +1,214 @@
+# coding: utf-8
+# Settings support shared by the ctypes and cffi libpwquality bindings
+# Copyright: 2019, Toshio Kuratomi <toshio@fedoraproject.org>
+# License: BSD or GPLv2+ at your option
+
+"""
+Settings support shared by the ctypes and cffi bindings.
+
+:data:`SETTINGS` maps the ``PWQ_SETTING_*`` constants to the attribute names which the upstream
+bindings use.  :func:`add_setting_properties` turns it into properties on a PWQSettings class and
+:func:`resolve_settings` checks the keyword arguments given to ``PWQSettings.configure()``.
+
+``PWQSettings.read_config()`` in the ctypes and cffi bindings has libpwquality parse the file
+every time.  With a ``reload_interval`` it uses a :class:`ConfigWatch` to pick up edits to the
+file and the ``<file>.d/*.conf`` snippets beside it in long-running processes.
+
+The bindings provide these methods on their PWQSettings for all of this to work with:
+``_get_setting(setting, kind)``, ``_set_setting(setting, kind, value)``,
+``_get_settings(settings_ids)``, ``_set_settings(values)`` and ``_read_config_file(cfgfilename)``.
+The plural forms let a binding read or apply many settings in one call into C.
+"""
+# Make code behave more similarly on Python2 and Python3
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import operator
+import os
+import sys
+import time
+
+
+#: The file libpwquality reads when read_config() is not given one
+DEFAULT_CFGFILE = '/etc/security/pwquality.conf'
+
+#: Attribute name, constant name, type and description of the settings libpwquality has.  The
+#: attribute names are those of the upstream pwquality bindings
+SETTINGS = (
+    ('difok', 'PWQ_SETTING_DIFF_OK', int, 'Minimum difference from the old password'),
+    ('minlen', 'PWQ_SETTING_MIN_LENGTH', int, 'Minimum length of the new password'),
+    ('dcredit', 'PWQ_SETTING_DIG_CREDIT', int, 'Credit for or minimum of digits'),
+    ('ucredit', 'PWQ_SETTING_UP_CREDIT', int, 'Credit for or minimum of uppercase characters'),
+    ('lcredit', 'PWQ_SETTING_LOW_CREDIT', int, 'Credit for or minimum of lowercase characters'),
+    ('ocredit', 'PWQ_SETTING_OTH_CREDIT', int, 'Credit for or minimum of other characters'),
+    ('minclass', 'PWQ_SETTING_MIN_CLASS', int, 'Minimum number of character classes'),
+    ('maxrepeat', 'PWQ_SETTING_MAX_REPEAT', int, 'Maximum repeated consecutive characters'),
+    ('maxclassrepeat', 'PWQ_SETTING_MAX_CLASS_REPEAT', int,
+     'Maximum consecutive characters of the same class'),
+    ('maxsequence', 'PWQ_SETTING_MAX_SEQUENCE', int,
+     'Maximum length of a monotonic character sequence'),
+    ('gecoscheck', 'PWQ_SETTING_GECOS_CHECK', int,
+     'Match words from the passwd GECOS field if available'),
+    ('dictcheck', 'PWQ_SETTING_DICT_CHECK', int, 'Perform the dictionary check'),
+    ('usercheck', 'PWQ_SETTING_USER_CHECK', int,
+     'Check whether the password contains the user name'),
+    ('enforcing', 'PWQ_SETTING_ENFORCING', int, 'Reject the password if it fails the checks'),
+    ('retry', 'PWQ_SETTING_RETRY_TIMES', int, 'Number of times the PAM module prompts'),
+    ('enforce_for_root', 'PWQ_SETTING_ENFORCE_ROOT', int, 'Enforce the checks for root too'),
+    ('local_users_only', 'PWQ_SETTING_LOCAL_USERS', int, 'Only check local users'),
+    ('badwords', 'PWQ_SETTING_BAD_WORDS', str,
+     'List of words more than 3 characters long that are forbidden'),
+    ('dictpath', 'PWQ_SETTING_DICT_PATH', str, 'Path to the cracklib dictionary'),
+)
+
+_SETTINGS_BY_NAME = dict((name, (constant, kind)) for name, constant, kind, _doc in SETTINGS)
+
+if sys.version_info >= (3,):
+    unicode = str
+
+
+def coerce_setting(kind, value):
+    """Check value the way the upstream bindings' setters do and return it"""
+    if kind is int:
+        return operator.index(value)
+    if value is not None and not isinstance(value, unicode):
+        raise TypeError('expected unicode string')
+    return value
+
+
+def settings_by_name(namespace):
+    """
+    Return {attribute name: (setting id, type)} for the settings whose constants are in namespace
+
+    :arg namespace: mapping holding the ``PWQ_SETTING_*`` constants
+    """
+    return dict((name, (namespace[constant], kind)) for name, constant, kind, _doc in SETTINGS
+                if constant in namespace)
+
+
+def resolve_settings(values, table, caller='configure'):
+    """
+    Return (setting id, type, value) triples for a mapping of setting attribute names to values
+
+    :arg values: mapping of setting attribute names to their new values
+    :arg table: mapping returned by :func:`settings_by_name`
+    :kwarg caller: name of the function to mention when a name is not a setting
+    :raises TypeError: if a name is not a setting or a value has the wrong type
+    """
+    resolved = []
+    for name, value in values.items():
+        try:
+            setting, kind = table[name]
+        except KeyError:
+            raise TypeError('%s() got an unexpected keyword argument %r' % (caller, name))
+        resolved.append((setting, kind, coerce_setting(kind, value)))
+    return resolved
+
+
+def snapshot_settings(settings, table):
+    """
+    Return {attribute name: value} for the settings libpwquality supports
+
+    :arg settings: PWQSettings to read the values from
+    :arg table: mapping returned by :func:`settings_by_name`
+    """
+    values = settings._get_settings(list(table.values()))
+    return dict((name, values[key]) for name, key in table.items() if key in values)
+
+
+def _setting_property(constant, kind, doc, namespace):
+    # The constants are looked up on each access as the bindings load them lazily
+    def fget(self):
+        return self._get_setting(namespace[constant], kind)
+
+    def fset(self, value):
+        self._set_setting(namespace[constant], kind, coerce_setting(kind, value))
+
+    return property(fget, fset, doc=doc)
+
+
+def add_setting_properties(cls, namespace):
+    """
+    Add a property to cls for every setting in :data:`SETTINGS`
+
+    :arg cls: PWQSettings class which has ``_get_setting()`` and ``_set_setting()``
+    :arg namespace: mapping which holds the ``PWQ_SETTING_*`` constants once the library is loaded
+    """
+    for name, constant, kind, doc in SETTINGS:
+        setattr(cls, name, _setting_property(constant, kind, doc, namespace))
+    return cls
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return (path, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def config_key(cfgfilename):
+    """
+    Return a value which changes whenever cfgfilename or the snippets in its .d directory change
+
+    None is returned when cfgfilename cannot be stat'd.
+    """
+    try:
+        key = [_stat_key(cfgfilename)]
+    except OSError:
+        return None
+
+    confdir = cfgfilename + '.d'
+    try:
+        names = sorted(name for name in os.listdir(confdir) if name.endswith('.conf'))
+    except OSError:
+        names = []
+    for name in names:
+        try:
+            key.append(_stat_key(os.path.join(confdir, name)))
+        except OSError:
+            pass
+    return tuple(key)
+
+
+class ConfigWatch:
+    """Reapply a configuration file to a settings object when the file changes"""
+    def __init__(self, cfgfilename, settings_ids, interval):
+        """
+        :arg cfgfilename: path to the configuration file or None for :data:`DEFAULT_CFGFILE`
+        :arg settings_ids: (setting id, type) pairs from :func:`settings_by_name`
+        :arg interval: minimum number of seconds between checks of the file
+        """
+        self.cfgfilename = cfgfilename
+        self.settings_ids = settings_ids
+        self.interval = interval
+        self.reloads = 0
+        self._key = None
+        self._previous = ()
+        self._next_poll = time.monotonic() + interval
+
+    def read(self, settings):
+        """Have libpwquality apply the file to settings and remember what it changed"""
+        key = config_key(DEFAULT_CFGFILE if self.cfgfilename is None else self.cfgfilename)
+        before = settings._get_settings(self.settings_ids)
+        settings._read_config_file(self.cfgfilename)
+        after = settings._get_settings(self.settings_ids)
+        self._key = key
+        self._previous = tuple((setting, kind, before[(setting, kind)])
+                               for (setting, kind), value in after.items()
+                               if (setting, kind) in before and before[(setting, kind)] != value)
+
+    def poll(self, settings):
+        """Reapply the file to settings if it has changed.  Cheap until the interval has passed"""
+        now = time.monotonic()
+        if now < self._next_poll:
+            return False
+        self._next_poll = now + self.interval
+
+        path = DEFAULT_CFGFILE if self.cfgfilename is None else self.cfgfilename
+        if config_key(path) == self._key:
+            return False
+
+        # Settings which the old file changed go back to what they were before it was read so
+        # that removing a line from the file takes effect
+        settings._set_settings(self._previous)
+        self.read(settings)
+        self.reloads += 1
+        return True
@@ -0,0 +1,437 @@
+# coding: utf-8
+# Shared dictionary index for skipping cracklib in the libpwquality bindings
+# Copyright: 2019, Toshio Kuratomi <toshio@fedoraproject.org>
+# License: BSD or GPLv2+ at your option
+
+"""
+Skip the cracklib dictionary lookup for passwords which cannot be dictionary words.
+
+With ``dictcheck`` on, every password which passes the other rules is handed to cracklib.
+cracklib opens the dictionary, then looks up the password under each of its mangling rules, and
+this dominates the time a check takes.  :class:`DictionaryIndex` is a sorted array of hashes of
+the words in the wordlist the cracklib dictionary was built from.  It is written to a file once
+and memory mapped read-only, so all of the processes using it share one copy through the page
+cache.
+
+:class:`DictPrefilter` looks up the forms cracklib's mangling rules can turn a password into:
+
+* lowercased, with whitespace trimmed
+* with up to three characters removed from the start or the end
+* with punctuation, symbols, or digits purged
+* with digits and ``$`` read as the letters they stand for (``0`` as ``o``, ``4`` as ``a`` or
+  ``h``, ...)
+* duplicated or reflected
+* reversed, and then any of the above
+
+When none of those forms are in the index, the password is not a dictionary word.  If it also
+cannot trip cracklib's other checks (too short, too few different characters, too systematic,
+like a National Insurance number, or like the user's password entry), it is checked with
+``dictcheck=0``.  Everything else goes through the normal check, so the results are the same as
+libpwquality's::
+
+    index = DictionaryIndex.load('/usr/share/cracklib/cracklib-small', '/var/cache/pwq.idx')
+    prefilter = DictPrefilter(ctypes_pwq.PWQSettings(), index)
+    prefilter.check(password)
+
+Lookups compare hashes, so a collision only sends a password through the normal check.
+"""
+# Make code behave more similarly on Python2 and Python3
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import bisect
+import gzip
+import mmap
+import os
+import pwd
+import re
+import struct
+import tempfile
+import zlib
+from array import array
+
+from parallel_pwq import import_binding
+
+
+_MAGIC = b'PWQDICT1'
+# magic, bucket bits, number of keys, size and mtime of the wordlist the index was built from
+_HEADER = struct.Struct('<8sQQQq')
+
+# cracklib's substitution rules turn these into letters.  1 and 4 have two readings each so their
+# letters are folded together as well.  Folding only ever makes more passwords look like words.
+_FOLD = bytes(bytearray(range(256))).translate(
+    bytes.maketrans(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ', b'abcdefghijklmnopqrstuvwxyz'))
+_FOLD = _FOLD.translate(bytes.maketrans(b'0234h5$1l', b'oaeaassii'))
+
+_PUNCTUATION = b'!"\'(),-.:;?`'
+_NOT_ALNUM = bytes(byte for byte in range(256)
+                   if not (0x30 <= byte <= 0x39 or 0x61 <= byte <= 0x7a))
+_NOT_ALPHA = bytes(byte for byte in range(256) if not 0x61 <= byte <= 0x7a)
+_DIGITS = b'0123456789'
+
+# cracklib's own limits, tightened so that passwords near them go through the normal check
+_MIN_LENGTH = 7
+_MIN_DIFFERENT = 6
+_MAX_STEPS = 3
+_MAX_DIGITS = 5
+
+# cracklib-format cuts the words to this many characters
+_MAX_WORD_LENGTH = 1022
+
+_WORD_SPLIT = re.compile(br'[^a-z0-9]+')
+
+
+def _key(form):
+    # Two different checksums are much cheaper than a cryptographic hash and a collision only
+    # costs a normal check
+    form = form.translate(_FOLD)
+    return zlib.crc32(form) << 32 | zlib.adler32(form)
+
+
+def _to_bytes(password):
+    if isinstance(password, bytes):
+        return password
+    if isinstance(password, str):
+        return password.encode('utf-8')
+    return memoryview(password).tobytes()
+
+
+def password_forms(password):
+    """
+    Return the set of strings cracklib may look up in the dictionary for password
+
+    :arg password: the password as UTF-8 bytes
+    """
+    lower = password.lower()
+    trimmed = lower.strip()
+    reverse = trimmed[::-1]
+    forms = set((lower,))
+    # cracklib runs its destructors over the password and then over the reversed password
+    for text in (trimmed, reverse):
+        forms.add(text)
+        for count in range(1, 4):
+            forms.add(text[count:])
+            forms.add(text[:-count])
+        for chars in (_PUNCTUATION, _NOT_ALNUM, _NOT_ALPHA, _DIGITS):
+            forms.add(text.translate(None, chars))
+
+    forms.update((reverse + reverse, trimmed + trimmed, reverse + trimmed, trimmed + reverse))
+    # Not one of cracklib's rules but cheap insurance: a doubled or mirrored word is a word
+    half = len(trimmed) // 2
+    if trimmed[:half] in (trimmed[-half:], trimmed[:-half - 1:-1]):
+        forms.update((trimmed[:half], trimmed[-half:]))
+    forms.discard(b'')
+    return forms
+
+
+def _user_forms(words):
+    """Return the folded forms of a user's password entry words cracklib compares passwords to"""
+    words = [word for word in words if word]
+    combined = set(words)
+    for first in words:
+        for second in words:
+            if first is not second:
+                combined.update((first + second, first[:1] + second, first + second[:1]))
+
+    forms = set()
+    for word in combined:
+        forms.update(password_forms(word))
+        for count in range(1, 4):
+            forms.update((word[count:], word[:-count]))
+    forms.discard(b'')
+    return set(form.translate(_FOLD) for form in forms)
+
+
+def _user_words(username):
+    try:
+        entry = pwd.getpwnam(username) if username is not None else pwd.getpwuid(os.getuid())
+    except KeyError:
+        return [username.lower().encode('utf-8')] if username is not None else []
+    text = ('%s %s' % (entry.pw_name, entry.pw_gecos)).encode('utf-8', 'replace').lower()
+    return _WORD_SPLIT.split(text)
+
+
+def may_trip_cracklib(password):
+    """
+    Return whether password may fail one of cracklib's checks which do not use the dictionary
+
+    :arg password: the password as UTF-8 bytes
+    """
+    if len(password) < _MIN_LENGTH or len(set(password)) < _MIN_DIFFERENT:
+        return True
+    if len(password) - len(password.translate(None, _DIGITS)) > _MAX_DIGITS:
+        return True
+    for text in (password, password.lower()):
+        steps = 0
+        for prev, byte in zip(bytearray(text), bytearray(text[1:])):
+            if byte == prev + 1 or byte == prev - 1:
+                steps += 1
+        if steps > _MAX_STEPS:
+            return True
+    return False
+
+
+class DictionaryIndex:
+    """
+    Memory mapped sorted array of the folded hashes of a wordlist
+
+    The keys are preceded by a table of where each range of the top bits of the hashes starts so
+    that a lookup only has to search a few keys.  Open an existing index with the constructor or
+    use :meth:`load` to build it when needed.
+    """
+    def __init__(self, path):
+        """:arg path: index file written by :meth:`build`"""
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, bits, count, self.source_size,
+         self.source_mtime_ns) = _HEADER.unpack_from(self._mmap)
+        buckets = (1 << bits) + 1
+        if magic != _MAGIC or len(self._mmap) != _HEADER.size + 8 * (buckets + count):
+            self._mmap.close()
+            raise ValueError('%s is not a dictionary index' % path)
+        table = memoryview(self._mmap)[_HEADER.size:].cast('Q')
+        self._starts = table[:buckets]
+        self._keys = table[buckets:]
+        self._shift = 64 - bits
+
+    @classmethod
+    def build(cls, wordlist, path):
+        """
+        Write the index of wordlist to path and return it
+
+        The file is replaced atomically so processes which have the old one mapped keep working.
+
+        :arg wordlist: file with one word per line, optionally gzip compressed.  It should be the
+            wordlist the cracklib dictionary at ``dictpath`` was packed from
+        :arg path: where to write the index
+        """
+        opener = gzip.open if wordlist.endswith('.gz') else open
+        keys = set()
+        with opener(wordlist, 'rb') as f:
+            for line in f:
+                # cracklib-format drops comments, lowercases the words, and deletes everything
+                # but letters and digits before they are packed.  Newer versions keep the
+                # punctuation instead so both forms are indexed
+                if line.startswith(b'#'):
+                    continue
+                word = line.strip().lower()
+                for form in (word, word.translate(None, _NOT_ALNUM)):
+                    if form:
+                        keys.add(_key(form[:_MAX_WORD_LENGTH]))
+        keys = array('Q', sorted(keys))
+        if keys.itemsize != 8:
+            raise RuntimeError('array does not have a 64-bit unsigned type')
+        # About eight keys per bucket
+        bits = min(20, max(0, len(keys).bit_length() - 3))
+        starts = array('Q', [0]) * ((1 << bits) + 1)
+        for key in keys:
+            starts[(key >> (64 - bits)) + 1] += 1
+        for bucket in range(1, len(starts)):
+            starts[bucket] += starts[bucket - 1]
+
+        stat = os.stat(wordlist)
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.pwqdict-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_HEADER.pack(_MAGIC, bits, len(keys), stat.st_size, stat.st_mtime_ns))
+                starts.tofile(f)
+                keys.tofile(f)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        return cls(path)
+
+    @classmethod
+    def load(cls, wordlist, path):
+        """
+        Return the index of wordlist at path, building it if it is missing or out of date
+
+        :arg wordlist: wordlist the index is built from.  See :meth:`build`
+        :arg path: index file
+        """
+        try:
+            index = cls(path)
+        except (OSError, IOError, ValueError):
+            return cls.build(wordlist, path)
+        stat = os.stat(wordlist)
+        if (index.source_size, index.source_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            index.close()
+            return cls.build(wordlist, path)
+        return index
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, form):
+        keys = self._keys
+        key = _key(form)
+        bucket = key >> self._shift
+        end = self._starts[bucket + 1]
+        idx = bisect.bisect_left(keys, key, self._starts[bucket], end)
+        return idx < end and keys[idx] == key
+
+    def close(self):
+        self._keys.release()
+        self._starts.release()
+        self._mmap.close()
+
+
+class DictPrefilter:
+    """
+    Check passwords without cracklib when a :class:`DictionaryIndex` shows they are not words
+
+    The values of the settings are copied when the prefilter is created.  Call :meth:`refresh`
+    after changing them.  Reloads done by ``read_config(reload_interval=...)`` are picked up
+    automatically.
+
+    :attr skipped: number of passwords checked without the dictionary lookup
+    :attr fallbacks: number of passwords which went through the normal check
+    """
+    def __init__(self, settings, index):
+        """
+        :arg settings: PWQSettings of the ctypes or cffi bindings
+        :arg index: :class:`DictionaryIndex` of the wordlist behind the settings' dictpath
+        """
+        self.module = import_binding(type(settings).__module__)
+        self.settings = settings
+        self.index = index
+        self.skipped = 0
+        self.fallbacks = 0
+        # Forms of the password entries cracklib compares passwords with, by username
+        self._user_forms = {}
+        self.refresh()
+
+    def refresh(self):
+        """Copy the settings to the settings object used for the checks without cracklib"""
+        values = self.settings.snapshot()
+        if values.get('dictcheck'):
+            values['dictcheck'] = 0
+            self._nodict = self.module.PWQSettings()
+            self._nodict.configure(**values)
+        else:
+            self._nodict = None
+
+    def _poll(self):
+        watch = self.settings._config_watch
+        if watch is not None:
+            reloads = watch.reloads
+            watch.poll(self.settings)
+            if watch.reloads != reloads:
+                self.refresh()
+
+    def _forms_of_user(self, username):
+        try:
+            return self._user_forms[username]
+        except KeyError:
+            pass
+        if len(self._user_forms) >= 64:
+            self._user_forms.clear()
+        forms = self._user_forms[username] = _user_forms(_user_words(username))
+        return forms
+
+    def is_word(self, password, username=None):
+        """
+        Return whether cracklib may reject password.  False means it definitely will not
+
+        :arg password: the password as UTF-8 bytes
+        :kwarg username: user name passed to the check
+        """
+        if not password or b'\0' in password or may_trip_cracklib(password):
+            return True
+        forms = password_forms(password)
+        user_forms = self._forms_of_user(None)
+        if username:
+            user_forms = user_forms | self._forms_of_user(_to_bytes(username).decode('utf-8'))
+        if not user_forms.isdisjoint(form.translate(_FOLD) for form in forms):
+            return True
+        return any(form in self.index for form in forms)
+
+    def _settings_for(self, password, username):
+        if self._nodict is None or self.is_word(_to_bytes(password), username):
+            self.fallbacks += 1
+            return self.settings
+        self.skipped += 1
+        return self._nodict
+
+    def check(self, password, oldpassword=None, username=None):
+        """
+        Check the password the way ``PWQSettings.check()`` does and return the score
+
+        The arguments are the same as for ``PWQSettings.check()``.
+        """
+        self._poll()
+        return self._settings_for(password, username).check(password, oldpassword, username)
+
+    def check_many(self, passwords, oldpasswords=None, usernames=None):
+        """
+        Check a batch of passwords and return the bindings' ``CheckResults``
+
+        The arguments are the same as for ``PWQSettings.check_many()``.
+        """
+        self._poll()
+        passwords = list(passwords)
+        count = len(passwords)
+        if ((oldpasswords is not None and len(oldpasswords) != count)
+                or (usernames is not None and len(usernames) != count)):
+            raise ValueError('oldpasswords and usernames must be the same length as passwords')
+        checked_idx = []
+        nodict_idx = []
+        for idx, password in enumerate(passwords):
+            username = usernames[idx] if usernames is not None else None
+            if self._settings_for(password, username) is self.settings:
+                checked_idx.append(idx)
+            else:
+                nodict_idx.append(idx)
+        if not nodict_idx:
+            return self.settings.check_many(passwords, oldpasswords, usernames)
+        if not checked_idx:
+            return self._nodict.check_many(passwords, oldpasswords, usernames)
+
+        results = _MergedResults(count)
+        for settings, indexes in ((self.settings, checked_idx), (self._nodict, nodict_idx)):
+            results.add(indexes, settings.check_many(
+                [passwords[idx] for idx in indexes],
+                None if oldpasswords is None else [oldpasswords[idx] for idx in indexes],
+                None if usernames is None else [usernames[idx] for idx in indexes]))
+        return results
+
+
+class _MergedResults:
+    """Check results made of the results of several ``check_many()`` calls"""
+    def __init__(self, count):
+        self.scores = array('i', [0]) * count
+        self._sources = [None] * count
+
+    def add(self, indexes, results):
+        for pos, idx in enumerate(indexes):
+            self.scores[idx] = results.scores[pos]
+            self._sources[idx] = (results, pos)
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __iter__(self):
+        return iter(self.scores)
+
+    def __getitem__(self, idx):
+        return self.scores[idx]
+
+    def error(self, idx):
+        """
+        Return the exception for a failed check or None if the password passed
+
+        :arg idx: index of the password in the batch
+        """
+        if idx < 0:
+            idx += len(self.scores)
+        results, pos = self._sources[idx]
+        return results.error(pos)
+
+    def errors(self):
+        """Iterate over (index, exception) pairs for the passwords which failed the check"""
+        for idx, rc in enumerate(self.scores):
+            if rc < 0:
+                yield idx, self.error(idx)
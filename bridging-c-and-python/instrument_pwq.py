@@ -0,0 +1,331 @@
+# coding: utf-8
+# Opt-in instrumentation for the libpwquality bindings
+# Copyright: 2019, Toshio Kuratomi <toshio@fedoraproject.org>
+# License: BSD or GPLv2+ at your option
+
+"""
+Measure where the time in the bindings' calls goes and which errors they return.
+
+Nothing here touches the bindings until :meth:`Instrumentation.install` is called.  It swaps the
+binding's ``PWQSettings`` methods in :data:`METHODS` and ``PWQError.from_pwq_rc`` for timed
+versions and :meth:`Instrumentation.remove` puts the originals back, so the uninstrumented code
+path carries no extra cost::
+
+    with Instrumentation('ctypes_pwq') as instr:
+        serve_requests()
+        instr.write_prometheus('/var/lib/node_exporter/pwquality.prom')
+
+Each call is split into three phases:
+
+* encode: turning text arguments into UTF-8 bytes
+* native: the rest of the binding's method, mostly the call into libpwquality
+* format: building the exception for a failed call.  The message of some errors is only formatted
+  when it is first read, which is not counted
+
+check_many() is timed as one call, while its error code counters count every password in the
+batch.  Calls an instrumented method makes to another one, like generate_many() calling
+generate() in the ABI mode bindings, are counted as part of the outer call only.
+
+The extension module's PWQSettings is an immutable type and it has no ``PWQError.from_pwq_rc``, so
+only the ctypes and cffi bindings can be instrumented.  :class:`Instrumentation` raises ValueError
+for the extension module rather than leave it out without saying so.
+"""
+# Make code behave more similarly on Python2 and Python3
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import bisect
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from parallel_pwq import import_binding
+
+
+#: Upper bounds of the latency histogram buckets in nanoseconds: 1us to about 1s
+BUCKETS_NS = tuple(1000 * 2 ** i for i in range(21))
+
+PHASES = ('encode', 'native', 'format', 'total')
+
+#: The PWQSettings methods which are timed
+METHODS = ('check', 'check_many', 'generate', 'generate_many', 'generate_into')
+
+#: Passed to the hook after every instrumented call.  The times are in nanoseconds and code is the
+#: PWQ_ERROR_* code of a failed call, 0 when it succeeded, or None if it raised something else.
+#: A check_many() call which returned has a code of 0 whatever the results of its passwords were.
+CallEvent = namedtuple('CallEvent', ('binding', 'method', 'start_ns', 'encode_ns', 'native_ns',
+                                     'format_ns', 'code'))
+
+_perf_ns = time.perf_counter_ns
+
+
+def _encode(value):
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return value
+
+
+def _encode_all(values):
+    if values is None:
+        return None
+    return [_encode(value) for value in values]
+
+
+def _score_codes(results):
+    # Count the results of a check_many() call by code, 0 being success
+    codes = {}
+    for score in results.scores:
+        code = score if score < 0 else 0
+        codes[code] = codes.get(code, 0) + 1
+    return codes
+
+
+class Histogram:
+    """Latency histogram with the fixed :data:`BUCKETS_NS` buckets"""
+    def __init__(self):
+        # The last count is for values larger than the last bucket
+        self.counts = [0] * (len(BUCKETS_NS) + 1)
+        self.sum_ns = 0
+        self.count = 0
+
+    def add(self, value_ns):
+        self.counts[bisect.bisect_left(BUCKETS_NS, value_ns)] += 1
+        self.sum_ns += value_ns
+        self.count += 1
+
+    def to_dict(self):
+        return {'buckets_ns': list(BUCKETS_NS), 'counts': list(self.counts),
+                'sum_ns': self.sum_ns, 'count': self.count}
+
+
+class Instrumentation:
+    """
+    Latency histograms and error code counters for one bindings module
+
+    :attr hook: callable which is given a :class:`CallEvent` after every instrumented call, for
+        instance to forward it to a tracer.  It can be set or cleared at any time
+    """
+    def __init__(self, binding='ctypes_pwq', hook=None):
+        """
+        :kwarg binding: bindings module or name of the bindings module to instrument
+        :kwarg hook: initial value of :attr:`hook`
+        """
+        self.module = import_binding(binding)
+        if not hasattr(self.module, 'to_c_string'):
+            raise ValueError('%s cannot be instrumented' % self.module.__name__)
+        self.hook = hook
+        self._histograms = dict(((method, phase), Histogram())
+                                for method in METHODS for phase in PHASES)
+        self._codes = dict((method, {}) for method in METHODS)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._originals = None
+
+    #
+    # Installing the timed methods
+    #
+
+    @property
+    def installed(self):
+        return self._originals is not None
+
+    def install(self):
+        """Replace the binding's methods with timed ones"""
+        if self._originals is not None:
+            return
+        settings_cls = self.module.PWQSettings
+        error_cls = self.module.PWQError
+        if getattr(settings_cls.check, '_pwq_instrumented', False):
+            raise RuntimeError('%s is already instrumented' % self.module.__name__)
+
+        methods = dict((method, getattr(settings_cls, method)) for method in METHODS)
+        from_pwq_rc = error_cls.__dict__['from_pwq_rc']
+        self._originals = (methods, from_pwq_rc)
+        timers = {'check': self._timed_check, 'check_many': self._timed_check_many}
+        for method, func in methods.items():
+            timed = timers.get(method, self._timed_method)(method, func)
+            timed.__doc__ = func.__doc__
+            timed._pwq_instrumented = True
+            setattr(settings_cls, method, timed)
+        error_cls.from_pwq_rc = staticmethod(self._timed_from_pwq_rc(from_pwq_rc.__func__))
+
+    def remove(self):
+        """Put the binding's original methods back"""
+        if self._originals is None:
+            return
+        methods, from_pwq_rc = self._originals
+        for method, func in methods.items():
+            setattr(self.module.PWQSettings, method, func)
+        self.module.PWQError.from_pwq_rc = from_pwq_rc
+        self._originals = None
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.remove()
+
+    def _timed_from_pwq_rc(self, from_pwq_rc):
+        local = self._local
+
+        def timed_from_pwq_rc(rc, auxerror=None):
+            if not getattr(local, 'active', False):
+                # For instance CheckResults.error() building the exception later
+                return from_pwq_rc(rc, auxerror)
+            start = _perf_ns()
+            try:
+                return from_pwq_rc(rc, auxerror)
+            finally:
+                local.format_ns += _perf_ns() - start
+                local.code = rc
+        return timed_from_pwq_rc
+
+    def _call(self, method, func, args, start, encode_ns, result_codes=None):
+        local = self._local
+        if getattr(local, 'active', False):
+            # Called by another instrumented method, which the time is counted in
+            return func(*args)
+        local.active = True
+        local.format_ns = 0
+        local.code = None
+        codes = None
+        native_start = _perf_ns()
+        try:
+            result = func(*args)
+            local.code = 0
+            if result_codes is not None:
+                codes = result_codes(result)
+            return result
+        finally:
+            end = _perf_ns()
+            local.active = False
+            self._record(method, start, encode_ns, end - native_start - local.format_ns,
+                         local.format_ns, end - start, local.code, codes)
+
+    def _timed_check(self, method, check):
+        def timed_check(settings, password, oldpassword=None, username=None):
+            start = _perf_ns()
+            args = (settings, _encode(password), _encode(oldpassword), _encode(username))
+            return self._call(method, check, args, start, _perf_ns() - start)
+        return timed_check
+
+    def _timed_check_many(self, method, check_many):
+        def timed_check_many(settings, passwords, oldpasswords=None, usernames=None):
+            start = _perf_ns()
+            args = (settings, _encode_all(passwords), _encode_all(oldpasswords),
+                    _encode_all(usernames))
+            return self._call(method, check_many, args, start, _perf_ns() - start,
+                              _score_codes)
+        return timed_check_many
+
+    def _timed_method(self, method, func):
+        def timed_method(settings, *args):
+            return self._call(method, func, (settings,) + args, _perf_ns(), 0)
+        return timed_method
+
+    def _record(self, method, start, encode_ns, native_ns, format_ns, total_ns, code,
+                result_codes=None):
+        histograms = self._histograms
+        with self._lock:
+            histograms[(method, 'encode')].add(encode_ns)
+            histograms[(method, 'native')].add(native_ns)
+            histograms[(method, 'format')].add(format_ns)
+            histograms[(method, 'total')].add(total_ns)
+            codes = self._codes[method]
+            if result_codes is not None:
+                for result_code, count in result_codes.items():
+                    codes[result_code] = codes.get(result_code, 0) + count
+            elif code is not None:
+                codes[code] = codes.get(code, 0) + 1
+
+        hook = self.hook
+        if hook is not None:
+            hook(CallEvent(self.module.__name__, method, start, encode_ns, native_ns, format_ns,
+                           code))
+
+    #
+    # Reading the measurements
+    #
+
+    def snapshot(self):
+        """
+        Return a copy of the measurements
+
+        The result is ``{method: {'phases': {phase: histogram}, 'codes': {code: count}}}`` where
+        each histogram is a dict with ``buckets_ns``, ``counts``, ``sum_ns``, and ``count``.
+        """
+        snapshot = {}
+        with self._lock:
+            for method, codes in self._codes.items():
+                phases = dict((phase, self._histograms[(method, phase)].to_dict())
+                              for phase in PHASES)
+                snapshot[method] = {'phases': phases, 'codes': dict(codes)}
+        return snapshot
+
+    def reset(self):
+        """Zero all of the measurements"""
+        with self._lock:
+            for histogram in self._histograms.values():
+                histogram.__init__()
+            for codes in self._codes.values():
+                codes.clear()
+
+    def _code_names(self):
+        names = {}
+        for name in dir(self.module):
+            if name.startswith('PWQ_ERROR_'):
+                names[getattr(self.module, name)] = name
+        return names
+
+    def prometheus_text(self):
+        """Return the measurements in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        binding = self.module.__name__
+        code_names = self._code_names()
+        lines = ['# HELP pwquality_call_duration_seconds Time spent in each phase of a call',
+                 '# TYPE pwquality_call_duration_seconds histogram']
+        for method, data in sorted(snapshot.items()):
+            for phase in PHASES:
+                histogram = data['phases'][phase]
+                labels = 'binding="%s",method="%s",phase="%s"' % (binding, method, phase)
+                cumulative = 0
+                for bound, count in zip(histogram['buckets_ns'], histogram['counts']):
+                    cumulative += count
+                    lines.append('pwquality_call_duration_seconds_bucket{%s,le="%g"} %d'
+                                 % (labels, bound / 1e9, cumulative))
+                lines.append('pwquality_call_duration_seconds_bucket{%s,le="+Inf"} %d'
+                             % (labels, histogram['count']))
+                lines.append('pwquality_call_duration_seconds_sum{%s} %.9f'
+                             % (labels, histogram['sum_ns'] / 1e9))
+                lines.append('pwquality_call_duration_seconds_count{%s} %d'
+                             % (labels, histogram['count']))
+
+        lines.extend(['# HELP pwquality_calls_total Calls by result code, 0 being success',
+                      '# TYPE pwquality_calls_total counter'])
+        for method, data in sorted(snapshot.items()):
+            for code, count in sorted(data['codes'].items()):
+                lines.append('pwquality_calls_total{binding="%s",method="%s",code="%d",name="%s"}'
+                             ' %d' % (binding, method, code, code_names.get(code, ''), count))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Write :meth:`prometheus_text` to path, for instance for node_exporter's textfile collector
+
+        The file is replaced atomically so a scrape never sees it half written.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.pwquality-', suffix='.prom')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.prometheus_text())
+            # mkstemp() makes the file readable by its owner only but the collector usually runs
+            # as another user
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
@@ -0,0 +1,118 @@
+# coding: utf-8
+# Thread pool helpers for the libpwquality bindings
+# Copyright: 2019, Toshio Kuratomi <toshio@fedoraproject.org>
+# License: BSD or GPLv2+ at your option
+
+"""
+Run password checks from several threads at once using any of the libpwquality bindings.
+
+libpwquality does not document its settings objects as thread-safe so each worker thread gets its
+own PWQSettings.  ctypes and cffi release the GIL while the C function runs (as does the extension
+module) so dictionary-heavy checks can use more than one core.
+"""
+# Make code behave more similarly on Python2 and Python3
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import importlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+#: Names of the binding modules which can be selected by name
+BINDINGS = ('ctypes_pwq', 'cffi_abi_pwq', 'cffi_abi_gen_pwq', 'cffi_api_gen_pwq', 'pwquality')
+
+
+def import_binding(binding):
+    """
+    Return the bindings module to use
+
+    :arg binding: Either a module which provides PWQSettings or the name of one of the
+        :data:`BINDINGS`
+    """
+    if not isinstance(binding, str):
+        return binding
+    if binding not in BINDINGS:
+        raise ValueError('Unknown libpwquality binding: %s' % binding)
+    return importlib.import_module(binding)
+
+
+class ParallelChecker:
+    """
+    Thread pool where every worker thread owns its own PWQSettings
+
+    Work is given to the pool as a method name of PWQSettings (``'check'``, ``'generate'``) or as
+    a callable which takes the worker's PWQSettings as its first argument::
+
+        with ParallelChecker('ctypes_pwq') as checker:
+            scores = list(checker.map('check', passwords))
+    """
+    def __init__(self, binding='ctypes_pwq', max_workers=None, settings_factory=None):
+        """
+        :kwarg binding: bindings module or name of the bindings module to use
+        :kwarg max_workers: number of worker threads.  Defaults to the number of cpus
+        :kwarg settings_factory: callable returning a configured PWQSettings.  Defaults to the
+            binding's PWQSettings class
+        """
+        self.module = import_binding(binding)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._settings_factory = settings_factory or self.module.PWQSettings
+        self._local = threading.local()
+        self._settings_lock = threading.Lock()
+        self.settings = []
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                            initializer=self._init_worker)
+
+    def _init_worker(self):
+        settings = self._settings_factory()
+        self._local.settings = settings
+        with self._settings_lock:
+            self.settings.append(settings)
+
+    def _call(self, method, args, kwargs):
+        settings = self._local.settings
+        if isinstance(method, str):
+            return getattr(settings, method)(*args, **kwargs)
+        return method(settings, *args, **kwargs)
+
+    def submit(self, method, *args, **kwargs):
+        """
+        Schedule a call in one of the worker threads and return a Future for it
+
+        :arg method: name of a PWQSettings method or a callable taking a PWQSettings as its first
+            argument
+        :arg args: positional arguments to pass to method
+        :kwarg kwargs: keyword arguments to pass to method
+        """
+        return self._executor.submit(self._call, method, args, kwargs)
+
+    def map(self, method, *iterables, **kwargs):
+        """
+        Like :meth:`concurrent.futures.Executor.map` using the worker's PWQSettings
+
+        Results are returned in the order of the input.  A failed check raises its PWQError when
+        its result is reached.
+
+        :arg method: name of a PWQSettings method or a callable taking a PWQSettings as its first
+            argument
+        :arg iterables: iterables supplying the arguments to method
+        :kwarg timeout: seconds to wait for each result
+        """
+        timeout = kwargs.pop('timeout', None)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kwargs))
+        return self._executor.map(lambda *args: self._call(method, args, {}), *iterables,
+                                  timeout=timeout)
+
+    def shutdown(self, wait=True):
+        """Stop the worker threads and release their PWQSettings"""
+        self._executor.shutdown(wait=wait)
+        with self._settings_lock:
+            del self.settings[:]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
@@ -0,0 +1,182 @@
+# coding: utf-8
+# Pool of reusable PWQSettings for the libpwquality bindings
+# Copyright: 2019, Toshio Kuratomi <toshio@fedoraproject.org>
+# License: BSD or GPLv2+ at your option
+
+"""
+Reuse configured PWQSettings instead of building a new one for every request.
+
+Setting up a PWQSettings means allocating the default settings, reading the configuration file
+and, on the first check, opening the cracklib dictionary.  :class:`SettingsPool` keeps idle
+settings objects keyed by a fingerprint of the configuration file and option overrides they were
+built with so that later requests for the same configuration can check one out again.
+
+Prefork servers can call :meth:`SettingsPool.prefork_warmup` before forking so that all of that
+set up is done once in the parent and the workers share the memory copy-on-write.
+"""
+# Make code behave more similarly on Python2 and Python3
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import gc
+import hashlib
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from parallel_pwq import import_binding
+
+
+# Passes the cheap rules so checking it goes all the way through the dictionary lookup
+_WARMUP_PASSWORD = 'Thosdjkesd%p~i l230-9'
+
+
+def normalize_options(options):
+    """
+    Return options as a sorted tuple of ``name=value`` strings
+
+    :arg options: a mapping of setting names to values or an iterable of ``name=value`` strings
+        as taken by ``PWQSettings.set_option()``
+    """
+    if hasattr(options, 'items'):
+        options = ('%s=%s' % (name, value) for name, value in options.items())
+    return tuple(sorted(options))
+
+
+class SettingsPool:
+    """
+    Pool of idle PWQSettings keyed by configuration
+
+    ::
+
+        pool = SettingsPool('cffi_api_gen_pwq', max_size=32)
+        with pool.settings('/etc/security/pwquality.conf', {'minlen': 12}) as pwq:
+            pwq.check(password)
+    """
+    def __init__(self, binding='ctypes_pwq', max_size=16, max_idle=300):
+        """
+        :kwarg binding: bindings module or name of the bindings module to use
+        :kwarg max_size: most idle settings objects to keep.  When the pool is full, the least
+            recently used one is dropped
+        :kwarg max_idle: seconds an idle settings object is kept before it is dropped.  None keeps
+            them until the pool is full
+        """
+        self.module = import_binding(binding)
+        self.max_size = max_size
+        self.max_idle = max_idle
+        # (fingerprint, settings, time returned) with the most recently returned on the right
+        self._idle = deque()
+        self._checked_out = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(cfgfilename=None, options=()):
+        """
+        Return the key settings objects built from this configuration are pooled under
+
+        :kwarg cfgfilename: path to the configuration file or None to only use the defaults
+        :kwarg options: option overrides.  See :func:`normalize_options`
+        """
+        data = repr((cfgfilename, normalize_options(options)))
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def _build(self, cfgfilename, options):
+        settings = self.module.PWQSettings()
+        if cfgfilename is not None:
+            settings.read_config(cfgfilename)
+        for option in options:
+            settings.set_option(option)
+        return settings
+
+    def _evict(self, now):
+        # Caller must hold self._lock
+        if self.max_idle is not None:
+            self._idle = deque(entry for entry in self._idle if now - entry[2] <= self.max_idle)
+        while len(self._idle) > self.max_size:
+            self._idle.popleft()
+
+    def checkout(self, cfgfilename=None, options=()):
+        """
+        Return a PWQSettings built for this configuration.  Give it back with :meth:`checkin`
+
+        :kwarg cfgfilename: path to the configuration file or None to only use the defaults
+        :kwarg options: option overrides.  See :func:`normalize_options`
+        """
+        options = normalize_options(options)
+        key = self.fingerprint(cfgfilename, options)
+        settings = None
+        with self._lock:
+            self._evict(time.monotonic())
+            # Prefer the most recently used one as it is the most likely to still be in cache
+            for idx in range(len(self._idle) - 1, -1, -1):
+                if self._idle[idx][0] == key:
+                    settings = self._idle[idx][1]
+                    del self._idle[idx]
+                    break
+
+        if settings is None:
+            settings = self._build(cfgfilename, options)
+
+        with self._lock:
+            self._checked_out[id(settings)] = key
+        return settings
+
+    def checkin(self, settings):
+        """
+        Return a PWQSettings obtained from :meth:`checkout` to the pool
+
+        :arg settings: the settings object.  It must not have been reconfigured while checked out
+        """
+        with self._lock:
+            key = self._checked_out.pop(id(settings))
+            now = time.monotonic()
+            self._idle.append((key, settings, now))
+            self._evict(now)
+
+    @contextmanager
+    def settings(self, cfgfilename=None, options=()):
+        """Context manager which checks a PWQSettings out and back in"""
+        settings = self.checkout(cfgfilename, options)
+        try:
+            yield settings
+        finally:
+            self.checkin(settings)
+
+    def evict_idle(self):
+        """Drop the settings objects which have been idle longer than max_idle"""
+        with self._lock:
+            self._evict(time.monotonic())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._idle)
+
+    def prefork_warmup(self, configs=((None, ()),), count=1):
+        """
+        Build and warm up settings objects in a prefork server's parent process
+
+        Each settings object reads its configuration and checks a password which reaches the
+        cracklib dictionary lookup.  They are then put in the pool.  Afterwards the objects the
+        garbage collector knows about are frozen (Python 3.7+) so that collections in the workers
+        do not write to, and so unshare, the pages holding them.
+
+        :kwarg configs: iterable of (cfgfilename, options) pairs to warm up
+        :kwarg count: how many settings objects to build for each configuration
+        """
+        warmed = []
+        for cfgfilename, options in configs:
+            for _ in range(count):
+                settings = self.checkout(cfgfilename, options)
+                warmed.append(settings)
+                try:
+                    settings.check(_WARMUP_PASSWORD)
+                except self.module.PWQError:
+                    pass
+
+        for settings in warmed:
+            self.checkin(settings)
+
+        if hasattr(gc, 'freeze'):
+            gc.collect()
+            gc.freeze()
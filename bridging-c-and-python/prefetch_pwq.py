@@ -0,0 +1,242 @@
+# coding: utf-8
+# Background password generation with the libpwquality bindings
+# Copyright: 2019, Toshio Kuratomi <toshio@fedoraproject.org>
+# License: BSD or GPLv2+ at your option
+
+"""
+Keep generated passwords ready ahead of time so handing one out does not wait on libpwquality.
+
+pwquality_generate() reads from the kernel random number generator and retries candidates which
+fail the checks so how long it takes varies from call to call.  :class:`PrefetchingGenerator` fills
+a bounded queue per entropy level from a background thread and :meth:`PrefetchingGenerator.get`
+takes from that queue.
+
+The queued passwords are held in bytearrays (written by ``generate_into()`` when the binding has
+it) so that they can be wiped when they expire unused or the generator is closed.
+
+When generating fails in the background thread (for instance when libpwquality cannot read its
+random source) the error is counted, kept in :attr:`PrefetchingGenerator.last_error`, and the
+thread waits before it tries again.
+"""
+# Make code behave more similarly on Python2 and Python3
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import codecs
+import threading
+import time
+from collections import deque
+
+from parallel_pwq import import_binding
+
+
+# Room for the longest password libpwquality generates at PWQ_MAX_ENTROPY_BITS
+_BUFFER_SIZE = 512
+
+
+def _wipe(buf):
+    buf[:] = b'\0' * len(buf)
+
+
+class PrefetchingGenerator:
+    """
+    Hand out pre-generated passwords
+
+    Each entropy level has its own queue.  When a queue drops below low_watermark the background
+    thread refills it up to high_watermark.  If a queue is empty, :meth:`get` generates a password
+    in the calling thread instead (a miss)::
+
+        with PrefetchingGenerator('cffi_api_gen_pwq', entropy_levels=(64, 128)) as gen:
+            password = gen.get(64)
+
+    :attr last_error: exception from the background thread's last attempt to generate a
+        password, or None if it succeeded
+    """
+    def __init__(self, binding='ctypes_pwq', entropy_levels=(64,), low_watermark=8,
+                 high_watermark=32, max_age=None, settings_factory=None, retry_interval=1.0):
+        """
+        :kwarg binding: bindings module or name of the bindings module to use
+        :kwarg entropy_levels: entropy levels to keep passwords ready for
+        :kwarg low_watermark: refill a queue once it holds fewer than this many passwords
+        :kwarg high_watermark: stop refilling a queue once it holds this many passwords
+        :kwarg max_age: seconds after which an unused password is wiped and thrown away.  None
+            keeps them until they are used
+        :kwarg settings_factory: callable returning a configured PWQSettings.  Defaults to the
+            binding's PWQSettings class
+        :kwarg retry_interval: seconds the background thread waits after failing to generate a
+            password before it tries again
+        """
+        if not 0 <= low_watermark <= high_watermark or high_watermark < 1:
+            raise ValueError('Need 0 <= low_watermark <= high_watermark and high_watermark >= 1')
+
+        self.module = import_binding(binding)
+        settings_factory = settings_factory or self.module.PWQSettings
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.max_age = max_age
+        self.retry_interval = retry_interval
+
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.expired = 0
+        self.errors = 0
+        self.last_error = None
+
+        # PWQSettings are not documented as thread-safe so the background thread and callers
+        # which miss each get their own
+        self._settings = settings_factory()
+        self._foreground = settings_factory()
+        self._foreground_lock = threading.Lock()
+
+        self._queues = dict((entropy, deque()) for entropy in entropy_levels)
+        self._filling = set(self._queues)
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='PrefetchingGenerator')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _make(self, entropy):
+        if hasattr(self._settings, 'generate_into'):
+            buf = bytearray(_BUFFER_SIZE)
+            length = self._settings.generate_into(buf, entropy)
+        else:
+            buf = bytearray(self._settings.generate(entropy).encode('utf-8'))
+            length = len(buf)
+        return time.monotonic(), buf, length
+
+    def _is_expired(self, created, now):
+        return self.max_age is not None and now - created > self.max_age
+
+    def _expire(self):
+        # Caller must hold self._cond
+        if self.max_age is None:
+            return
+        now = time.monotonic()
+        for queue in self._queues.values():
+            # Passwords are queued oldest first
+            while queue and self._is_expired(queue[0][0], now):
+                _wipe(queue.popleft()[1])
+                self.expired += 1
+
+    def _next_level(self):
+        # Caller must hold self._cond.  Return an entropy level which needs more passwords
+        for entropy, queue in self._queues.items():
+            if len(queue) < self.low_watermark:
+                self._filling.add(entropy)
+            if entropy in self._filling:
+                if len(queue) < self.high_watermark:
+                    return entropy
+                self._filling.discard(entropy)
+        return None
+
+    def _run(self):
+        wait = None if self.max_age is None else self.max_age / 2
+        while True:
+            with self._cond:
+                self._expire()
+                entropy = self._next_level()
+                while not self._closed and entropy is None:
+                    self._cond.wait(wait)
+                    self._expire()
+                    entropy = self._next_level()
+                if self._closed:
+                    return
+
+            try:
+                item = self._make(entropy)
+            except Exception as e:
+                # Keep the thread alive so that it can refill the queues once generating works
+                # again
+                with self._cond:
+                    self.errors += 1
+                    self.last_error = e
+                    # get() notifies on every miss so wait out the whole interval
+                    deadline = time.monotonic() + self.retry_interval
+                    remaining = self.retry_interval
+                    while not self._closed and remaining > 0:
+                        self._cond.wait(remaining)
+                        remaining = deadline - time.monotonic()
+                continue
+
+            with self._cond:
+                self.last_error = None
+                if self._closed:
+                    _wipe(item[1])
+                    return
+                self._queues[entropy].append(item)
+                self.generated += 1
+
+    def get(self, entropy):
+        """
+        Return a password with the requested entropy
+
+        :arg entropy: integer entropy bits of the password.  Levels which were not given to the
+            constructor are always generated on demand.  When the background thread is failing
+            the queue runs dry and the password is generated on demand as well, so the error is
+            raised here if it happens again
+        """
+        item = None
+        with self._cond:
+            queue = self._queues.get(entropy)
+            now = time.monotonic()
+            while queue:
+                item = queue.popleft()
+                if not self._is_expired(item[0], now):
+                    break
+                _wipe(item[1])
+                self.expired += 1
+                item = None
+
+            if item is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            if queue is not None and len(queue) < self.low_watermark:
+                self._cond.notify()
+
+        if item is None:
+            with self._foreground_lock:
+                return self._foreground.generate(entropy)
+
+        _created, buf, length = item
+        try:
+            return codecs.decode(memoryview(buf)[:length], 'utf-8')
+        finally:
+            _wipe(buf)
+
+    def stats(self):
+        """
+        Return the hit, miss, generated, expired, and error counters, the queue sizes, and the
+        background thread's :attr:`last_error`
+        """
+        with self._cond:
+            return {'hits': self.hits, 'misses': self.misses, 'generated': self.generated,
+                    'expired': self.expired, 'errors': self.errors,
+                    'last_error': self.last_error,
+                    'queued': dict((e, len(q)) for e, q in self._queues.items())}
+
+    def close(self, raise_error=True):
+        """
+        Stop the background thread and wipe the passwords which were not handed out
+
+        :kwarg raise_error: raise :attr:`last_error` when the background thread's last attempt to
+            generate a password failed
+        """
+        with self._cond:
+            self._closed = True
+            for queue in self._queues.values():
+                while queue:
+                    _wipe(queue.popleft()[1])
+            self._cond.notify_all()
+        self._thread.join()
+        if raise_error and self.last_error is not None:
+            raise self.last_error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Do not hide an exception from the with block behind the background thread's
+        self.close(raise_error=exc_type is None)
@@ -0,0 +1,446 @@
+# coding: utf-8
+# Prefilter for the cheap libpwquality rules
+# Copyright: 2019, Toshio Kuratomi <toshio@fedoraproject.org>
+# License: BSD or GPLv2+ at your option
+
+"""
+Reject passwords which fail the cheap rules without calling into libpwquality.
+
+Many rejected passwords are too short, lack a character class, or repeat characters.  Finding that
+out in libpwquality costs a call through the bindings and, for the passwords which pass, the
+cracklib dictionary lookup.  :class:`Prefilter` evaluates these rules in Python from the settings
+object's current values:
+
+* MIN_LENGTH and the MIN_DIGITS, MIN_UPPERS, MIN_LOWERS, and MIN_OTHERS credits
+* MIN_CLASSES
+* MAX_CONSECUTIVE, MAX_CLASS_REPEAT, and MAX_SEQUENCE
+
+A password which fails one of them raises the same PWQError (code and message) that
+``PWQSettings.check()`` would.  Everything else is passed on to libpwquality::
+
+    prefilter = Prefilter(ctypes_pwq.PWQSettings())
+    score = prefilter.check(password)
+
+The rules are applied in the order libpwquality's ``password_check()`` applies them.  Checks which
+come earlier in that function (empty passwords, palindromes, and everything that needs the old
+password) are left to libpwquality, so a password is only rejected here when libpwquality would
+have rejected it with the same error.  Like libpwquality, the rules look at the UTF-8 bytes of the
+password and count every non-ASCII byte as an "other" character.
+
+:meth:`Prefilter.check_many` evaluates a batch with NumPy when it is installed.  Passwords longer
+than 256 bytes are evaluated one at a time so that one of them does not widen the whole batch.
+"""
+# Make code behave more similarly on Python2 and Python3
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from parallel_pwq import import_binding
+
+
+# Settings the rules depend on
+RULE_SETTINGS = ('minlen', 'dcredit', 'ucredit', 'lcredit', 'ocredit', 'minclass', 'maxrepeat',
+                 'maxclassrepeat', 'maxsequence')
+
+# Batches smaller than this are faster to evaluate one password at a time
+_MIN_VECTOR_BATCH = 32
+
+# Longer passwords are evaluated one at a time.  Every row of the matrices is as wide as the
+# longest password so a single long one would make the whole batch that large
+_MAX_VECTOR_LENGTH = 256
+
+# Character classes of libpwquality's simple() in the order the credits are checked
+_DIGIT, _UPPER, _LOWER, _OTHER = range(4)
+
+
+def _byte_class(byte):
+    if 0x30 <= byte <= 0x39:
+        return _DIGIT
+    if 0x41 <= byte <= 0x5a:
+        return _UPPER
+    if 0x61 <= byte <= 0x7a:
+        return _LOWER
+    return _OTHER
+
+
+_CLASS_OF = tuple(_byte_class(byte) for byte in range(256))
+
+
+def _to_bytes(password):
+    if isinstance(password, bytes):
+        return password
+    if isinstance(password, str):
+        return password.encode('utf-8')
+    return memoryview(password).tobytes()
+
+
+def _exceeds(steps, limit):
+    """
+    Return which rows of the boolean matrix steps go over limit
+
+    Like the counters in :meth:`Prefilter.first_failure`, a True step extends the count of the
+    characters before it by one and the count is compared with ``count > limit`` at every True
+    step.
+    """
+    positions = np.arange(1, steps.shape[1] + 1)
+    # Number of True values in a row ending at each position
+    runs = positions - np.maximum.accumulate(np.where(steps, 0, positions), axis=1)
+    return (steps & (runs + 1 > limit)).any(axis=1)
+
+
+class PrefilterResults:
+    """
+    Results of a :meth:`Prefilter.check_many` call
+
+    This has the same interface as the bindings' ``CheckResults``.
+    """
+    def __init__(self, scores, auxerrors, error_cls, checked, checked_idx):
+        self.scores = scores
+        self._auxerrors = auxerrors
+        self._error_cls = error_cls
+        # Results of the passwords which were passed on to libpwquality, with their indexes
+        self._checked = checked
+        self._checked_idx = checked_idx
+        self._errors = {}
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __iter__(self):
+        return iter(self.scores)
+
+    def __getitem__(self, idx):
+        return self.scores[idx]
+
+    def error(self, idx):
+        """
+        Return the exception for a failed check or None if the password passed
+
+        :arg idx: index of the password in the batch
+        """
+        if idx < 0:
+            idx += len(self.scores)
+        rc = self.scores[idx]
+        if rc >= 0:
+            return None
+        if idx in self._checked_idx:
+            return self._checked.error(self._checked_idx[idx])
+        try:
+            return self._errors[idx]
+        except KeyError:
+            err = self._errors[idx] = self._error_cls.from_pwq_rc(rc, self._auxerrors[idx])
+        return err
+
+    def errors(self):
+        """Iterate over (index, exception) pairs for the passwords which failed the check"""
+        for idx, rc in enumerate(self.scores):
+            if rc < 0:
+                yield idx, self.error(idx)
+
+
+class Prefilter:
+    """
+    Check passwords against the cheap rules before passing them to a PWQSettings
+
+    The values of the settings are read when the prefilter is created.  Call :meth:`refresh` after
+    changing them.  Reloads done by ``read_config(reload_interval=...)`` are picked up
+    automatically.
+
+    :attr rejected: number of passwords rejected without calling libpwquality
+    :attr passed: number of passwords passed on to libpwquality
+    """
+    def __init__(self, settings, vectorize=None):
+        """
+        :arg settings: PWQSettings of the ctypes or cffi bindings to check the survivors with
+        :kwarg vectorize: whether :meth:`check_many` uses NumPy.  None uses it when it is installed
+            and the batch is large enough to gain from it
+        """
+        module = import_binding(type(settings).__module__)
+        if not hasattr(module.PWQError, 'from_pwq_rc'):
+            raise ValueError('%s cannot be prefiltered' % module.__name__)
+        if vectorize and np is None:
+            raise ValueError('vectorize needs NumPy')
+
+        self.settings = settings
+        self.vectorize = vectorize
+        self.rejected = 0
+        self.passed = 0
+        self._error_cls = module.PWQError
+        self._codes = (module.PWQ_ERROR_MAX_CLASS_REPEAT, module.PWQ_ERROR_MIN_DIGITS,
+                       module.PWQ_ERROR_MIN_UPPERS, module.PWQ_ERROR_MIN_LOWERS,
+                       module.PWQ_ERROR_MIN_OTHERS, module.PWQ_ERROR_MIN_LENGTH,
+                       module.PWQ_ERROR_MIN_CLASSES, module.PWQ_ERROR_MAX_CONSECUTIVE,
+                       module.PWQ_ERROR_MAX_SEQUENCE)
+        self.refresh()
+
+    def refresh(self):
+        """Read the rule settings from the settings object again"""
+        self.rules = dict((name, getattr(self.settings, name)) for name in RULE_SETTINGS)
+
+    def _poll(self):
+        watch = self.settings._config_watch
+        if watch is not None:
+            reloads = watch.reloads
+            watch.poll(self.settings)
+            if watch.reloads != reloads:
+                self.refresh()
+
+    #
+    # Evaluating the rules
+    #
+
+    def first_failure(self, password):
+        """
+        Return (rc, auxerror) for the first cheap rule password fails or None
+
+        None also means that the password must be left to libpwquality because an earlier check
+        applies to it.
+
+        :arg password: the password as UTF-8 bytes
+        """
+        rules = self.rules
+        (class_repeat_rc, digits_rc, uppers_rc, lowers_rc, others_rc, length_rc, classes_rc,
+         consecutive_rc, sequence_rc) = self._codes
+        lower = password.lower()
+        if not password or b'\0' in password or lower == lower[::-1]:
+            return None
+
+        # simple()
+        counts = [0, 0, 0, 0]
+        max_class_repeat = rules['maxclassrepeat']
+        prev_class = None
+        same_class = 0
+        for byte in bytearray(password):
+            char_class = _CLASS_OF[byte]
+            counts[char_class] += 1
+            if char_class == prev_class:
+                same_class += 1
+            else:
+                prev_class = char_class
+                same_class = 1
+            if max_class_repeat > 1 and same_class > max_class_repeat:
+                return class_repeat_rc, max_class_repeat
+
+        classes = len([count for count in counts if count])
+        size = rules['minlen']
+        for char_class, rc, credit in ((_DIGIT, digits_rc, rules['dcredit']),
+                                       (_UPPER, uppers_rc, rules['ucredit']),
+                                       (_LOWER, lowers_rc, rules['lcredit']),
+                                       (_OTHER, others_rc, rules['ocredit'])):
+            if credit >= 0:
+                size -= min(counts[char_class], credit)
+            elif counts[char_class] < -credit:
+                return rc, -credit
+        if size > len(password):
+            return length_rc, rules['minlen']
+
+        # minclass()
+        if classes < rules['minclass']:
+            return classes_rc, rules['minclass']
+
+        # consecutive()
+        max_repeat = rules['maxrepeat']
+        if max_repeat:
+            prev = None
+            same = 0
+            for byte in bytearray(password):
+                if byte == prev:
+                    same += 1
+                    if same > max_repeat:
+                        return consecutive_rc, max_repeat
+                else:
+                    prev = byte
+                    same = 1
+
+        # sequence() compares plain chars, which are signed on the platforms we build for
+        max_sequence = rules['maxsequence']
+        if max_sequence:
+            up = down = 1
+            prev = None
+            for byte in bytearray(password):
+                if byte >= 0x80:
+                    byte -= 0x100
+                if prev is not None and byte == prev + 1:
+                    up += 1
+                    down = 1
+                    if up > max_sequence:
+                        return sequence_rc, max_sequence
+                elif prev is not None and byte == prev - 1:
+                    down += 1
+                    up = 1
+                    if down > max_sequence:
+                        return sequence_rc, max_sequence
+                else:
+                    up = down = 1
+                prev = byte
+
+        return None
+
+    def first_failures(self, passwords):
+        """
+        Return arrays of the rc and auxerror of the first cheap rule each password fails
+
+        This is the vectorized version of :meth:`first_failure`.  An rc of 0 means that the
+        password has to be checked by libpwquality.  Passwords longer than 256 bytes are given to
+        :meth:`first_failure` instead.
+
+        :arg passwords: sequence of passwords as UTF-8 bytes
+        """
+        if np is None:
+            raise RuntimeError('first_failures needs NumPy')
+        long_idx = [idx for idx, password in enumerate(passwords)
+                    if len(password) > _MAX_VECTOR_LENGTH]
+        if not long_idx:
+            return self._first_failures(passwords)
+
+        long_idx = set(long_idx)
+        short_idx = [idx for idx in range(len(passwords)) if idx not in long_idx]
+        rcs = np.zeros(len(passwords), dtype=np.intc)
+        auxerrors = np.zeros(len(passwords), dtype=np.intp)
+        rcs[short_idx], auxerrors[short_idx] = self._first_failures(
+            [passwords[idx] for idx in short_idx])
+        for idx in long_idx:
+            failure = self.first_failure(passwords[idx])
+            if failure is not None:
+                rcs[idx], auxerrors[idx] = failure
+        return rcs, auxerrors
+
+    def _first_failures(self, passwords):
+        rules = self.rules
+        count = len(passwords)
+        lengths = np.fromiter((len(p) for p in passwords), dtype=np.intp, count=count)
+        width = int(lengths.max()) if count else 0
+        valid = np.arange(width) < lengths[:, None]
+        buf = np.zeros((count, width), dtype=np.uint8)
+        buf[valid] = np.frombuffer(b''.join(passwords), dtype=np.uint8)
+
+        lower = buf + ((buf >= 0x41) & (buf <= 0x5a)).astype(np.uint8) * 0x20
+        mirror = np.clip(lengths[:, None] - 1 - np.arange(width), 0, None)
+        palindrome = ((np.take_along_axis(lower, mirror, axis=1) == lower) | ~valid).all(axis=1)
+        deferred = palindrome | ((buf == 0) & valid).any(axis=1)
+
+        char_class = np.array(_CLASS_OF, dtype=np.int8)[buf]
+        char_class[~valid] = -1
+        counts = [(char_class == cls).sum(axis=1) for cls in (_DIGIT, _UPPER, _LOWER, _OTHER)]
+        pairs = valid[:, 1:]
+
+        failed = []
+        auxerrors = []
+        max_class_repeat = rules['maxclassrepeat']
+        if max_class_repeat > 1:
+            same_class = (char_class[:, 1:] == char_class[:, :-1]) & pairs
+            failed.append(_exceeds(same_class, max_class_repeat))
+        else:
+            failed.append(np.zeros(count, dtype=bool))
+        auxerrors.append(max_class_repeat)
+
+        size = np.full(count, rules['minlen'], dtype=np.intp)
+        for cls, credit in ((_DIGIT, rules['dcredit']), (_UPPER, rules['ucredit']),
+                            (_LOWER, rules['lcredit']), (_OTHER, rules['ocredit'])):
+            if credit >= 0:
+                size -= np.minimum(counts[cls], credit)
+                failed.append(np.zeros(count, dtype=bool))
+            else:
+                failed.append(counts[cls] < -credit)
+            auxerrors.append(-credit)
+        failed.append(size > lengths)
+        auxerrors.append(rules['minlen'])
+
+        classes = sum((cls_count > 0).astype(np.intp) for cls_count in counts)
+        failed.append(classes < rules['minclass'])
+        auxerrors.append(rules['minclass'])
+
+        max_repeat = rules['maxrepeat']
+        if max_repeat:
+            failed.append(_exceeds((buf[:, 1:] == buf[:, :-1]) & pairs, max_repeat))
+        else:
+            failed.append(np.zeros(count, dtype=bool))
+        auxerrors.append(max_repeat)
+
+        max_sequence = rules['maxsequence']
+        if max_sequence:
+            signed = buf.view(np.int8).astype(np.int16)
+            step = signed[:, 1:] - signed[:, :-1]
+            failed.append(_exceeds((step == 1) & pairs, max_sequence)
+                          | _exceeds((step == -1) & pairs, max_sequence))
+        else:
+            failed.append(np.zeros(count, dtype=bool))
+        auxerrors.append(max_sequence)
+
+        failed = [rule & ~deferred for rule in failed]
+        rcs = np.select(failed, self._codes, 0)
+        return rcs.astype(np.intc), np.select(failed, auxerrors, 0)
+
+    #
+    # Checking passwords
+    #
+
+    def check(self, password, oldpassword=None, username=None):
+        """
+        Check the password the way ``PWQSettings.check()`` does and return the score
+
+        The arguments are the same as for ``PWQSettings.check()``.
+        """
+        self._poll()
+        if not oldpassword:
+            failure = self.first_failure(_to_bytes(password))
+            if failure is not None:
+                self.rejected += 1
+                raise self._error_cls.from_pwq_rc(*failure)
+        self.passed += 1
+        return self.settings.check(password, oldpassword, username)
+
+    def check_many(self, passwords, oldpasswords=None, usernames=None):
+        """
+        Check a batch of passwords and return a :class:`PrefilterResults`
+
+        Only the passwords which pass the cheap rules are given to ``PWQSettings.check_many()``.
+        The arguments are the same as for ``PWQSettings.check_many()``.
+        """
+        self._poll()
+        passwords = [_to_bytes(p) for p in passwords]
+        count = len(passwords)
+        if ((oldpasswords is not None and len(oldpasswords) != count)
+                or (usernames is not None and len(usernames) != count)):
+            raise ValueError('oldpasswords and usernames must be the same length as passwords')
+
+        vectorize = self.vectorize
+        if vectorize is None:
+            vectorize = np is not None and count >= _MIN_VECTOR_BATCH
+        if vectorize:
+            rcs, auxerrors = self.first_failures(passwords)
+            scores = array('i', rcs.tolist())
+            auxerrors = auxerrors.tolist()
+        else:
+            scores = array('i', [0]) * count
+            auxerrors = [0] * count
+            for idx, password in enumerate(passwords):
+                failure = self.first_failure(password)
+                if failure is not None:
+                    scores[idx], auxerrors[idx] = failure
+
+        checked_idx = {}
+        for idx in range(count):
+            if oldpasswords is not None and oldpasswords[idx]:
+                scores[idx] = 0
+            if not scores[idx]:
+                checked_idx[idx] = len(checked_idx)
+
+        checked = None
+        if checked_idx:
+            checked = self.settings.check_many(
+                [passwords[idx] for idx in checked_idx],
+                None if oldpasswords is None else [oldpasswords[idx] for idx in checked_idx],
+                None if usernames is None else [usernames[idx] for idx in checked_idx])
+            for idx, checked_pos in checked_idx.items():
+                scores[idx] = checked.scores[checked_pos]
+
+        self.passed += len(checked_idx)
+        self.rejected += count - len(checked_idx)
+        return PrefilterResults(scores, auxerrors, self._error_cls, checked, checked_idx)
@@ -8,24 +8,63 @@
  */
 
 #include <Python.h>
+#include <pythread.h>
 #include "pwquality.h"
 
-#if PY_MAJOR_VERSION >= 3
-#define IS_PY3K
-#define PWQLong_FromLong PyLong_FromLong
-#define PWQLong_AsLong PyLong_AsLong
-#else
-#define PWQLong_FromLong PyInt_FromLong
-#define PWQLong_AsLong PyInt_AsLong
+/* Multi-phase init with a heap type and per-module state lets the module be
+ * loaded into several (sub)interpreters, each with its own PWQError and
+ * PWQSettings.  PyType_FromModuleAndSpec() is needed to find that state from
+ * a PWQSettings object. */
+#if PY_VERSION_HEX < 0x03090000
+#error "pwquality needs Python 3.9 or later"
 #endif
 
-static PyObject *PWQError;
+/* Names of the parameters of check() and generate() */
+static const char *check_keywords[] = { "password", "oldpassword", "username" };
+#define CHECK_NARGS 3
+static const char *generate_keywords[] = { "entropy" };
+#define GENERATE_NARGS 1
+
+/* Error codes from PWQ_ERROR_FATAL_FAILURE (-1) down whose exception
+ * arguments are built when the module is executed */
+#define PWQ_ERROR_CACHED 32
+
+typedef struct {
+        PyObject *PWQError;
+        PyTypeObject *PWQSettings_Type;
+        /* The parameter names interned once so that a keyword argument is
+         * usually matched by comparing pointers */
+        PyObject *check_kwlist[CHECK_NARGS];
+        PyObject *generate_kwlist[GENERATE_NARGS];
+        /* (code, message) tuples of the errors, indexed by -code - 1, for
+         * the messages which do not depend on auxerror */
+        PyObject *error_args[PWQ_ERROR_CACHED];
+} pwquality_state;
+
+static struct PyModuleDef pwqualitydef;
 
 typedef struct {
         PyObject_HEAD
         pwquality_settings_t *pwq;
+        PyThread_type_lock lock;
 } PWQSettings;
 
+/* The GIL is released around the libpwquality calls so the settings object
+ * has its own lock to keep concurrent users of one object safe.  The lock
+ * must never be waited on while holding the GIL or a thread inside the
+ * library could not get the GIL back to release it.  On free-threaded
+ * builds there is no GIL to serialize the calls which do not release it, so
+ * every access to self->pwq goes through this lock. */
+#define PWQSETTINGS_LOCK(self) \
+        do { \
+                if (!PyThread_acquire_lock((self)->lock, NOWAIT_LOCK)) { \
+                        Py_BEGIN_ALLOW_THREADS \
+                        PyThread_acquire_lock((self)->lock, WAIT_LOCK); \
+                        Py_END_ALLOW_THREADS \
+                } \
+        } while (0)
+#define PWQSETTINGS_UNLOCK(self) PyThread_release_lock((self)->lock)
+
 static PyObject *
 pwqsettings_new(PyTypeObject *type, PyObject *args, PyObject *kwds);
 static void
@@ -43,9 +82,11 @@ read_config(PWQSettings *self, PyObject *args);
 static PyObject *
 set_option(PWQSettings *self, PyObject *args);
 static PyObject *
-generate(PWQSettings *self, PyObject *args);
+generate(PWQSettings *self, PyTypeObject *defining_class, PyObject *const *args,
+         Py_ssize_t nargs, PyObject *kwnames);
 static PyObject *
-check(PWQSettings *self, PyObject *args);
+check(PWQSettings *self, PyTypeObject *defining_class, PyObject *const *args,
+      Py_ssize_t nargs, PyObject *kwnames);
 
 static PyMethodDef pwqsettings_methods[] = {
         { "read_config", (PyCFunction)read_config, METH_VARARGS,
@@ -56,11 +97,17 @@ static PyMethodDef pwqsettings_methods[] = {
                 "Set option from name=value pair\n\nParameters:\n"
                 "        option - string with the name=value pair"
         },
-        { "generate", (PyCFunction)generate, METH_VARARGS,
+        /* METH_FASTCALL passes the arguments without packing them into a
+         * tuple and METH_METHOD passes the class which holds the module state */
+        { "generate", (PyCFunction)(void (*)(void))generate,
+                METH_METHOD | METH_FASTCALL | METH_KEYWORDS,
+                "generate($self, /, entropy)\n--\n\n"
                 "Generate password with requested entropy\n\nParameters:\n"
                 "        entropy - integer entropy bits used to generate the password"
         },
-        { "check", (PyCFunction)check, METH_VARARGS,
+        { "check", (PyCFunction)(void (*)(void))check,
+                METH_METHOD | METH_FASTCALL | METH_KEYWORDS,
+                "check($self, /, password, oldpassword=None, username=None)\n--\n\n"
                 "Check whether the password conforms to the requirements and return password strength score"
                 "\n\nParameters:\n"
                 "        password - password string to be checked\n"
@@ -145,57 +192,75 @@ static PyGetSetDef pwqsettings_getseters[] = {
 };
 
 
-static PyTypeObject pwqsettings_type = {
-        PyVarObject_HEAD_INIT(NULL, 0)
-        "pwquality.PWQSettings",   /* tp_name */
-        sizeof(PWQSettings),       /* tp_basicsize */
-        0,                         /* tp_itemsize */
-        (destructor)pwqsettings_dealloc, /* tp_dealloc */
-        0,                         /* tp_print */
-        0,                         /* tp_getattr */
-        0,                         /* tp_setattr */
-        0,                         /* tp_compare */
-        0,                         /* tp_repr */
-        0,                         /* tp_as_number */
-        0,                         /* tp_as_sequence */
-        0,                         /* tp_as_mapping */
-        0,                         /* tp_hash */
-        0,                         /* tp_call */
-        0,                         /* tp_str */
-        0,                         /* tp_getattro */
-        0,                         /* tp_setattro */
-        0,                         /* tp_as_buffer */
-        Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE, /* tp_flags */
-        "PWQSettings objects - libpwquality functionality wrapper", /* tp_doc */
-        0,                         /* tp_traverse */
-        0,                         /* tp_clear */
-        0,                         /* tp_richcompare */
-        0,                         /* tp_weaklistoffset */
-        0,                         /* tp_iter */
-        0,                         /* tp_iternext */
-        pwqsettings_methods,       /* tp_methods */
-        0,                         /* tp_members */
-        pwqsettings_getseters,     /* tp_getset */
-        0,                         /* tp_base */
-        0,                         /* tp_dict */
-        0,                         /* tp_descr_get */
-        0,                         /* tp_descr_set */
-        0,                         /* tp_dictoffset */
-        0,                         /* tp_init */
-        0,                         /* tp_alloc */
-        pwqsettings_new,           /* tp_new */
+static PyType_Slot pwqsettings_slots[] = {
+        { Py_tp_dealloc, pwqsettings_dealloc },
+        { Py_tp_doc, "PWQSettings objects - libpwquality functionality wrapper" },
+        { Py_tp_methods, pwqsettings_methods },
+        { Py_tp_getset, pwqsettings_getseters },
+        { Py_tp_new, pwqsettings_new },
+        { 0, NULL }  /* Sentinel */
+};
+
+static PyType_Spec pwqsettings_spec = {
+        "pwquality.PWQSettings",
+        sizeof(PWQSettings),
+        0,
+#ifdef Py_TPFLAGS_IMMUTABLETYPE
+        Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_IMMUTABLETYPE,
+#else
+        Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE,
+#endif
+        pwqsettings_slots,
 };
 
 static PyMethodDef pwquality_methods[] = {
         { NULL }  /* Sentinel */
 };
 
+/* Return the state of the module which defined the type of self, which may
+ * be a subclass of PWQSettings */
+static pwquality_state *
+pwquality_get_state(PyObject *self)
+{
+#if PY_VERSION_HEX >= 0x030B0000
+        return (pwquality_state *)PyModule_GetState(
+                PyType_GetModuleByDef(Py_TYPE(self), &pwqualitydef));
+#else
+        PyTypeObject *type = Py_TYPE(self);
+
+        while (type->tp_methods != pwqsettings_methods)
+                type = type->tp_base;
+        return (pwquality_state *)PyType_GetModuleState(type);
+#endif
+}
+
+/* Set the exception for a libpwquality error and return NULL.  Messages
+ * which need auxerror are formatted by pwquality_strerror(), which also
+ * frees auxerror for the codes where it was allocated.  The others come
+ * from the tuples made when the module was executed. */
 static PyObject *
-pwqerror(int rc, void *auxerror)
+pwqerror(pwquality_state *state, int rc, void *auxerror)
 {
         char buf[PWQ_MAX_ERROR_MESSAGE_LEN];
         PyObject *py_errvalue;
         const char *msg;
+        PyObject *exc_type;
+
+        if (rc == PWQ_ERROR_UNKNOWN_SETTING || rc == PWQ_ERROR_NON_INT_SETTING
+                || rc == PWQ_ERROR_NON_STR_SETTING) {
+                exc_type = PyExc_AttributeError;
+        } else {
+                exc_type = state->PWQError;
+        }
+
+        if (auxerror == NULL) {
+                if (rc == PWQ_ERROR_MEM_ALLOC)
+                        return PyErr_NoMemory();
+                if (rc < 0 && rc >= -PWQ_ERROR_CACHED) {
+                        PyErr_SetObject(exc_type, state->error_args[-rc - 1]);
+                        return NULL;
+                }
+        }
 
         msg = pwquality_strerror(buf, sizeof(buf), rc, auxerror);
 
@@ -206,12 +271,7 @@ pwqerror(int rc, void *auxerror)
         if (py_errvalue == NULL)
                 return NULL;
 
-        if (rc == PWQ_ERROR_UNKNOWN_SETTING || rc == PWQ_ERROR_NON_INT_SETTING
-                || rc == PWQ_ERROR_NON_STR_SETTING) {
-                PyErr_SetObject(PyExc_AttributeError, py_errvalue);
-        } else {
-                PyErr_SetObject(PWQError, py_errvalue);
-        }
+        PyErr_SetObject(exc_type, py_errvalue);
         Py_DECREF(py_errvalue);
         return NULL;
 }
@@ -223,6 +283,11 @@ pwqsettings_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
 
         self = (PWQSettings *)type->tp_alloc(type, 0);
         if (self) {
+                self->lock = PyThread_allocate_lock();
+                if (self->lock == NULL) {
+                        Py_DECREF(self);
+                        return PyErr_NoMemory();
+                }
                 self->pwq = pwquality_default_settings();
                 if (self->pwq == NULL) {
                         Py_DECREF(self);
@@ -235,8 +300,15 @@ pwqsettings_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
 static void
 pwqsettings_dealloc(PWQSettings *self)
 {
-        pwquality_free_settings(self->pwq);
-        Py_TYPE(self)->tp_free((PyObject *)self);
+        /* Instances of heap types own a reference to their type */
+        PyTypeObject *type = Py_TYPE(self);
+
+        if (self->pwq)
+                pwquality_free_settings(self->pwq);
+        if (self->lock)
+                PyThread_free_lock(self->lock);
+        type->tp_free((PyObject *)self);
+        Py_DECREF(type);
 }
 
 static PyObject *
@@ -245,10 +317,13 @@ pwqsettings_getint(PWQSettings *self, void *setting)
         int value;
         int rc;
 
-        if ((rc = pwquality_get_int_value(self->pwq, (int)(ssize_t)setting, &value)) < 0) {
-                return pwqerror(rc, NULL);
+        PWQSETTINGS_LOCK(self);
+        rc = pwquality_get_int_value(self->pwq, (int)(ssize_t)setting, &value);
+        PWQSETTINGS_UNLOCK(self);
+        if (rc < 0) {
+                return pwqerror(pwquality_get_state((PyObject *)self), rc, NULL);
         }
-        return PWQLong_FromLong((long)value);
+        return PyLong_FromLong((long)value);
 }
 
 static int
@@ -257,11 +332,13 @@ pwqsettings_setint(PWQSettings *self, PyObject *value, void *setting)
         long l;
         int rc;
 
-        l = PWQLong_AsLong(value);
+        l = PyLong_AsLong(value);
         if (PyErr_Occurred() == NULL) {
-                if ((rc = pwquality_set_int_value(self->pwq,
-                        (int)(ssize_t)setting, (int)l)) < 0) {
-                        pwqerror(rc, NULL);
+                PWQSETTINGS_LOCK(self);
+                rc = pwquality_set_int_value(self->pwq, (int)(ssize_t)setting, (int)l);
+                PWQSETTINGS_UNLOCK(self);
+                if (rc < 0) {
+                        pwqerror(pwquality_get_state((PyObject *)self), rc, NULL);
                         return -1;
                 }
                 return 0;
@@ -273,50 +350,56 @@ static PyObject *
 pwqsettings_getstr(PWQSettings *self, void *setting)
 {
         const char *value;
+        PyObject *strobj;
         int rc;
 
+        /* The string belongs to the settings object so copy it before unlocking */
+        PWQSETTINGS_LOCK(self);
         if ((rc = pwquality_get_str_value(self->pwq, (int)(ssize_t)setting, &value)) < 0) {
-                return pwqerror(rc, NULL);
+                PWQSETTINGS_UNLOCK(self);
+                return pwqerror(pwquality_get_state((PyObject *)self), rc, NULL);
         }
         if (value == NULL) {
+                PWQSETTINGS_UNLOCK(self);
                 Py_INCREF(Py_None);
                 return Py_None;
         }
-#ifdef IS_PY3K
-        return PyUnicode_FromString(value);
-#else
-        return PyString_FromString(value);
-#endif
+        strobj = PyUnicode_FromString(value);
+        PWQSETTINGS_UNLOCK(self);
+        return strobj;
 }
 
 static int
 pwqsettings_setstr(PWQSettings *self, PyObject *value, void *setting)
 {
         const char *s = NULL;
+        PyObject *value_as_bytes = NULL;
         int rc;
 
         if (value != (PyObject *)Py_None) {
-#ifdef IS_PY3K
                 if (PyUnicode_Check(value)) {
-                        PyObject *value_as_bytes = PyUnicode_AsUTF8String(value);
+                        /* s points into value_as_bytes so keep it until libpwquality
+                         * has copied the string */
+                        value_as_bytes = PyUnicode_AsUTF8String(value);
                         if (!value_as_bytes)
                                 return -1;
                         s = PyBytes_AsString(value_as_bytes);
-                        Py_DECREF(value_as_bytes);
-                        if (!s)
+                        if (!s) {
+                                Py_DECREF(value_as_bytes);
                                 return -1;
+                        }
                 } else {
                         PyErr_SetString(PyExc_TypeError, "expected unicode string");
                 }
-#else
-                s = PyString_AsString(value);
-#endif
         }
 
         if (PyErr_Occurred() == NULL) {
-                if ((rc = pwquality_set_str_value(self->pwq,
-                        (int)(ssize_t)setting, s)) < 0) {
-                        pwqerror(rc, NULL);
+                PWQSETTINGS_LOCK(self);
+                rc = pwquality_set_str_value(self->pwq, (int)(ssize_t)setting, s);
+                PWQSETTINGS_UNLOCK(self);
+                Py_XDECREF(value_as_bytes);
+                if (rc < 0) {
+                        pwqerror(pwquality_get_state((PyObject *)self), rc, NULL);
                         return -1;
                 }
                 return 0;
@@ -328,13 +411,19 @@ static PyObject *
 read_config(PWQSettings *self, PyObject *args)
 {
         char *cfgfile = NULL;
-        void *auxerror;
+        void *auxerror = NULL;
         int rc;
 
         if (!PyArg_ParseTuple(args, "|s", &cfgfile))
                 return NULL;
-        if ((rc = pwquality_read_config(self->pwq, cfgfile, &auxerror)) < 0) {
-                return pwqerror(rc, auxerror);
+
+        PWQSETTINGS_LOCK(self);
+        Py_BEGIN_ALLOW_THREADS
+        rc = pwquality_read_config(self->pwq, cfgfile, &auxerror);
+        Py_END_ALLOW_THREADS
+        PWQSETTINGS_UNLOCK(self);
+        if (rc < 0) {
+                return pwqerror(pwquality_get_state((PyObject *)self), rc, auxerror);
         }
         Py_INCREF(Py_None);
         return Py_None;
@@ -348,106 +437,268 @@ set_option(PWQSettings *self, PyObject *args)
 
         if (!PyArg_ParseTuple(args, "s", &option))
                 return NULL;
-        if ((rc = pwquality_set_option(self->pwq, option)) < 0) {
-                return pwqerror(rc, NULL);
+
+        PWQSETTINGS_LOCK(self);
+        rc = pwquality_set_option(self->pwq, option);
+        PWQSETTINGS_UNLOCK(self);
+        if (rc < 0) {
+                return pwqerror(pwquality_get_state((PyObject *)self), rc, NULL);
         }
         Py_INCREF(Py_None);
         return Py_None;
 }
 
+/* Match the vectorcall arguments of fname to the parameter names in kwlist.
+ * values gets a borrowed reference for each parameter, or NULL for optional
+ * ones which were not passed.  The private _PyArg_Parser of CPython does the
+ * same but it changes between Python versions. */
+static int
+parse_fastcall(const char *fname, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames,
+               PyObject *const *kwlist, Py_ssize_t maxargs, Py_ssize_t required,
+               PyObject **values)
+{
+        Py_ssize_t nkw = kwnames == NULL ? 0 : PyTuple_GET_SIZE(kwnames);
+        Py_ssize_t i, j;
+
+        if (nargs > maxargs) {
+                PyErr_Format(PyExc_TypeError, "%s() takes at most %zd arguments (%zd given)",
+                             fname, maxargs, nargs + nkw);
+                return -1;
+        }
+        for (i = 0; i < maxargs; i++)
+                values[i] = i < nargs ? args[i] : NULL;
+
+        for (i = 0; i < nkw; i++) {
+                PyObject *key = PyTuple_GET_ITEM(kwnames, i);
+
+                for (j = 0; j < maxargs && key != kwlist[j]; j++)
+                        ;
+                if (j == maxargs) {
+                        /* Names which were not interned */
+                        for (j = 0; j < maxargs && PyUnicode_Compare(key, kwlist[j]) != 0; j++)
+                                ;
+                }
+                if (j == maxargs) {
+                        PyErr_Format(PyExc_TypeError,
+                                     "'%U' is an invalid keyword argument for %s()", key, fname);
+                        return -1;
+                }
+                if (values[j] != NULL) {
+                        PyErr_Format(PyExc_TypeError,
+                                     "argument for %s() given by name ('%U') and position (%zd)",
+                                     fname, key, j + 1);
+                        return -1;
+                }
+                values[j] = args[nargs + i];
+        }
+
+        for (i = 0; i < required; i++) {
+                if (values[i] == NULL) {
+                        PyErr_Format(PyExc_TypeError,
+                                     "%s() missing required argument '%U' (pos %zd)",
+                                     fname, kwlist[i], i + 1);
+                        return -1;
+                }
+        }
+        return 0;
+}
+
+/* Convert an argument like the "s" format of PyArg_ParseTuple() or, when
+ * none_ok is set, the "z" format.  The string belongs to obj. */
+static int
+str_arg(const char *fname, Py_ssize_t pos, PyObject *obj, int none_ok, const char **value)
+{
+        Py_ssize_t size;
+
+        if (obj == NULL || (none_ok && obj == Py_None)) {
+                *value = NULL;
+                return 0;
+        }
+        if (!PyUnicode_Check(obj)) {
+                PyErr_Format(PyExc_TypeError, "%s() argument %zd must be %s, not %.50s",
+                             fname, pos, none_ok ? "str or None" : "str",
+                             Py_TYPE(obj)->tp_name);
+                return -1;
+        }
+        *value = PyUnicode_AsUTF8AndSize(obj, &size);
+        if (*value == NULL)
+                return -1;
+        if (strlen(*value) != (size_t)size) {
+                PyErr_SetString(PyExc_ValueError, "embedded null character");
+                return -1;
+        }
+        return 0;
+}
+
+/* Convert an argument like the "i" format of PyArg_ParseTuple() */
+static int
+int_arg(PyObject *obj, int *value)
+{
+        long l = PyLong_AsLong(obj);
+
+        if (l == -1 && PyErr_Occurred())
+                return -1;
+        if (l > INT_MAX) {
+                PyErr_SetString(PyExc_OverflowError, "signed integer is greater than maximum");
+                return -1;
+        }
+        if (l < INT_MIN) {
+                PyErr_SetString(PyExc_OverflowError, "signed integer is less than minimum");
+                return -1;
+        }
+        *value = (int)l;
+        return 0;
+}
+
 static PyObject *
-generate(PWQSettings *self, PyObject *args)
+generate(PWQSettings *self, PyTypeObject *defining_class, PyObject *const *args,
+         Py_ssize_t nargs, PyObject *kwnames)
 {
+        pwquality_state *state = (pwquality_state *)PyType_GetModuleState(defining_class);
+        PyObject *values[GENERATE_NARGS];
         int entropy_bits;
         char *password;
         PyObject *passobj;
         int rc;
 
-        if (!PyArg_ParseTuple(args, "i", &entropy_bits))
+        if (parse_fastcall("generate", args, nargs, kwnames, state->generate_kwlist,
+                           GENERATE_NARGS, 1, values) < 0
+            || int_arg(values[0], &entropy_bits) < 0)
                 return NULL;
-        if ((rc = pwquality_generate(self->pwq, entropy_bits, &password)) < 0) {
-                return pwqerror(rc, NULL);
+
+        /* Reading the random device and checking the candidates does not need the GIL */
+        PWQSETTINGS_LOCK(self);
+        Py_BEGIN_ALLOW_THREADS
+        rc = pwquality_generate(self->pwq, entropy_bits, &password);
+        Py_END_ALLOW_THREADS
+        PWQSETTINGS_UNLOCK(self);
+        if (rc < 0) {
+                return pwqerror(state, rc, NULL);
         }
 
-#ifdef IS_PY3K
         passobj = PyUnicode_FromString(password);
-#else
-        passobj = PyString_FromString(password);
-#endif
         free(password);
         return passobj;
 }
 
 static PyObject *
-check(PWQSettings *self, PyObject *args)
+check(PWQSettings *self, PyTypeObject *defining_class, PyObject *const *args,
+      Py_ssize_t nargs, PyObject *kwnames)
 {
-        char *password;
-        char *oldpassword = NULL;
-        char *username = NULL;
-        void *auxerror;
+        pwquality_state *state = (pwquality_state *)PyType_GetModuleState(defining_class);
+        PyObject *values[CHECK_NARGS];
+        const char *password;
+        const char *oldpassword;
+        const char *username;
+        void *auxerror = NULL;
         int rc;
 
-        if (!PyArg_ParseTuple(args, "s|zz", &password, &oldpassword, &username))
+        if (parse_fastcall("check", args, nargs, kwnames, state->check_kwlist,
+                           CHECK_NARGS, 1, values) < 0
+            || str_arg("check", 1, values[0], 0, &password) < 0
+            || str_arg("check", 2, values[1], 1, &oldpassword) < 0
+            || str_arg("check", 3, values[2], 1, &username) < 0)
                 return NULL;
-        if ((rc = pwquality_check(self->pwq, password, oldpassword,
-                                  username, &auxerror)) < 0) {
-                return pwqerror(rc, auxerror);
+
+        /* The strings stay alive in args so the dictionary lookup can run without the GIL */
+        PWQSETTINGS_LOCK(self);
+        Py_BEGIN_ALLOW_THREADS
+        rc = pwquality_check(self->pwq, password, oldpassword, username, &auxerror);
+        Py_END_ALLOW_THREADS
+        PWQSETTINGS_UNLOCK(self);
+        if (rc < 0) {
+                return pwqerror(state, rc, auxerror);
         }
 
-        return PWQLong_FromLong((long)rc);
+        return PyLong_FromLong((long)rc);
 }
 
-#ifdef IS_PY3K
-static struct PyModuleDef pwqualitydef = {
-        PyModuleDef_HEAD_INIT,
-        "pwquality",
-        "Libpwquality wrapper module",
-        -1,
-        pwquality_methods,
-        NULL,
-        NULL,
-        NULL,
-        NULL,
-};
-
-#define INITERROR return NULL
-
-PyObject *
-PyInit_pwquality(void)
-#else
-#define INITERROR return
+static int
+pwquality_traverse(PyObject *module, visitproc visit, void *arg)
+{
+        pwquality_state *state = (pwquality_state *)PyModule_GetState(module);
+
+        int i;
+
+        Py_VISIT(state->PWQError);
+        Py_VISIT(state->PWQSettings_Type);
+        for (i = 0; i < CHECK_NARGS; i++)
+                Py_VISIT(state->check_kwlist[i]);
+        for (i = 0; i < GENERATE_NARGS; i++)
+                Py_VISIT(state->generate_kwlist[i]);
+        for (i = 0; i < PWQ_ERROR_CACHED; i++)
+                Py_VISIT(state->error_args[i]);
+        return 0;
+}
 
-PyMODINIT_FUNC
-initpwquality(void)
-#endif
+static int
+pwquality_clear(PyObject *module)
 {
-        PyObject *module;
+        pwquality_state *state = (pwquality_state *)PyModule_GetState(module);
+
+        int i;
+
+        Py_CLEAR(state->PWQError);
+        Py_CLEAR(state->PWQSettings_Type);
+        for (i = 0; i < CHECK_NARGS; i++)
+                Py_CLEAR(state->check_kwlist[i]);
+        for (i = 0; i < GENERATE_NARGS; i++)
+                Py_CLEAR(state->generate_kwlist[i]);
+        for (i = 0; i < PWQ_ERROR_CACHED; i++)
+                Py_CLEAR(state->error_args[i]);
+        return 0;
+}
 
-        if (PyType_Ready(&pwqsettings_type) < 0)
-                INITERROR;
+static void
+pwquality_free(void *module)
+{
+        pwquality_clear((PyObject *)module);
+}
 
-#ifdef IS_PY3K
-        module = PyModule_Create(&pwqualitydef);
-#else
-        module = Py_InitModule3("pwquality", pwquality_methods,
-                "Libpwquality wrapper module");
-#endif
-        if (module == NULL)
-                INITERROR;
+static int
+pwquality_exec(PyObject *module)
+{
+        pwquality_state *state = (pwquality_state *)PyModule_GetState(module);
+        char buf[PWQ_MAX_ERROR_MESSAGE_LEN];
+        int i;
+
+        /* libpwquality translates the messages so these are in the language
+         * of the locale the module was imported with */
+        for (i = 0; i < PWQ_ERROR_CACHED; i++) {
+                state->error_args[i] = Py_BuildValue("is", -i - 1,
+                        pwquality_strerror(buf, sizeof(buf), -i - 1, NULL));
+                if (state->error_args[i] == NULL)
+                        return -1;
+        }
+        for (i = 0; i < CHECK_NARGS; i++) {
+                state->check_kwlist[i] = PyUnicode_InternFromString(check_keywords[i]);
+                if (state->check_kwlist[i] == NULL)
+                        return -1;
+        }
+        for (i = 0; i < GENERATE_NARGS; i++) {
+                state->generate_kwlist[i] = PyUnicode_InternFromString(generate_keywords[i]);
+                if (state->generate_kwlist[i] == NULL)
+                        return -1;
+        }
 
-        PWQError = PyErr_NewExceptionWithDoc("pwquality.PWQError",
+        state->PWQError = PyErr_NewExceptionWithDoc("pwquality.PWQError",
                 "Standard exception thrown from PWQSettings method calls\n\n"
                 "The exception value is always integer error code and string description",
                 NULL, NULL);
-        if (PWQError == NULL) {
-                Py_DECREF(module);
-                INITERROR;
+        if (state->PWQError == NULL)
+                return -1;
+        Py_INCREF(state->PWQError);
+        if (PyModule_AddObject(module, "PWQError", state->PWQError) < 0) {
+                Py_DECREF(state->PWQError);
+                return -1;
         }
-        Py_INCREF(PWQError);
-        PyModule_AddObject(module, "PWQError", PWQError);
 
-        Py_INCREF(&pwqsettings_type);
-        PyModule_AddObject(module, "PWQSettings", (PyObject *)&pwqsettings_type);
+        state->PWQSettings_Type = (PyTypeObject *)PyType_FromModuleAndSpec(
+                module, &pwqsettings_spec, NULL);
+        if (state->PWQSettings_Type == NULL)
+                return -1;
+        if (PyModule_AddType(module, state->PWQSettings_Type) < 0)
+                return -1;
 
 /* This section is generated during build time from pwquality.h 
  * There is some python code in the build scripts which pulls it out, formats it, and places it
@@ -506,9 +757,38 @@ PyModule_AddIntConstant(module, "PWQ_ERROR_MAX_CLASS_REPEAT", -27);
 PyModule_AddIntConstant(module, "PWQ_ERROR_BAD_WORDS", -28);
 PyModule_AddIntConstant(module, "PWQ_ERROR_MAX_SEQUENCE", -29);
 /* End generated section */
-#ifdef IS_PY3K
-        return module;
+        return PyErr_Occurred() ? -1 : 0;
+}
+
+static PyModuleDef_Slot pwquality_slots[] = {
+        { Py_mod_exec, pwquality_exec },
+#if PY_VERSION_HEX >= 0x030C0000
+        { Py_mod_multiple_interpreters, Py_MOD_PER_INTERPRETER_GIL_SUPPORTED },
 #endif
+#if PY_VERSION_HEX >= 0x030D0000
+        /* Every PWQSettings has its own lock and the module state is only
+         * written while the module is executed */
+        { Py_mod_gil, Py_MOD_GIL_NOT_USED },
+#endif
+        { 0, NULL }  /* Sentinel */
+};
+
+static struct PyModuleDef pwqualitydef = {
+        PyModuleDef_HEAD_INIT,
+        "pwquality",
+        "Libpwquality wrapper module",
+        sizeof(pwquality_state),
+        pwquality_methods,
+        pwquality_slots,
+        pwquality_traverse,
+        pwquality_clear,
+        pwquality_free,
+};
+
+PyMODINIT_FUNC
+PyInit_pwquality(void)
+{
+        return PyModuleDef_Init(&pwqualitydef);
 }
 
 /*
@@ -1,3 +1,17 @@
+import asyncio
+import importlib.machinery
+import importlib.util
+import json
+import os
+import pickle
+import random
+import shutil
+import subprocess
+import sys
+import sysconfig
+import threading
+import time
+
 import pwquality
 import pytest
 
@@ -5,6 +19,17 @@ import ctypes_pwq
 import cffi_api_gen_pwq
 import cffi_abi_gen_pwq
 import cffi_abi_pwq
+import async_pwq
+import audit_pwq
+import badwords_pwq
+import build_pwq
+import cache_pwq
+import dict_pwq
+import instrument_pwq
+import parallel_pwq
+import pool_pwq
+import prefetch_pwq
+import prefilter_pwq
 
 
 @pytest.fixture()
@@ -24,6 +49,74 @@ def baseline_check():
     yield pwq_ctx.check
 
 
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Builds pwquality.c with the interpreter it is run by: python -c ... SOURCE BUILD_DIR
+_BUILD_EXTENSION = """
+import os.path
+import sys
+from setuptools import Distribution, Extension
+source, build_dir = sys.argv[1:]
+ext = Extension('pwquality', [source], include_dirs=[os.path.dirname(source)],
+                libraries=['pwquality'])
+cmd = Distribution({'name': 'pwquality', 'ext_modules': [ext]}).get_command_obj('build_ext')
+cmd.build_lib = build_dir
+cmd.build_temp = os.path.join(build_dir, 'build')
+cmd.ensure_finalized()
+cmd.run()
+print(cmd.get_ext_fullpath('pwquality'))
+"""
+
+
+def _free_threaded_python():
+    if sysconfig.get_config_var('Py_GIL_DISABLED'):
+        return sys.executable
+    for minor in range(13, 20):
+        python = shutil.which('python3.%dt' % minor)
+        if python:
+            return python
+    return None
+
+
+FREE_THREADED_PYTHON = _free_threaded_python()
+
+
+@pytest.fixture(scope='session')
+def build_extension(tmp_path_factory):
+    """Return a function which builds pwquality.c for an interpreter and returns its path"""
+    builds = {}
+
+    def build(python=sys.executable):
+        if python not in builds:
+            build_dir = tmp_path_factory.mktemp('extension')
+            proc = subprocess.run([python, '-c', _BUILD_EXTENSION,
+                                   os.path.join(HERE, 'pwquality.c'), str(build_dir)],
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                  universal_newlines=True)
+            builds[python] = (proc.returncode, proc.stdout)
+        returncode, output = builds[python]
+        if returncode:
+            pytest.skip('cannot build pwquality.c for %s:\n%s' % (python, output))
+        return output.splitlines()[-1]
+    return build
+
+
+@pytest.fixture(scope='session')
+def extension(build_extension):
+    """
+    The extension module in pwquality.c, built and loaded from its own path
+
+    It is not put in sys.modules so the upstream pwquality module which the bindings are compared
+    against stays the one that ``import pwquality`` returns.
+    """
+    path = build_extension()
+    loader = importlib.machinery.ExtensionFileLoader('pwquality', path)
+    spec = importlib.util.spec_from_file_location('pwquality', path, loader=loader)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
 @pytest.mark.parametrize('module', [ctypes_pwq, cffi_api_gen_pwq])
 def test_generate(module, baseline_generate):
     ctx = module.PWQSettings()
@@ -44,6 +137,35 @@ def test_generate(module, baseline_generate):
     assert len(baseline) >= len(module_password) - 1
 
 
+@pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq, cffi_abi_gen_pwq])
+def test_generate_many(module, baseline_generate):
+    ctx = module.PWQSettings()
+    passwords = ctx.generate_many(5, 64)
+    baseline = baseline_generate(64)
+
+    assert len(passwords) == 5
+    for password in passwords:
+        assert type(password) == type(baseline)
+        assert len(baseline) - 1 <= len(password) <= len(baseline) + 1
+
+
+@pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq, cffi_abi_gen_pwq])
+def test_generate_into(module, baseline_generate):
+    ctx = module.PWQSettings()
+    baseline = baseline_generate(64)
+    buf = bytearray(b'x' * 128)
+    length = ctx.generate_into(buf, 64)
+
+    assert len(baseline) - 1 <= length <= len(baseline) + 1
+    assert buf[length] == 0
+    assert b'\0' not in buf[:length]
+
+    with pytest.raises(ValueError):
+        ctx.generate_into(bytearray(2), 64)
+    with pytest.raises(TypeError):
+        ctx.generate_into(b'x' * 128, 64)
+
+
 @pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq, cffi_abi_gen_pwq])
 @pytest.mark.parametrize('password', ['Thosdjkesd', 'Thosdjkesd%', 'Thosdjkesd%p~i l230-9'])
 def test_check_succeed(module, baseline_check, password):
@@ -54,6 +176,27 @@ def test_check_succeed(module, baseline_check, password):
     assert baseline == module_score
 
 
+@pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq, cffi_abi_gen_pwq])
+@pytest.mark.parametrize('password', ['Thosdjkesd', 'Thosdjkesd%p~i l230-9', 'Thos'])
+def test_check_buffers(module, password):
+    ctx = module.PWQSettings()
+    try:
+        expected = ctx.check(password)
+    except module.PWQError as e:
+        expected = e.args
+
+    data = password.encode('utf-8')
+    buf = bytearray(b'xx' + data + b'\0yy')
+    inputs = [data, bytearray(data), bytearray(data + b'\0'), memoryview(buf)[2:len(data) + 3],
+              memoryview(data), memoryview(data + b'\0')]
+    for value in inputs:
+        try:
+            result = ctx.check(value)
+        except module.PWQError as e:
+            result = e.args
+        assert result == expected
+
+
 @pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq, cffi_abi_gen_pwq])
 @pytest.mark.parametrize('password', ['Thos', 'supercalifragilic', "pa's a s'ap"])
 def test_check_fail(module, baseline_check, password):
@@ -64,3 +207,981 @@ def test_check_fail(module, baseline_check, password):
         module_score = ctx.check(password)
 
     assert base_err.value.args == mod_err.value.args
+
+
+@pytest.mark.parametrize('args', [('',), ('Thosdjkesd%%dsekjdsohT',), ('Thos',),
+                                  ('Thosdjkesd%', 'Thosdjkesd%')])
+def test_extension_error_args(extension, args):
+    # Messages without details come from tuples the extension made at import
+    ctx = ctypes_pwq.PWQSettings()
+    with pytest.raises(ctypes_pwq.PWQError) as expected:
+        ctx.check(*args)
+
+    errors = []
+    for _ in range(2):
+        with pytest.raises(extension.PWQError) as err:
+            extension.PWQSettings().check(*args)
+        assert err.value.args == expected.value.args
+        errors.append(err.value)
+    assert errors[0] is not errors[1]
+
+
+@pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq, cffi_abi_gen_pwq])
+@pytest.mark.parametrize('password', ['Thos', 'supercalifragilic'])
+def test_check_fail_error_formatting(module, baseline_check, password):
+    ctx = module.PWQSettings()
+    with pytest.raises(pwquality.PWQError) as base_err:
+        baseline_check(password)
+    with pytest.raises(module.PWQError) as mod_err:
+        ctx.check(password)
+
+    assert str(mod_err.value) == str(base_err.value)
+    assert pickle.loads(pickle.dumps(mod_err.value)).args == base_err.value.args
+
+
+def _check_keyword_arguments(module):
+    ctx = module.PWQSettings()
+    assert (ctx.check(password='Thosdjkesd%', oldpassword='Thosdjkesd', username='toshio')
+            == ctx.check('Thosdjkesd%', 'Thosdjkesd', 'toshio'))
+    assert ctx.check('Thosdjkesd%', username=None) == ctx.check('Thosdjkesd%')
+    assert len(ctx.generate(entropy=56)) >= 8
+
+    with pytest.raises(TypeError):
+        ctx.check('Thosdjkesd%', password='Thosdjkesd%')
+    with pytest.raises(TypeError):
+        ctx.check('Thosdjkesd%', user='toshio')
+    with pytest.raises(TypeError):
+        ctx.check(oldpassword='Thosdjkesd%')
+
+
+@pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq, cffi_abi_gen_pwq])
+def test_keyword_arguments(module):
+    _check_keyword_arguments(module)
+
+
+def test_extension_keyword_arguments(extension):
+    # Upstream's check() and generate() only take positional arguments
+    _check_keyword_arguments(extension)
+
+
+@pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq, cffi_abi_gen_pwq])
+def test_check_many(module, baseline_check):
+    passwords = ['Thosdjkesd', 'Thos', 'Thosdjkesd%p~i l230-9', 'supercalifragilic']
+    ctx = module.PWQSettings()
+    results = ctx.check_many(passwords)
+
+    assert len(results) == len(passwords)
+    for idx, password in enumerate(passwords):
+        try:
+            baseline = baseline_check(password)
+        except pwquality.PWQError as e:
+            assert results[idx] == e.args[0]
+            assert results.error(idx).args == e.args
+        else:
+            assert results[idx] == baseline
+            assert results.error(idx) is None
+
+    assert [idx for idx, _err in results.errors()] == [1, 3]
+
+
+@pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq, cffi_abi_gen_pwq])
+def test_check_many_extra_args(module, baseline_check):
+    passwords = ['Thosdjkesd%', 'Thosdjkesd%']
+    oldpasswords = ['Thosdjkesd%', None]
+    usernames = [None, 'toshio']
+    ctx = module.PWQSettings()
+    results = ctx.check_many(passwords, oldpasswords, usernames)
+
+    for idx, password in enumerate(passwords):
+        try:
+            baseline = baseline_check(password, oldpasswords[idx], usernames[idx])
+        except pwquality.PWQError as e:
+            assert results.error(idx).args == e.args
+        else:
+            assert results[idx] == baseline
+
+
+@pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq, cffi_abi_gen_pwq])
+def test_set_option(module):
+    base_ctx = pwquality.PWQSettings()
+    ctx = module.PWQSettings()
+    base_ctx.set_option('minlen=20')
+    ctx.set_option('minlen=20')
+
+    with pytest.raises(pwquality.PWQError) as base_err:
+        base_ctx.check('Thosdjkesd%')
+    with pytest.raises(module.PWQError) as mod_err:
+        ctx.check('Thosdjkesd%')
+    assert mod_err.value.args == base_err.value.args
+
+    with pytest.raises(AttributeError) as base_err:
+        base_ctx.set_option('nosuchsetting=1')
+    with pytest.raises(AttributeError) as mod_err:
+        ctx.set_option('nosuchsetting=1')
+    assert mod_err.value.args == base_err.value.args
+
+
+@pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq, cffi_abi_gen_pwq])
+def test_read_config(module, tmp_path):
+    cfgfile = tmp_path / 'pwquality.conf'
+    cfgfile.write_text('minlen = 20\n')
+    base_ctx = pwquality.PWQSettings()
+    base_ctx.read_config(str(cfgfile))
+
+    ctx = module.PWQSettings()
+    ctx.read_config(str(cfgfile))
+    with pytest.raises(pwquality.PWQError) as base_err:
+        base_ctx.check('Thosdjkesd%')
+    with pytest.raises(module.PWQError) as mod_err:
+        ctx.check('Thosdjkesd%')
+    assert mod_err.value.args == base_err.value.args
+
+    with pytest.raises(pwquality.PWQError) as base_err:
+        base_ctx.read_config(str(tmp_path / 'missing.conf'))
+    with pytest.raises(module.PWQError) as mod_err:
+        ctx.read_config(str(tmp_path / 'missing.conf'))
+    assert mod_err.value.args == base_err.value.args
+
+
+@pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq, cffi_abi_gen_pwq])
+def test_read_config_reload(module, baseline_check, tmp_path):
+    cfgfile = tmp_path / 'pwquality.conf'
+    cfgfile.write_text('minlen = 20\n')
+    ctx = module.PWQSettings()
+    ctx.maxrepeat = 3
+    ctx.read_config(str(cfgfile), reload_interval=0)
+    with pytest.raises(module.PWQError):
+        ctx.check('Thosdjkesd%')
+
+    # Dropping minlen from the file puts it back to the default
+    cfgfile.write_text('difok = 5\n')
+    assert ctx.check('Thosdjkesd%') == baseline_check('Thosdjkesd%')
+    assert ctx._config_watch.reloads == 1
+    assert ctx.difok == 5
+    # Settings the file never touched keep the values they were given
+    assert ctx.maxrepeat == 3
+
+
+UPSTREAM_SETTINGS = ['difok', 'minlen', 'dcredit', 'ucredit', 'lcredit', 'ocredit', 'minclass',
+                     'maxrepeat', 'maxclassrepeat', 'maxsequence', 'gecoscheck', 'dictcheck',
+                     'badwords', 'dictpath']
+
+
+@pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq, cffi_abi_gen_pwq])
+def test_setting_properties(module):
+    base_ctx = pwquality.PWQSettings()
+    ctx = module.PWQSettings()
+    for name in UPSTREAM_SETTINGS:
+        assert getattr(ctx, name) == getattr(base_ctx, name)
+
+    for ctx_ in (base_ctx, ctx):
+        ctx_.minlen = 20
+        ctx_.badwords = 'acme widget'
+        ctx_.dictpath = None
+    for name in UPSTREAM_SETTINGS:
+        assert getattr(ctx, name) == getattr(base_ctx, name)
+
+    with pytest.raises(TypeError):
+        ctx.badwords = b'acme'
+    with pytest.raises(TypeError):
+        ctx.minlen = '12'
+
+
+@pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq, cffi_abi_gen_pwq])
+def test_configure_snapshot(module):
+    ctx = module.PWQSettings()
+    ctx.configure(minlen=20, difok=3, badwords='acme widget')
+    snapshot = ctx.snapshot()
+    assert snapshot['minlen'] == ctx.minlen == 20
+    assert snapshot['difok'] == 3
+    assert snapshot['badwords'] == 'acme widget'
+    assert set(UPSTREAM_SETTINGS) <= set(snapshot)
+
+    other = module.PWQSettings()
+    other.configure(**snapshot)
+    assert other.snapshot() == snapshot
+
+    with pytest.raises(TypeError):
+        ctx.configure(nosuchsetting=1)
+
+
+def _check_in_threads(module, settings, password, iterations):
+    def worker(ctx):
+        for _ in range(iterations):
+            try:
+                ctx.check(password)
+            except module.PWQError:
+                pass
+
+    threads = [threading.Thread(target=worker, args=(ctx,)) for ctx in settings]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(threads) * iterations / (time.perf_counter() - start)
+
+
+def test_check_shared_settings_threads(extension, baseline_check):
+    passwords = ['Thosdjkesd', 'Thos', 'supercalifragilic', "pa's a s'ap"] * 50
+    expected = []
+    for password in passwords:
+        try:
+            expected.append(baseline_check(password))
+        except pwquality.PWQError as e:
+            expected.append(e.args)
+
+    ctx = extension.PWQSettings()
+    results = [[] for _ in range(4)]
+
+    def worker(out):
+        for password in passwords:
+            try:
+                out.append(ctx.check(password))
+            except extension.PWQError as e:
+                out.append(e.args)
+
+    threads = [threading.Thread(target=worker, args=(out,)) for out in results]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for out in results:
+        assert out == expected
+
+
+@pytest.mark.skipif((os.cpu_count() or 1) < 2, reason='needs more than one core to scale')
+def test_check_threads_scale(extension):
+    # Dictionary checks spend their time in cracklib, outside of the GIL
+    num_threads = min(os.cpu_count(), 4)
+    single = _check_in_threads(extension, [extension.PWQSettings()], 'supercalifragilic', 200)
+    multi = _check_in_threads(extension, [extension.PWQSettings() for _ in range(num_threads)],
+                              'supercalifragilic', 200)
+
+    assert multi > single * (1 + (num_threads - 1) * 0.5)
+
+
+def test_extension_subclass(extension, baseline_check):
+    # Errors are raised with the PWQError of the module which defined the type
+    class Settings(extension.PWQSettings):
+        pass
+
+    with pytest.raises(pwquality.PWQError) as base_err:
+        baseline_check('Thos')
+    with pytest.raises(extension.PWQError) as sub_err:
+        Settings().check('Thos')
+    assert sub_err.value.args == base_err.value.args
+
+
+# Run by the interpreter under test: python -c ... EXTENSION_PATH.  Exits with 77 when the
+# interpreter has no subinterpreter module
+_SUBINTERPRETERS = '\n'.join([
+    'import os.path',
+    'import sys',
+    'try:',
+    '    import _interpreters as interpreters',
+    'except ImportError:',
+    '    try:',
+    '        import _xxsubinterpreters as interpreters',
+    '    except ImportError:',
+    '        sys.exit(77)',
+    'code = "\\n".join([',
+    '    "import sys",',
+    '    "sys.path.insert(0, %r)" % os.path.dirname(sys.argv[1]),',
+    '    "import pwquality",',
+    '    "assert pwquality.__file__ == %r, pwquality.__file__" % sys.argv[1],',
+    '    "try:",',
+    '    "    pwquality.PWQSettings().check(\'Thos\')",',
+    '    "except pwquality.PWQError as e:",',
+    '    "    assert e.args[0] == pwquality.PWQ_ERROR_MIN_LENGTH",',
+    '    "else:",',
+    '    "    raise AssertionError(\'check() passed\')",',
+    '])',
+    'for _ in range(2):',
+    # Both modules create isolated interpreters by default, which only import modules using
+    # multi-phase init
+    '    interp = interpreters.create()',
+    '    try:',
+    # _xxsubinterpreters raises when the code fails and _interpreters returns the exception
+    '        result = interpreters.run_string(interp, code)',
+    '        assert result is None, result',
+    '    finally:',
+    '        interpreters.destroy(interp)',
+])
+
+# Run by a free-threaded interpreter: python -c ... EXTENSION_PATH
+_FREE_THREADED = '\n'.join([
+    'import os.path',
+    'import sys',
+    'import threading',
+    'sys.path.insert(0, os.path.dirname(sys.argv[1]))',
+    'import pwquality',
+    'assert pwquality.__file__ == sys.argv[1], pwquality.__file__',
+    # Importing a module which does not declare Py_mod_gil turns the GIL back on
+    'assert not sys._is_gil_enabled()',
+    'ctx = pwquality.PWQSettings()',
+    'errors = []',
+    'def worker():',
+    '    try:',
+    '        for _ in range(200):',
+    '            try:',
+    '                ctx.check("Thos")',
+    '            except pwquality.PWQError as e:',
+    '                assert e.args[0] == pwquality.PWQ_ERROR_MIN_LENGTH',
+    '            ctx.minlen = 9',
+    '            ctx.check("Thosdjkesd%")',
+    '    except BaseException as e:',
+    '        errors.append(e)',
+    'threads = [threading.Thread(target=worker) for _ in range(8)]',
+    'for thread in threads:',
+    '    thread.start()',
+    'for thread in threads:',
+    '    thread.join()',
+    'assert not errors, errors',
+])
+
+
+@pytest.mark.parametrize('python', [
+    sys.executable,
+    pytest.param(FREE_THREADED_PYTHON, id='free-threaded',
+                 marks=pytest.mark.skipif(FREE_THREADED_PYTHON is None,
+                                          reason='no free-threaded interpreter')),
+])
+def test_extension_subinterpreters(build_extension, python):
+    path = build_extension(python)
+    proc = subprocess.run([python, '-c', _SUBINTERPRETERS, path], stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, universal_newlines=True)
+    if proc.returncode == 77:
+        pytest.skip('%s has no subinterpreter module' % python)
+    assert proc.returncode == 0, proc.stdout
+
+
+@pytest.mark.skipif(FREE_THREADED_PYTHON is None, reason='no free-threaded interpreter')
+def test_extension_free_threaded(build_extension):
+    # Threads share one PWQSettings with the GIL off
+    path = build_extension(FREE_THREADED_PYTHON)
+    proc = subprocess.run([FREE_THREADED_PYTHON, '-c', _FREE_THREADED, path],
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          universal_newlines=True)
+    assert proc.returncode == 0, proc.stdout
+
+
+@pytest.mark.parametrize('binding', ['ctypes_pwq', 'cffi_abi_pwq', 'cffi_api_gen_pwq',
+                                     'cffi_abi_gen_pwq'])
+def test_parallel_checker_map(binding, baseline_check):
+    passwords = ['Thosdjkesd', 'Thosdjkesd%', 'Thosdjkesd%p~i l230-9'] * 10
+    with parallel_pwq.ParallelChecker(binding, max_workers=3) as checker:
+        scores = list(checker.map('check', passwords))
+        assert len(checker.settings) <= 3
+
+    assert scores == [baseline_check(p) for p in passwords]
+
+
+def test_parallel_checker_submit(baseline_check):
+    with parallel_pwq.ParallelChecker(ctypes_pwq, max_workers=2) as checker:
+        success = checker.submit('check', 'Thosdjkesd%')
+        failure = checker.submit(lambda ctx, pw: ctx.check(pw), 'Thos')
+
+        assert success.result() == baseline_check('Thosdjkesd%')
+        with pytest.raises(ctypes_pwq.PWQError) as mod_err:
+            failure.result()
+    with pytest.raises(pwquality.PWQError) as base_err:
+        baseline_check('Thos')
+
+    assert base_err.value.args == mod_err.value.args
+
+
+@pytest.mark.parametrize('binding', ['ctypes_pwq', 'cffi_abi_pwq', 'cffi_api_gen_pwq',
+                                     'cffi_abi_gen_pwq'])
+def test_audit_engine(binding, baseline_check):
+    passwords = ['Thosdjkesd', 'Thos', 'supercalifragilic', 'Thosdjkesd%p~i l230-9'] * 5
+    expected = []
+    for password in passwords:
+        try:
+            expected.append(baseline_check(password))
+        except pwquality.PWQError as e:
+            expected.append(e.args[0])
+
+    with audit_pwq.AuditEngine(binding, max_workers=2, chunk_size=3, max_pending=2) as engine:
+        batches = list(engine.run(iter(passwords)))
+
+    assert [b.start for b in batches] == list(range(0, len(passwords), 3))
+    assert [rc for b in batches for rc in b.scores] == expected
+    assert engine.totals[0] == len([rc for rc in expected if rc >= 0])
+    assert sum(engine.totals.values()) == len(passwords)
+
+
+@pytest.mark.parametrize('binding', ['ctypes_pwq', 'cffi_abi_pwq', 'cffi_api_gen_pwq',
+                                     'cffi_abi_gen_pwq'])
+def test_async_check(binding, baseline_check):
+    passwords = ['Thosdjkesd', 'Thosdjkesd%', 'Thosdjkesd%p~i l230-9'] * 10
+
+    async def run():
+        async with async_pwq.AsyncPWQSettings(binding, max_workers=2, max_in_flight=3) as pwq:
+            scores = await asyncio.gather(*(pwq.check(p) for p in passwords))
+            with pytest.raises(pwq.module.PWQError) as mod_err:
+                await pwq.check('Thos')
+            password = await pwq.generate(56)
+        return scores, mod_err, password
+
+    scores, mod_err, password = asyncio.run(run())
+
+    assert scores == [baseline_check(p) for p in passwords]
+    with pytest.raises(pwquality.PWQError) as base_err:
+        baseline_check('Thos')
+    assert base_err.value.args == mod_err.value.args
+    assert isinstance(password, str)
+
+
+def test_async_cancel_in_flight():
+    # Cancelled callers keep their slot until the call they started is done
+    lock = threading.Lock()
+    running = [0, 0]
+
+    class SlowSettings:
+        def check(self, password, oldpassword=None, username=None):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+            return 0
+
+    async def run():
+        async with async_pwq.AsyncPWQSettings(ctypes_pwq, max_workers=4, max_in_flight=2,
+                                              settings_factory=SlowSettings) as pwq:
+            for _ in range(5):
+                tasks = [asyncio.ensure_future(pwq.check('Thosdjkesd')) for _ in range(4)]
+                await asyncio.sleep(0.005)
+                for task in tasks:
+                    task.cancel()
+            while pwq.in_flight:
+                await asyncio.sleep(0.01)
+            return await pwq.check('Thosdjkesd')
+
+    assert asyncio.run(run()) == 0
+    assert running[1] <= 2
+
+
+def test_build_constants(tmp_path):
+    output = tmp_path / 'pwq_constants.py'
+    build_pwq.build_constants(output_file=str(output))
+    namespace = {}
+    exec(output.read_text(), namespace)
+
+    for name in namespace['__all__']:
+        assert namespace[name] == getattr(pwquality, name)
+        assert namespace[name] == getattr(ctypes_pwq, name)
+    assert namespace['CDEF'] == build_pwq.retrieve_cdef()
+
+
+def test_build_cache(tmp_path):
+    # Processes starting at the same time with an empty cache share a single build.  A stale
+    # build left on the path is not imported
+    stale = tmp_path / 'stale'
+    stale.mkdir()
+    (stale / 'built_cffi_abi_pwq.py').write_text('raise ImportError("stale build")\n')
+    env = dict(os.environ, PWQ_BUILD_CACHE=str(tmp_path / 'cache'),
+               PYTHONPATH=os.pathsep.join([str(stale), os.path.dirname(os.path.abspath(__file__))]
+                                          + sys.path))
+    code = ('import cffi_abi_gen_pwq as m; m.load_library();'
+            ' print(m.PWQSettings().check("Thosdjkesd"))')
+    procs = [subprocess.Popen([sys.executable, '-c', code], cwd=str(tmp_path), env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+             for _ in range(6)]
+    scores = {proc.communicate()[0].splitlines()[-1] for proc in procs}
+    assert [proc.returncode for proc in procs] == [0] * 6
+    assert len(scores) == 1
+
+    builds = [entry for entry in os.listdir(str(tmp_path / 'cache'))
+              if not entry.endswith('.lock')]
+    assert len(builds) == 1
+    assert builds[0].startswith('built_cffi_abi_pwq-')
+    assert not [entry for entry in os.listdir(str(tmp_path)) if entry.startswith('built_cffi')]
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize('binding', ['ctypes_pwq', 'cffi_abi_pwq', 'cffi_api_gen_pwq',
+                                     'cffi_abi_gen_pwq'])
+def test_prefetching_generator(binding, baseline_generate):
+    baseline = baseline_generate(64)
+    with prefetch_pwq.PrefetchingGenerator(binding, entropy_levels=(64,), low_watermark=2,
+                                           high_watermark=4) as gen:
+        _wait_for(lambda: gen.stats()['queued'][64] == 4)
+        passwords = [gen.get(64) for _ in range(3)]
+        missed = gen.get(128)
+        _wait_for(lambda: gen.stats()['queued'][64] == 4)
+        stats = gen.stats()
+
+    for password in passwords:
+        assert type(password) == type(baseline)
+        assert len(baseline) - 1 <= len(password) <= len(baseline) + 1
+    assert len(set(passwords)) == 3
+    assert type(missed) == type(baseline)
+    assert stats['hits'] == 3
+    assert stats['misses'] == 1
+    assert stats['generated'] >= 6
+
+
+def test_prefetching_generator_expiry():
+    with prefetch_pwq.PrefetchingGenerator(ctypes_pwq, entropy_levels=(64,), low_watermark=1,
+                                           high_watermark=2, max_age=0.05) as gen:
+        _wait_for(lambda: gen.stats()['queued'][64] == 2)
+        queued = [item[1] for item in gen._queues[64]]
+        _wait_for(lambda: gen.stats()['expired'] >= 2)
+
+    for buf in queued:
+        assert buf == bytearray(len(buf))
+
+
+class _FailingSettings:
+    def __init__(self, failures):
+        self.failures = failures
+        self._settings = ctypes_pwq.PWQSettings()
+
+    def generate(self, entropy):
+        if self.failures:
+            self.failures -= 1
+            raise ctypes_pwq.PWQError(ctypes_pwq.PWQ_ERROR_RNG, 'Cannot obtain random numbers')
+        return self._settings.generate(entropy)
+
+
+def test_prefetching_generator_errors():
+    # The background thread keeps refilling after generating fails
+    with prefetch_pwq.PrefetchingGenerator(ctypes_pwq, entropy_levels=(64,), low_watermark=1,
+                                           high_watermark=2, retry_interval=0.01,
+                                           settings_factory=lambda: _FailingSettings(2)) as gen:
+        _wait_for(lambda: gen.stats()['queued'][64] == 2)
+        stats = gen.stats()
+    assert stats['errors'] == 2
+    assert stats['last_error'] is None
+
+    gen = prefetch_pwq.PrefetchingGenerator(ctypes_pwq, entropy_levels=(64,), retry_interval=0.01,
+                                            settings_factory=lambda: _FailingSettings(10 ** 9))
+    _wait_for(lambda: gen.stats()['errors'] >= 2)
+    assert gen.last_error.args[0] == ctypes_pwq.PWQ_ERROR_RNG
+    with pytest.raises(ctypes_pwq.PWQError):
+        gen.get(64)
+    with pytest.raises(ctypes_pwq.PWQError) as err:
+        gen.close()
+    assert err.value.args[0] == ctypes_pwq.PWQ_ERROR_RNG
+
+
+def test_settings_pool_reuse():
+    pool = pool_pwq.SettingsPool(ctypes_pwq, max_size=2, max_idle=None)
+    with pool.settings(options={'minlen': 9}) as first:
+        pass
+    with pool.settings(options=['minlen=9']) as second:
+        assert second is first
+        with pool.settings(options={'minlen': 10}) as other:
+            assert other is not first
+    assert len(pool) == 2
+
+    with pool.settings(options={'minlen': 11}):
+        pass
+    # The pool is full so the least recently used settings were dropped
+    assert len(pool) == 2
+    with pool.settings(options={'minlen': 9}) as third:
+        assert third is first
+    with pool.settings(options={'minlen': 10}) as fourth:
+        assert fourth is not other
+
+
+def test_settings_pool_idle_eviction():
+    pool = pool_pwq.SettingsPool(ctypes_pwq, max_idle=0.01)
+    pool.prefork_warmup(count=2)
+    assert len(pool) == 2
+    time.sleep(0.02)
+    pool.evict_idle()
+    assert len(pool) == 0
+
+
+@pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq, cffi_abi_gen_pwq])
+def test_check_cache(module, baseline_check):
+    ctx = module.PWQSettings()
+    cache = ctx.enable_check_cache(maxsize=3)
+    expected = baseline_check('Thosdjkesd%')
+    for password in ('Thosdjkesd%', b'Thosdjkesd%', bytearray(b'Thosdjkesd%\0')):
+        assert ctx.check(password) == expected
+    for _ in range(2):
+        with pytest.raises(module.PWQError) as err:
+            ctx.check('Thos')
+        assert err.value.args[0] == module.PWQ_ERROR_MIN_LENGTH
+    assert (cache.hits, cache.misses) == (3, 2)
+    assert not [key for key in cache._entries if b'Thos' in key]
+
+    # Results are not returned for other settings but come back with the old ones
+    ctx.minlen = 20
+    with pytest.raises(module.PWQError):
+        ctx.check('Thosdjkesd%')
+    ctx.configure(minlen=9)
+    assert ctx.check('Thosdjkesd%') == expected
+    assert (cache.hits, cache.misses) == (4, 3)
+
+    ctx.check('Thosdjkesd%', username='toshio')
+    assert cache.stats() == {'hits': 4, 'misses': 4, 'evictions': 1, 'expirations': 0,
+                             'size': 3}
+
+    # None, empty values, and NUL led buffers may reach libpwquality as NULL or "" so they are
+    # kept apart
+    cache = ctx.enable_check_cache()
+    for username in (None, '', bytearray(b'\0'), 'toshio'):
+        ctx.check('Thosdjkesd%', username=username)
+    assert (cache.hits, cache.misses) == (0, 4)
+    ctx.check('Thosdjkesd%', username='')
+    assert (cache.hits, cache.misses) == (1, 4)
+
+    cache = ctx.enable_check_cache(ttl=0)
+    ctx.check('Thosdjkesd%')
+    ctx.check('Thosdjkesd%')
+    assert (cache.hits, cache.misses, cache.expirations) == (0, 2, 1)
+
+
+@pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq, cffi_abi_gen_pwq])
+def test_check_cache_settings_change_threads(module, monkeypatch):
+    ctx = module.PWQSettings()
+    ctx.minlen = 8
+    cache = ctx.enable_check_cache()
+
+    # A setting changes on another thread after the fingerprint was computed for the old values
+    settings_fingerprint = cache_pwq.settings_fingerprint
+
+    def fingerprint_then_change(settings):
+        fingerprint = settings_fingerprint(settings)
+        monkeypatch.setattr(cache_pwq, 'settings_fingerprint', settings_fingerprint)
+        thread = threading.Thread(target=setattr, args=(ctx, 'minlen', 20))
+        thread.start()
+        thread.join()
+        return fingerprint
+
+    monkeypatch.setattr(cache_pwq, 'settings_fingerprint', fingerprint_then_change)
+    with pytest.raises(module.PWQError) as err:
+        ctx.check('Thosdjkesd%')
+    assert err.value.args[0] == module.PWQ_ERROR_MIN_LENGTH
+    with pytest.raises(module.PWQError):
+        ctx.check('Thosdjkesd%')
+    ctx.minlen = 8
+    score = ctx.check('Thosdjkesd%')
+
+    # Checks racing with changes only ever return the result for the settings they end with
+    stop = threading.Event()
+
+    def toggle():
+        while not stop.is_set():
+            ctx.minlen = 20
+            ctx.configure(minlen=8)
+
+    thread = threading.Thread(target=toggle)
+    thread.start()
+    try:
+        for _ in range(2000):
+            try:
+                ctx.check('Thosdjkesd%')
+            except module.PWQError:
+                pass
+    finally:
+        stop.set()
+        thread.join()
+    assert ctx.check('Thosdjkesd%') == score
+    ctx.minlen = 20
+    with pytest.raises(module.PWQError):
+        ctx.check('Thosdjkesd%')
+
+
+@pytest.mark.parametrize('binding', ['ctypes_pwq', 'cffi_abi_pwq', 'cffi_api_gen_pwq',
+                                     'cffi_abi_gen_pwq'])
+def test_check_cache_instrumentation(binding):
+    module = parallel_pwq.import_binding(binding)
+    with instrument_pwq.Instrumentation(binding) as instr:
+        ctx = module.PWQSettings()
+        cache = ctx.enable_check_cache()
+        for _ in range(3):
+            with pytest.raises(module.PWQError) as err:
+                ctx.check('Thos')
+            assert err.value.args[0] == module.PWQ_ERROR_MIN_LENGTH
+            ctx.check('Thosdjkesd%')
+    assert cache.hits == 4
+    assert instr.snapshot()['check']['codes'] == {module.PWQ_ERROR_MIN_LENGTH: 3, 0: 3}
+
+
+@pytest.mark.parametrize('binding', ['ctypes_pwq', 'cffi_abi_pwq', 'cffi_api_gen_pwq',
+                                     'cffi_abi_gen_pwq'])
+def test_instrumentation(binding, baseline_check, tmp_path):
+    module = parallel_pwq.import_binding(binding)
+    original_check = module.PWQSettings.check
+    events = []
+    passwords = ['Thosdjkesd%p~i l230-9', 'Thos', 'Thos', 'supercalifragilic']
+
+    with instrument_pwq.Instrumentation(binding, hook=events.append) as instr:
+        ctx = module.PWQSettings()
+        for password in passwords:
+            try:
+                ctx.check(password)
+            except module.PWQError:
+                pass
+        ctx.generate(64)
+        ctx.check_many(passwords)
+        ctx.generate_many(3, 64)
+        ctx.generate_into(bytearray(128), 64)
+        instr.write_prometheus(str(tmp_path / 'pwquality.prom'))
+    assert module.PWQSettings.check is original_check
+
+    expected = {}
+    for password in passwords:
+        try:
+            baseline_check(password)
+        except pwquality.PWQError as e:
+            expected[e.args[0]] = expected.get(e.args[0], 0) + 1
+        else:
+            expected[0] = expected.get(0, 0) + 1
+
+    snapshot = instr.snapshot()
+    assert snapshot['check']['codes'] == expected
+    assert snapshot['check']['phases']['native']['count'] == len(passwords)
+    assert snapshot['generate']['codes'] == {0: 1}
+    # check_many() counts the result of every password but is timed as one call
+    assert snapshot['check_many']['codes'] == expected
+    assert snapshot['check_many']['phases']['total']['count'] == 1
+    # generate_many() calling generate() is not counted as a generate() call
+    assert snapshot['generate_many']['codes'] == {0: 1}
+    assert snapshot['generate_into']['codes'] == {0: 1}
+    assert [e.method for e in events] == (['check'] * len(passwords)
+                                          + ['generate', 'check_many', 'generate_many',
+                                             'generate_into'])
+    assert all(e.native_ns > 0 for e in events)
+
+    # Readable by a textfile collector running as another user
+    assert os.stat(str(tmp_path / 'pwquality.prom')).st_mode & 0o777 == 0o644
+    text = (tmp_path / 'pwquality.prom').read_text()
+    assert ('pwquality_calls_total{binding="%s",method="check",code="%d",'
+            'name="PWQ_ERROR_MIN_LENGTH"} 2' % (binding, module.PWQ_ERROR_MIN_LENGTH)) in text
+    assert ('pwquality_call_duration_seconds_count{binding="%s",method="check",phase="total"} 4'
+            % binding) in text
+
+
+
+def test_instrumentation_extension(extension):
+    # The extension's PWQSettings is immutable so it is refused rather than left untimed
+    with pytest.raises(ValueError):
+        instrument_pwq.Instrumentation(extension)
+
+
+PREFILTER_SETTINGS = [
+    {},
+    {'minlen': 12, 'dcredit': 2, 'ucredit': 1, 'lcredit': 1, 'ocredit': 3},
+    {'minlen': 6, 'dcredit': -2, 'ucredit': -1, 'lcredit': -1, 'ocredit': -1},
+    {'minlen': 6, 'minclass': 3, 'maxrepeat': 2, 'maxclassrepeat': 3, 'maxsequence': 3},
+    {'minlen': 6, 'minclass': 4, 'maxrepeat': 1, 'maxclassrepeat': 2, 'maxsequence': 1},
+    {'minlen': 6, 'maxrepeat': -1, 'maxsequence': -2},
+]
+
+
+def _prefilter_corpus():
+    rng = random.Random(17)
+    alphabet = 'aab0123cdxyzXYZ!~ \xe9%'
+    corpus = ['', 'Thos', 'Thosdjkesd', "pa's a s'ap", 'Thosdjkesd%p~i l230-9', 'abcdefghij',
+              'zyxwvutsrq', 'aaaaaaaaaa', '1234567890', 'Aa1!Aa1!Aa1!', 'Thos\x00djkesd']
+    for _ in range(300):
+        corpus.append(''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 16))))
+    # Longer than the prefilter puts in its matrices
+    corpus.extend(['Aa1!' * 100, 'x' * 300, 'abcdefgh' * 40])
+    return corpus
+
+
+@pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq])
+@pytest.mark.parametrize('settings', PREFILTER_SETTINGS)
+@pytest.mark.parametrize('vectorize', [False, True])
+def test_prefilter_parity(module, settings, vectorize):
+    if vectorize and prefilter_pwq.np is None:
+        pytest.skip('needs NumPy')
+    ctx = module.PWQSettings()
+    ctx.configure(**settings)
+    prefilter = prefilter_pwq.Prefilter(ctx, vectorize=vectorize)
+    corpus = _prefilter_corpus()
+
+    results = prefilter.check_many(corpus)
+    assert len(results) == len(corpus)
+    for idx, password in enumerate(corpus):
+        try:
+            expected = ctx.check(password)
+        except module.PWQError as e:
+            assert results[idx] == e.args[0]
+            assert results.error(idx).args == e.args
+            with pytest.raises(module.PWQError) as pre_err:
+                prefilter.check(password)
+            assert pre_err.value.args == e.args
+        else:
+            assert results[idx] == expected
+            assert prefilter.check(password) == expected
+
+    assert prefilter.rejected > 0
+    assert prefilter.passed > 0
+
+
+# A selection of cracklib's r_destructors from fascist.c.  cracklib lowercases and trims the
+# password, applies each of these to it and to its reverse, and looks the result up
+_CRACKLIB_DESTRUCTORS = (
+    ':', '[', ']', '[[', ']]', '[[[', ']]]',
+    '/?p@?p', '/?s@?s', '/?X@?X',
+    '/$s$s', '/0s0o', '/2s2a', '/3s3e', '/5s5s', '/1s1i', '/1s1l', '/4s4a', '/4s4h',
+    '/$s$s/0s0o/2s2a/3s3e/5s5s/1s1i/4s4a', '/$s$s/0s0o/2s2a/3s3e/5s5s/1s1l/4s4h',
+)
+
+# Characters of the classes the purge rules delete
+_CRACKLIB_CLASS_CHARS = {'?p': ".'", '?s': '#~', '?X': '+ '}
+
+
+def _undo_destructor(word, rule):
+    """Return a password which cracklib's destructor rule turns into word"""
+    if rule == ':':
+        return word.capitalize()
+    if rule.strip('[') == '':
+        return '7x!'[:len(rule)] + word
+    if rule.strip(']') == '':
+        return word + '!x7'[:len(rule)]
+    if rule.startswith('/?'):
+        # Purge a character class: the password had some of them mixed in
+        junk = _CRACKLIB_CLASS_CHARS[rule[1:3]]
+        return word[:2] + junk + word[2:]
+    # /XsXY: X is read as Y, so the password had X in place of Y
+    for step in rule.split('/')[1:]:
+        word = word.replace(step[3], step[0])
+    return word
+
+
+@pytest.fixture(scope='session')
+def cracklib_dict(tmp_path_factory):
+    """Return a function which packs a wordlist into a cracklib dictionary and returns its path"""
+    if not (shutil.which('cracklib-format') and shutil.which('cracklib-packer')):
+        pytest.skip('cracklib-format and cracklib-packer are needed to build a dictionary')
+
+    def pack(wordlist):
+        dictpath = str(tmp_path_factory.mktemp('cracklib') / 'pw_dict')
+        words = subprocess.run(['cracklib-format', wordlist], stdout=subprocess.PIPE,
+                               check=True).stdout
+        subprocess.run(['cracklib-packer', dictpath], input=words, stdout=subprocess.DEVNULL,
+                       check=True)
+        return dictpath
+    return pack
+
+
+@pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq])
+def test_dictionary_prefilter(module, cracklib_dict, tmp_path):
+    words = ['password', 'dragon', 'monkey', 'sunshine', 'supercalifragilic', "o'clock"]
+    wordlist = tmp_path / 'words'
+    wordlist.write_text('# comment\n' + ''.join(word + '\n' for word in words))
+    index = dict_pwq.DictionaryIndex.load(str(wordlist), str(tmp_path / 'words.idx'))
+    # cracklib-format packs o'clock as oclock so both are indexed
+    assert len(index) == 7
+    assert dict_pwq.DictionaryIndex.load(str(wordlist), str(tmp_path / 'words.idx')).path
+
+    # Compared against cracklib looking in a dictionary packed from the same wordlist
+    ctx = module.PWQSettings()
+    ctx.dictpath = cracklib_dict(str(wordlist))
+    with pytest.raises(module.PWQError) as err:
+        ctx.check('supercalifragilic')
+    assert err.value.args[0] == module.PWQ_ERROR_CRACKLIB_CHECK
+
+    prefilter = dict_pwq.DictPrefilter(ctx, index)
+    for password in ('Password', 'drowssap', 'pa55w0rd', '123password', 'sunshine!!',
+                     'dragondragon', 'Supercalifragilic1', 'oclock12', "O'clock12"):
+        assert prefilter.is_word(password.encode('utf-8'))
+    for password in ('Thosdjkesd%p~i l230-9', 'xK9#qLm2vT7!'):
+        assert not prefilter.is_word(password.encode('utf-8'))
+
+    mangled = []
+    for word in words:
+        for rule in _CRACKLIB_DESTRUCTORS:
+            password = _undo_destructor(word, rule)
+            mangled.extend((password, password[::-1]))
+    for password in mangled:
+        assert prefilter.is_word(password.encode('utf-8')), password
+
+    corpus = _prefilter_corpus() + mangled + ['xK9#qLm2vT7!']
+    results = prefilter.check_many(corpus)
+    for idx, password in enumerate(corpus):
+        try:
+            expected = ctx.check(password)
+        except module.PWQError as e:
+            assert results.error(idx).args == e.args
+            with pytest.raises(module.PWQError) as pre_err:
+                prefilter.check(password)
+            assert pre_err.value.args == e.args
+        else:
+            assert results[idx] == expected
+            assert prefilter.check(password) == expected
+
+    assert prefilter.skipped > 0
+    assert prefilter.fallbacks > 0
+
+
+@pytest.mark.parametrize('module', [ctypes_pwq, cffi_abi_pwq, cffi_api_gen_pwq])
+def test_badwords_filter(module):
+    ctx = module.PWQSettings()
+    ctx.configure(badwords='acme Widgetron xyzzy abc', minlen=6)
+    badwords = badwords_pwq.BadwordsFilter(ctx)
+    assert badwords.index.search(b'my-ACME-pass')
+    assert badwords.index.search(b'my-nortegdiw')
+    assert not badwords.index.search(b'my-abc-pass')
+
+    corpus = _prefilter_corpus() + ['Xq9#ACMEr7!vL', 'Xq9#emcar7!vL', 'Xq9#abcr7!vL',
+                                    'supercalifragilicacme', 'Xq9#nortegdiwR7', 'acme']
+    results = badwords.check_many(corpus)
+    for idx, password in enumerate(corpus):
+        try:
+            expected = ctx.check(password)
+        except module.PWQError as e:
+            assert results.error(idx).args == e.args
+            with pytest.raises(module.PWQError) as bad_err:
+                badwords.check(password)
+            assert bad_err.value.args == e.args
+        else:
+            assert results[idx] == expected
+            assert badwords.check(password) == expected
+
+    ctx.badwords = 'acme,widgetron'
+    badwords.refresh()
+    assert badwords.index is None
+
+
+def test_audit_cli(baseline_check, tmp_path):
+    passwords = ['Thosdjkesd', 'Thos', 'supercalifragilic', '', 'Thosdjkesd%p~i l230-9'] * 3
+    input_path = tmp_path / 'passwords.txt'
+    input_path.write_bytes('\n'.join(passwords).encode('utf-8'))
+    output_path = tmp_path / 'results.jsonl'
+    argv = [str(input_path), '-o', str(output_path), '--workers', '2', '--chunk-size', '4',
+            '--checkpoint-interval', '0']
+    assert audit_pwq.main(argv) == 0
+
+    records = [json.loads(line) for line in output_path.read_text().splitlines()]
+    offset = 0
+    for password, record in zip(passwords, records):
+        assert record['offset'] == offset
+        offset += len(password.encode('utf-8')) + 1
+        try:
+            expected = baseline_check(password)
+        except pwquality.PWQError as e:
+            assert (record['code'], record['message']) == e.args
+        else:
+            assert record['score'] == expected
+    assert len(records) == len(passwords)
+
+    # Resume from a checkpoint taken after the first six lines.  The records written after it
+    # are replaced
+    complete = output_path.read_bytes()
+    checkpoint = audit_pwq.read_checkpoint(str(output_path) + '.checkpoint')
+    assert checkpoint['offset'] == input_path.stat().st_size
+    head = b''.join(complete.splitlines(True)[:6])
+    checkpoint.update(offset=records[6]['offset'], output_size=len(head), lines=6)
+    audit_pwq.write_checkpoint(str(output_path) + '.checkpoint', checkpoint)
+    output_path.write_bytes(head + b'{"offset": 9999, "trunc')
+    assert audit_pwq.main(argv + ['--resume']) == 0
+    assert output_path.read_bytes() == complete